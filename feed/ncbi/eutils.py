@@ -0,0 +1,142 @@
+# Client for NCBI's eutils efetch service, shared by the accession
+# mapping scripts.
+#
+# Requests go out over a small pool of persistent (keep-alive)
+# connections, one per worker thread, so a run of batches doesn't pay
+# for a new connection each time.  All threads share one rate limit;
+# NCBI allows 3 requests a second, or 10 with an API key.  A request
+# that fails (connection trouble, 429 or 5xx) is retried after an
+# exponentially growing pause.
+
+import time
+import threading
+import socket
+import httplib
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+EFETCH_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+
+class RateLimit(object):
+    """Spaces calls to wait() at least 1/rate seconds apart, across
+    threads"""
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = self.clock()
+            at = max(now, self.next)
+            self.next = at + self.interval
+        if at > now:
+            self.sleep(at - now)
+
+class Eutils(object):
+
+    def __init__(self, url=EFETCH_URL, jobs=3, rate=None, api_key=None,
+                 retries=5, backoff=1.0, timeout=60, sleep=time.sleep):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = parsed.netloc
+        self.path = parsed.path
+        self.jobs = jobs
+        if rate == None:
+            rate = 10 if api_key else 3
+        self.limit = RateLimit(rate, sleep=sleep)
+        self.api_key = api_key
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn == None:
+            conn = self.connection_class(self.host, timeout=self.timeout)
+            self.local.connection = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def drop_connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn != None:
+            conn.close()
+            self.local.connection = None
+            with self.lock:
+                self.connections.remove(conn)
+
+    def efetch(self, ids, rettype, retmode='xml', db='nuccore'):
+        """Returns the body of the efetch response for the given ids.
+        Raises IOError once the retries are used up."""
+        params = {'db': db, 'id': ','.join(ids),
+                  'rettype': rettype, 'retmode': retmode}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        body = urllib.urlencode(params)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.sleep(self.backoff * 2 ** (attempt - 1))
+            self.limit.wait()
+            try:
+                conn = self.connection()
+                conn.request('POST', self.path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.getheader('connection', '').lower() == 'close':
+                    self.drop_connection()
+            except (httplib.HTTPException, socket.error) as e:
+                print '** efetch failed (%s), attempt %s' % (e, attempt + 1)
+                self.drop_connection()
+                continue
+            if response.status == 200:
+                return data
+            print '** efetch status %s, attempt %s' % (response.status, attempt + 1)
+            if response.status != 429 and response.status < 500:
+                break
+        raise IOError('efetch failed for %s' % ','.join(ids))
+
+    def map(self, function, batches):
+        """function(batch) for each batch, run on up to jobs threads;
+        the results come back in batch order, each as soon as it and
+        those before it are done"""
+        if self.jobs <= 1:
+            return (function(batch) for batch in batches)
+        if self.pool == None:
+            self.pool = ThreadPool(self.jobs)
+        return self.pool.imap(function, batches)
+
+    def close(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+def batches(accessions, batch_size, max_batches=None):
+    """Splits accessions into lists of batch_size, at most max_batches
+    of them"""
+    result = []
+    for start in xrange(0, len(accessions), batch_size):
+        if max_batches != None and len(result) >= max_batches:
+            break
+        result.append(accessions[start:start + batch_size])
+    return result
@@ -13,12 +13,13 @@
 """
 
 import sys,os
-import time
 import string
 import xml.etree.ElementTree as ET
 import argparse
 import csv
 
+import eutils
+
 # set command line arguments
 # note that there are two input files: the existing file of 
 # accessions \t taxonID \t strain (mappedfilename) and the list 
@@ -29,6 +30,10 @@ parser.add_argument('unmappedfilename', help='file containing a list of accessio
 parser.add_argument('-o','--outputfile', help='where to write the output; will have same format as accessionfile; default is out.tsv',default='out.tsv')
 parser.add_argument('-b','--batchsize', type=int, help='the number of accession numbers to send to GenBank in each request; default=10', default=10)
 parser.add_argument('-m','--maxbatches', type=int, help='the number of requests to send to GenBank; the total number of accessions queries is batchsize*maxbatches; default=10',default=10)
+parser.add_argument('-j','--jobs', type=int, help='the number of requests to have going at once; default=3', default=3)
+parser.add_argument('-r','--rate', type=float, help='the most requests to send per second; default=3, or 10 with an API key', default=None)
+parser.add_argument('--api-key', help='NCBI API key', default=None)
+parser.add_argument('--url', help='eutils efetch URL', default=eutils.EFETCH_URL)
 
 # Get the accessions that have been mapped so far from previous version of
 # mapping file, and put into two maps: taxaMap for taxonid and strainMap 
@@ -74,32 +79,22 @@ def getUnmappedAccessions(filename, map):
 	unmapped = fewer_unmapped
 	return unmapped
 
-# Function to loop up a batch of accession ids
-def do_one_batch(batch,map):
-	#print batch
-	tempfilename = "efetch.tmp"
-	callEutils(tempfilename,batch)
-	
+# Function to look up a batch of accession ids.  Returns the
+# (accession, taxon id) pairs found.
+def fetch_batch(batch,client):
+	xml = client.efetch(batch,'native')
+
 	# parse the NCBI XML
 	# using http://www.ncbi.nlm.nih.gov/dtd/NCBI_Seqset.dtd as schema
-	try:
-		tree = ET.parse(tempfilename)
-	except IOError:
-		print "Did not find output file from eutils call"
-		raise
+	root = ET.fromstring(xml)
 
-	root = tree.getroot()
-	
-	acc = None
-	strainname = ""
-	taxid = None
-	count = 0
+	found = []
 	for seq in root.iter('Seq-entry'):
 		acc = seq.find(".//Textseq-id_accession").text
 		taxid = seq.find(".//Object-id_id").text
+		strainname = ""
 		if taxid is not None:
-			map[acc] = taxid
-			count = count+1
+			found.append((acc,taxid))
 		# assuming we found a taxaid, look for strain information 
 		# in an OrgMod element
 		# not yet printing strain info to file
@@ -110,49 +105,59 @@ def do_one_batch(batch,map):
 				strainname = orgmod.find('OrgMod_subname').text
 
 		print (acc,taxid,strainname)
-		acc = None
-		strainname = ""
-		taxid = None
-
+	return found
+
+# Adds the results for a batch to map; accessions that weren't found
+# map to '*'.  Returns the (accession, taxon id) pairs that are new.
+def add_batch(batch,found,map):
+	added = []
+	for (acc,taxid) in found:
+		if map.get(acc) != taxid:
+			map[acc] = taxid
+			added.append((acc,taxid))
 	for acc in batch:
 		if not (acc in map):
 			print "Did not find taxon id for accession number ", acc;
 			map[acc] = '*'
+			added.append((acc,'*'))
+	return added
+
+def do_one_batch(batch,map,client):
+	add_batch(batch,fetch_batch(batch,client),map)
 	return map
 
-def callEutils(tempfilename,batch):
-	# using rettype=native&retmode=xml in order to get strain info
-	command = ("wget -q -O " + tempfilename +
-			  " \"http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nuccore&id=" +
-			  ",".join(batch) +
-			  "&rettype=native&retmode=xml\"")
-	print command
-	os.system(command)
+# Looks up the unmapped accessions, batchsize at a time, with up to
+# client.jobs requests going at once.  The output file starts with the
+# existing mappings, and the new ones are appended as each batch comes
+# back, so an interrupted run loses nothing; rerun with the output as
+# the mapped file to carry on.  fetch(batch,client) returns the
+# (accession, taxon id) pairs found for a batch.
+def map_accessions(map,unmapped,outputfilename,client,batchsize,maxbatches,fetch=fetch_batch):
+	outfile = open(outputfilename,"w")
+	for accid in map.iterkeys():
+		outfile.write("%s\t%s\n"%(accid, map[accid]))
+	outfile.flush()
+	batches = eutils.batches(unmapped,batchsize,maxbatches)
+	try:
+		for (batch,found) in client.map(lambda batch: (batch,fetch(batch,client)), batches):
+			for (accid,taxid) in add_batch(batch,found,map):
+				outfile.write("%s\t%s\n"%(accid, taxid))
+			outfile.flush()
+	except IOError as e:
+		print "Giving up:", e
+	finally:
+		outfile.close()
+	return map
 
 def main(args):
 	map = getMappedAccessions(args.mappedfilename)
 	unmapped = getUnmappedAccessions(args.unmappedfilename,map)
-	
-	nbatches = len(unmapped)/args.batchsize
-	# for i in range(nbatches):
-	for i in range(args.maxbatches):
-		start = i*args.batchsize
-		end = min(start+args.batchsize,len(unmapped))
-		if end > start:
-			try:
-				map=do_one_batch(unmapped[start:end],map)
-			except IOError:
-				quit()
-			
-			time.sleep(1)
-
-	# Write out all of the mappings, both old and new.
-
-	outfile = open(args.outputfile,"w")
-	for accid in map.iterkeys():
-		outfile.write("%s\t%s\n"%(accid, map[accid]))
-	outfile.close()
+	client = eutils.Eutils(args.url,jobs=args.jobs,rate=args.rate,api_key=args.api_key)
+	try:
+		map_accessions(map,unmapped,args.outputfile,client,args.batchsize,args.maxbatches)
+	finally:
+		client.close()
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -9,65 +9,48 @@
 
 import sys,os
 import re
-import time
 import string
-
-if len(sys.argv) != 6:
-	print "Wrong number of arguments"
-
-infilename = sys.argv[1]
-silvafilename = sys.argv[2]
-outfilename = sys.argv[3]
-batchsize = int(sys.argv[4])
-maxbatches = int(sys.argv[5])
+import argparse
+
+import eutils
+import map_ncbi_accessions as mna
+
+parser = argparse.ArgumentParser(description='Map Silva accession numbers to NCBI taxon ids')
+parser.add_argument('infilename', help='previous mapping file: accession number, taxon id, tab-separated')
+parser.add_argument('silvafilename', help='e.g. feed/silva/out/silva_taxonly.txt')
+parser.add_argument('outfilename', help='where to write the mapping')
+parser.add_argument('batchsize', type=int, help='the number of accession numbers to send to GenBank in each request')
+parser.add_argument('maxbatches', type=int, help='the number of requests to send to GenBank')
+parser.add_argument('-j','--jobs', type=int, help='the number of requests to have going at once; default=3', default=3)
+parser.add_argument('-r','--rate', type=float, help='the most requests to send per second; default=3, or 10 with an API key', default=None)
+parser.add_argument('--api-key', help='NCBI API key', default=None)
+parser.add_argument('--url', help='eutils efetch URL', default=eutils.EFETCH_URL)
 
 # for the whole deal, need batchsize*maxbatches >= 
 
-# Get the ones that have been mapped so far from previous version of
-# mapping file, and put into map.
-
-infile = open(infilename,"r")
-map = {}
-for line in infile:
-	fields = line.split("\t")
-	if len(fields) >= 2:
-		map[fields[0]] = fields[1].strip()
-infile.close()
-
-print "Start with", len(map)
-
 # Get a list of accession ids from silva that haven't been yet mapped yet.
 
-unmapped = []
-silvafile = open(silvafilename,"r")  # feed/silva/out/silva_taxonly.txt
-silvapattern = re.compile("(.*)\\..*")
-for line in silvafile:
-	accid = string.split(line,".",1)[0]
-	if not (accid in map):
-		unmapped.append(accid)
-silvafile.close()
-print "Unmapped: ", len(unmapped)
+def get_unmapped(silvafilename, map):
+	unmapped = []
+	silvafile = open(silvafilename,"r")  # feed/silva/out/silva_taxonly.txt
+	for line in silvafile:
+		accid = string.split(line,".",1)[0]
+		if not (accid in map):
+			unmapped.append(accid)
+	silvafile.close()
+	print "Unmapped: ", len(unmapped)
+	return unmapped
 
 accpattern = re.compile(".*<TSeq_accver>(.*)\\..*</TSeq_accver>.*")
 taxpattern = re.compile(".*<TSeq_taxid>(.*)</TSeq_taxid>.*")
 
-# Look up the unmapped accession ids, in batches.
-
-def do_one_batch(batch):
-	#print batch
-	tempfilename = "efetch.tmp"
-	command = ("wget -q -O " + tempfilename +
-			  " \"http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nuccore&id=" +
-			  ",".join(batch) +
-			  "&rettype=fasta&retmode=xml\"")
-	print command
+# Look up a batch of accession ids in the fasta (TSeq) format.  Returns
+# the (accession, taxon id) pairs found for it.
 
-	os.system(command)
-	tempfile = open(tempfilename,"r")
-	taxids = []
+def fetch_batch(batch,client):
+	found = []
 	acc = None
-	count = 0
-	for line in tempfile:
+	for line in client.efetch(batch,'fasta').splitlines():
 		if acc is None:
 			probe = re.match(accpattern,line)
 			if probe != None:
@@ -76,35 +59,24 @@ def do_one_batch(batch):
 			# Pull the taxid out of <TSeq_taxid>1056490</TSeq_taxid>
 			probe = re.match(taxpattern,line)
 			if probe != None:
-				map[acc] = probe.group(1)
-				count = count + 1
+				found.append((acc,probe.group(1)))
 			acc = None
-	tempfile.close()
-	for acc in batch:
-		if not (acc in map):
-			print "Accession number didn't map to taxon id", acc;
-			map[acc] = '*'
-
-fewer_unmapped = []
-for acc in unmapped:
-	if not(acc in map):
-		fewer_unmapped.append(acc)
-
-unmapped = fewer_unmapped
-
-nbatches = len(unmapped)/batchsize
-# for i in range(nbatches):
-for i in range(maxbatches):
-	start = i*batchsize
-	end = min(start+batchsize,len(unmapped))
-	if end > start:
-		do_one_batch(unmapped[start:end])
-		time.sleep(1)
-
-
-# Write out all of the mappings, both old and new.
-
-outfile = open(outfilename,"w")
-for accid in map.iterkeys():
-	outfile.write("%s\t%s\n"%(accid, map[accid]))
-outfile.close()
+	return found
+
+# The batches, and the writing of old and new mappings as they come
+# back, are shared with map_ncbi_accessions.py.
+
+def main(args):
+	# Get the ones that have been mapped so far from previous version of
+	# mapping file, and put into map.
+	map = mna.getMappedAccessions(args.infilename)
+	unmapped = get_unmapped(args.silvafilename,map)
+	client = eutils.Eutils(args.url,jobs=args.jobs,rate=args.rate,api_key=args.api_key)
+	try:
+		mna.map_accessions(map,unmapped,args.outfilename,client,
+				   args.batchsize,args.maxbatches,fetch=fetch_batch)
+	finally:
+		client.close()
+
+if __name__ == '__main__':
+	main(parser.parse_args())
@@ -1,35 +1,168 @@
 import unittest
 import os
+import shutil, tempfile, threading, urlparse
+import BaseHTTPServer, SocketServer
 import map_ncbi_accessions as mna
+import seq_taxon_xref
+import eutils
 
-class testAccessionMapping(unittest.TestCase):
-	def setUp(self):	
+# What the fake eutils server knows: accession -> (taxon id, strain)
+RECORDS = {'AF025822': ('67760', 'ME'),
+	   'AM947437': ('329270', None),
+	   'X00001': ('562', None),
+	   'X00002': ('562', 'K-12')}
+
+def native_xml(accessions):
+	entries = []
+	for acc in accessions:
+		if acc in RECORDS:
+			(taxid, strain) = RECORDS[acc]
+			orgmod = ''
+			if strain:
+				orgmod = ('<OrgMod><OrgMod_subtype value="strain">2</OrgMod_subtype>'
+					  '<OrgMod_subname>%s</OrgMod_subname></OrgMod>' % strain)
+			entries.append('<Seq-entry><Textseq-id_accession>%s</Textseq-id_accession>'
+				       '<Object-id_id>%s</Object-id_id>%s</Seq-entry>' % (acc, taxid, orgmod))
+	return ('<?xml version="1.0"?>\n<Bioseq-set><Bioseq-set_seq-set>%s'
+		'</Bioseq-set_seq-set></Bioseq-set>\n' % ''.join(entries))
+
+def tseq_xml(accessions):
+	entries = []
+	for acc in accessions:
+		if acc in RECORDS:
+			entries.append('<TSeq>\n  <TSeq_accver>%s.1</TSeq_accver>\n'
+				       '  <TSeq_taxid>%s</TSeq_taxid>\n</TSeq>' % (acc, RECORDS[acc][0]))
+	return '<?xml version="1.0"?>\n<TSeqSet>\n%s\n</TSeqSet>\n' % '\n'.join(entries)
+
+# A stand-in for efetch.fcgi.  The server's 'failures' list gives the
+# status to answer the next few requests with, instead of data.
+class FakeEutilsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		length = int(self.headers.getheader('content-length'))
+		params = urlparse.parse_qs(self.rfile.read(length))
+		ids = params['id'][0].split(',')
+		with self.server.lock:
+			self.server.requests.append((self.client_address, ids))
+			status = self.server.failures.pop(0) if self.server.failures else 200
+		if status != 200:
+			body = 'error'
+		elif params['rettype'][0] == 'fasta':
+			body = tseq_xml(ids)
+		else:
+			body = native_xml(ids)
+		self.send_response(status)
+		self.send_header('Content-Type', 'text/xml')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
 		pass
 
+class FakeEutils(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class testAccessionMapping(unittest.TestCase):
+	def setUp(self):
+		self.server = FakeEutils(('127.0.0.1', 0), FakeEutilsHandler)
+		self.server.requests = []
+		self.server.failures = []
+		self.server.lock = threading.Lock()
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.url = 'http://127.0.0.1:%s/entrez/eutils/efetch.fcgi' % self.server.server_port
+		self.sleeps = []
+		self.tempdir = tempfile.mkdtemp()
+
 	def tearDown(self):
-		pass
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tempdir)
+
+	def client(self, jobs=1, retries=3):
+		return eutils.Eutils(self.url, jobs=jobs, rate=1000, retries=retries,
+				     sleep=self.sleeps.append)
+
+	def backoffs(self):
+		# the rate limit's pauses are all much shorter
+		return [seconds for seconds in self.sleeps if seconds >= 0.5]
 
-	def testDoesEutilCreatesOutputFile(self):
-		accessionNumber = "AF025822"
-		tempfilename = "efetchtest.tmp"
-		batch = [accessionNumber]
-		mna.callEutils(tempfilename,batch)
-		self.assertTrue(os.path.isfile(tempfilename))
-		if os.path.isfile(tempfilename):
-			os.unlink(tempfilename)
-	
-	# this probably shouldn't actually call NCBI, but it is only one
-	# accession and I haven't looked into mock objects enough yet
 	def testCorrectlyMapSingleAccession(self):
 		accessionNumber = "AF025822"
 		taxonID = '67760'
-		strain='ME'
 		map={'AF23456':'2356'}
 		batch = [accessionNumber]
-		map = mna.do_one_batch(batch,map)
+		client = self.client()
+		map = mna.do_one_batch(batch,map,client)
+		client.close()
 		self.assertTrue(map[accessionNumber]==taxonID)
-			
+		self.assertEqual(map['AF23456'], '2356')
+
+	def testUnknownAccession(self):
+		client = self.client()
+		map = mna.do_one_batch(['AF025822', 'Q99999'],{},client)
+		client.close()
+		self.assertEqual(map, {'AF025822': '67760', 'Q99999': '*'})
+
+	def testRetriesWithBackoff(self):
+		self.server.failures = [503, 429]
+		client = self.client()
+		map = mna.do_one_batch(['AM947437'],{},client)
+		client.close()
+		self.assertEqual(map['AM947437'], '329270')
+		self.assertEqual(len(self.server.requests), 3)
+		self.assertEqual(self.backoffs(), [1.0, 2.0])
+
+	def testGivesUp(self):
+		self.server.failures = [500] * 10
+		client = self.client(retries=2)
+		self.assertRaises(IOError, client.efetch, ['AM947437'], 'native')
+		client.close()
+		self.assertEqual(len(self.server.requests), 3)
+
+	def testMapConcurrentlyOverPersistentConnections(self):
+		unmapped = ['X00001', 'X00002', 'AM947437', 'AF025822', 'Q99999', 'Q99998', 'Q99997']
+		out = os.path.join(self.tempdir, 'out.tsv')
+		client = self.client(jobs=3)
+		map = mna.map_accessions({'OLD1': '7'},unmapped,out,client,2,10)
+		client.close()
+		with open(out) as infile:
+			rows = [line.rstrip('\n').split('\t') for line in infile]
+		self.assertEqual(rows[0], ['OLD1', '7'])
+		self.assertEqual(sorted(row[0] for row in rows), sorted(['OLD1'] + unmapped))
+		self.assertEqual(dict(rows), map)
+		self.assertEqual(len(self.server.requests), 4)
+		# No more connections than threads
+		self.assertTrue(len(set(address for (address, ids) in self.server.requests)) <= 3)
+
+	def testInterruptedRunKeepsResults(self):
+		# The third batch is refused outright
+		self.server.failures = [200, 200, 400]
+		unmapped = ['X00001', 'X00002', 'AM947437', 'AF025822']
+		out = os.path.join(self.tempdir, 'out.tsv')
+		client = self.client()
+		mna.map_accessions({},unmapped,out,client,1,10)
+		client.close()
+		with open(out) as infile:
+			rows = [line.rstrip('\n').split('\t') for line in infile]
+		self.assertEqual(rows, [['X00001', '562'], ['X00002', '562']])
+
+	def testMapSilvaAccessionsFromFasta(self):
+		unmapped = ['X00001', 'AM947437', 'Q99999']
+		out = os.path.join(self.tempdir, 'out.tsv')
+		client = self.client(jobs=2)
+		map = mna.map_accessions({'OLD1': '7'},unmapped,out,client,2,10,
+					 fetch=seq_taxon_xref.fetch_batch)
+		client.close()
+		self.assertEqual(map, {'OLD1': '7', 'X00001': '562', 'AM947437': '329270', 'Q99999': '*'})
+		self.assertEqual(len(self.server.requests), 2)
+
+	def testMaxBatches(self):
+		self.assertEqual(eutils.batches(range(7), 3), [[0, 1, 2], [3, 4, 5], [6]])
+		self.assertEqual(eutils.batches(range(7), 3, 2), [[0, 1, 2], [3, 4, 5]])
 
 if __name__ == "__main__":
     unittest.main()
-
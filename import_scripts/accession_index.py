@@ -0,0 +1,133 @@
+# Sorted, memory-mapped accession index.
+#
+# Maps accession ids to a few string fields, e.g. GenBank accession to
+# (NCBI taxon id, strain).  The keys are stored sorted and padded to a
+# fixed width, followed by an offset table into the field values; the
+# file is memory-mapped and searched by binary search, so a lookup
+# touches a few pages instead of needing the whole table loaded into a
+# dict (or unpickled) first.
+#
+# Layout:
+#   MAGIC
+#   count, key width, field count, metadata length   (HEADER)
+#   metadata, as JSON (for whatever the writer wants to remember)
+#   keys: count * key width bytes, NUL padded, sorted
+#   offsets: count + 1 of them (OFFSET), into the values area
+#   values: for each key, its fields joined by tabs ('' for None)
+
+import os, mmap, struct, json, bisect
+
+MAGIC = 'ACCIDX1\n'
+HEADER = struct.Struct('<QIIQ')
+OFFSET = struct.Struct('<Q')
+
+def is_index(path):
+    with open(path, 'rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+def write(path, items, metadata=None):
+    """Writes an index of items, which are (key, fields) pairs or a dict
+    from key to fields.  The file is replaced atomically."""
+    if isinstance(items, dict):
+        items = items.iteritems()
+    items = sorted(items)
+    width = max([len(key) for (key, fields) in items] or [0])
+    field_count = max([len(fields) for (key, fields) in items] or [0])
+    meta = json.dumps(metadata)
+    temp = path + '.new'
+    with open(temp, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(HEADER.pack(len(items), width, field_count, len(meta)))
+        outfile.write(meta)
+        previous = None
+        for (key, fields) in items:
+            if key == previous:
+                raise ValueError('duplicate key in accession index: %s' % key)
+            outfile.write(key.ljust(width, '\0'))
+            previous = key
+        values = [encode(fields) for (key, fields) in items]
+        offset = 0
+        outfile.write(OFFSET.pack(offset))
+        for value in values:
+            offset += len(value)
+            outfile.write(OFFSET.pack(offset))
+        for value in values:
+            outfile.write(value)
+    os.rename(temp, path)
+
+def encode(fields):
+    return '\t'.join([(field or '').replace('\t', ' ').replace('\n', ' ')
+                      for field in fields])
+
+class AccessionIndex(object):
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:len(MAGIC)] != MAGIC:
+            raise ValueError('not an accession index: %s' % path)
+        (self.count, self.width, self.field_count, meta_length) = \
+            HEADER.unpack_from(self.map, len(MAGIC))
+        start = len(MAGIC) + HEADER.size
+        self.metadata = json.loads(self.map[start:start + meta_length])
+        self.keys_at = start + meta_length
+        self.offsets_at = self.keys_at + self.count * self.width
+        self.values_at = self.offsets_at + (self.count + 1) * OFFSET.size
+        self.keys = _Keys(self)
+
+    def find(self, key):
+        """Position of key in the index, or -1"""
+        if len(key) > self.width:
+            return -1
+        padded = key.ljust(self.width, '\0')
+        i = bisect.bisect_left(self.keys, padded)
+        if i < self.count and self.keys[i] == padded:
+            return i
+        return -1
+
+    def key(self, i):
+        return self.keys[i].rstrip('\0')
+
+    def fields(self, i):
+        """The fields for the key at position i, with None for empty"""
+        (start,) = OFFSET.unpack_from(self.map, self.offsets_at + i * OFFSET.size)
+        (end,) = OFFSET.unpack_from(self.map, self.offsets_at + (i + 1) * OFFSET.size)
+        value = self.map[self.values_at + start:self.values_at + end]
+        return tuple([field or None for field in value.split('\t')])
+
+    def get(self, key, default=None):
+        i = self.find(key)
+        if i < 0:
+            return default
+        return self.fields(i)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def iteritems(self):
+        """(key, fields) for every key, in key order"""
+        for i in xrange(self.count):
+            yield (self.key(i), self.fields(i))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+# The padded keys as a sequence, for bisect
+class _Keys(object):
+
+    def __init__(self, index):
+        self.map = index.map
+        self.at = index.keys_at
+        self.width = index.width
+        self.count = index.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.at + i * self.width
+        return self.map[start:start + self.width]
@@ -17,28 +17,208 @@
 # Mapping of EOL classication ids to OTT idspaces, from Yan Wong:
 #  ((('ncbi', 1172), ('if', 596), ('worms', 123), ('irmng', 1347), ('gbif', 800)))
 
-import sys, csv
+# Command line arguments:
+#   digest: the EOL digest file
+#   outdir: where to write eol-mappings-<idspace>.csv for each idspace,
+#     with columns page id, idspace, source id, sorted by source id
+#     (ready for merge joins), and eol-mappings.csv, all of them one
+#     after another.  (So eol-mappings.csv is grouped by idspace, not
+#     in digest order; load_eol_page_ids.py keeps the first qid it
+#     sees for a page and node, so its report can name different qids
+#     than it did with the digest order.)
+#   --jobs: number of chunks of the digest to convert at once
+
+import sys, os, csv, re, argparse
+import multiprocessing
+import itertools
+import cStringIO
+import shutil
 
 sources = [('ncbi', 1172), ('if', 596), ('worms', 123), ('irmng', 1347), ('gbif', 800)]
 
 sources_dict = {str(id): prefix for (prefix, id) in sources}
 
-writer = csv.writer(sys.stdout)
-
-row_count = 0
-hit_count = 0
-
-for row in csv.reader(sys.stdin):
-    row_count += 1
-    if len(row) != 5:
-        # print 'bad row:', row  #about ten of these
-        continue
-    [uid, source_id, hierarchy, page_id, name] = row
-    if row_count % 1000000 == 0:
-        print >>sys.stderr, row_count, name
-    probe = sources_dict.get(hierarchy)
-    if probe != None:
-        writer.writerow([page_id, probe, source_id])
-        hit_count += 1
-
-print >>sys.stderr, "%s input rows, %s output rows" % (row_count, hit_count)
+# Lines whose third (hierarchy) column is one of the sources.  Only
+# these get decoded as CSV; in a chunk of the digest they're found by
+# one regular expression search rather than line by line.  (Matching
+# from the newline before the line, rather than from ^, is much
+# faster.)  This relies on each line being a whole record; see
+# process_chunk.
+wanted_line = re.compile(r'\n([^,\n]*,(?:"[^"\n]*(?:""[^"\n]*)*"|[^,\n]*),(?:%s),[^\n]*)' %
+                         '|'.join(sources_dict.keys()))
+
+CHUNK_SIZE = 1 << 24
+
+def chunks(inpath, chunk_size=CHUNK_SIZE):
+    """Splits the file into (inpath, start, end) byte ranges of whole
+    lines"""
+    size = os.path.getsize(inpath)
+    result = []
+    with open(inpath, 'rb') as infile:
+        start = 0
+        while start < size:
+            infile.seek(min(start + chunk_size, size))
+            infile.readline()
+            end = min(infile.tell(), size)
+            result.append((inpath, start, end))
+            start = end
+    return result
+
+def process_chunk(chunk):
+    """Converts one chunk of the digest.  Returns the number of records
+    in it, and the converted rows as CSV text for each idspace; or None
+    if a quoted field in it has a newline, so that its lines aren't
+    all records."""
+    (inpath, start, end) = chunk
+    with open(inpath, 'rb') as infile:
+        infile.seek(start)
+        text = infile.read(end - start)
+    # Splitting at quotes, every other piece is inside a quoted field
+    # (a doubled quote just makes an empty piece)
+    if '\n' in '"'.join(text.split('"')[1::2]):
+        return None
+    line_count = text.count('\n')
+    if not text.endswith('\n'):
+        line_count += 1
+    return (line_count, convert(csv.reader(wanted_line.findall('\n' + text))))
+
+RECORD_BATCH = 100000
+
+def process_records(inpath, start):
+    """Converts the digest from start on, read record by record with
+    csv.reader.  Generates (number of records, converted rows as CSV
+    text for each idspace) for successive batches of records."""
+    with open(inpath, 'rb') as infile:
+        infile.seek(start)
+        reader = csv.reader(infile)
+        while True:
+            rows = list(itertools.islice(reader, RECORD_BATCH))
+            if len(rows) == 0:
+                break
+            yield (len(rows), convert(rows))
+
+def process_digest(inpath, jobs):
+    """Generates the results for successive parts of the digest.  The
+    chunks are converted in parallel until one turns out to have a
+    record that runs over several lines; it starts on a record
+    boundary, as all the chunks before it were whole lines, and from
+    there on the digest is read record by record."""
+    todo = chunks(inpath)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(process_chunk, todo)
+    else:
+        pool = None
+        results = itertools.imap(process_chunk, todo)
+    try:
+        for ((inpath, start, end), result) in itertools.izip(todo, results):
+            if result == None:
+                print >>sys.stderr, ('Multi-line record at or after byte %s; '
+                                     'reading the rest as CSV' % start)
+                for result in process_records(inpath, start):
+                    yield result
+                return
+            yield result
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+def convert(rows):
+    """Returns the rows for each idspace, as (number of rows, CSV
+    text)"""
+    by_idspace = {prefix: [] for (prefix, id) in sources}
+    for row in rows:
+        if len(row) != 5:
+            # print 'bad row:', row  #about ten of these
+            continue
+        [uid, source_id, hierarchy, page_id, name] = row
+        probe = sources_dict.get(hierarchy)
+        if probe != None:
+            by_idspace[probe].append((page_id, probe, source_id))
+    texts = {}
+    for prefix in by_idspace:
+        out = cStringIO.StringIO()
+        csv.writer(out).writerows(by_idspace[prefix])
+        texts[prefix] = (len(by_idspace[prefix]), out.getvalue())
+    return texts
+
+def sort_idspace(path):
+    """Sorts the rows in path.unsorted by source id, into path: numeric
+    ids in numeric order, then any others"""
+    with open(path + '.unsorted', 'rb') as infile:
+        lines = infile.readlines()
+    rows = list(csv.reader(lines))
+    if len(rows) != len(lines):
+        # Some source id has a newline in it, so the lines aren't all
+        # rows; write the rows out again one by one instead
+        out = cStringIO.StringIO()
+        writer = csv.writer(out)
+        lines = []
+        for row in rows:
+            writer.writerow(row)
+            lines.append(out.getvalue())
+            out.seek(0)
+            out.truncate()
+    numeric = []
+    other = []
+    for (row, line) in itertools.izip(rows, lines):
+        source_id = row[2]
+        if source_id.isdigit():
+            numeric.append((int(source_id), line))
+        else:
+            other.append((source_id, line))
+    numeric.sort()
+    other.sort()
+    with open(path + '.new', 'wb') as outfile:
+        for (key, line) in numeric:
+            outfile.write(line)
+        for (key, line) in other:
+            outfile.write(line)
+    os.remove(path + '.unsorted')
+    os.rename(path + '.new', path)
+    return len(rows)
+
+def main(args):
+    paths = [os.path.join(args.outdir, 'eol-mappings-%s.csv' % prefix)
+             for (prefix, id) in sources]
+    unsorted = {prefix: open(path + '.unsorted', 'wb')
+                for ((prefix, id), path) in zip(sources, paths)}
+    row_count = 0
+    hit_count = 0
+    for (record_count, texts) in process_digest(args.digest, args.jobs):
+        row_count += record_count
+        for prefix in texts:
+            (count, text) = texts[prefix]
+            hit_count += count
+            unsorted[prefix].write(text)
+        print >>sys.stderr, row_count, hit_count
+    for prefix in unsorted:
+        unsorted[prefix].close()
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        counts = pool.map(sort_idspace, paths)
+        pool.close()
+        pool.join()
+    else:
+        counts = map(sort_idspace, paths)
+    for ((prefix, id), count) in zip(sources, counts):
+        print >>sys.stderr, "%s: %s rows" % (prefix, count)
+
+    outpath = os.path.join(args.outdir, 'eol-mappings.csv')
+    with open(outpath + '.new', 'wb') as outfile:
+        for path in paths:
+            with open(path, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, 1 << 20)
+    os.rename(outpath + '.new', outpath)
+
+    print >>sys.stderr, "%s input rows, %s output rows" % (row_count, hit_count)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert EOL digest')
+    parser.add_argument('digest', help='EOL digest .csv file')
+    parser.add_argument('outdir', help='where to write the mappings')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='number of chunks to convert at once')
+    main(parser.parse_args())
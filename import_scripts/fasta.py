@@ -0,0 +1,80 @@
+# Header-only reading of FASTA files.
+#
+# The SILVA export is mostly sequence data; the importers only want the
+# '>' lines.  Instead of handing every line to Python, these scanners
+# jump from one header to the next by searching for '\n>' in large
+# buffers, so the headers-only digest and the full download both read
+# quickly.  A plain .fasta file is memory-mapped; a .fasta.gz file is
+# decompressed a block at a time, so only one block plus one partial
+# header is ever held in memory.
+
+import os, mmap, zlib
+
+def headers(path, blocksize=1 << 22):
+    """Generates the header lines of the FASTA file at path, without
+    the leading '>' or the line end"""
+    if path.endswith('.gz'):
+        return _block_headers(_gunzip_blocks(path, blocksize))
+    else:
+        return _mapped_headers(path)
+
+def _mapped_headers(path):
+    with open(path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size == 0:
+            return
+        m = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if m[0:1] == '>':
+                pos = 0
+            else:
+                pos = m.find('\n>')
+                if pos >= 0: pos += 1
+            while pos >= 0:
+                end = m.find('\n', pos)
+                if end < 0: end = size
+                yield m[pos + 1:end].rstrip('\r')
+                pos = m.find('\n>', end)
+                if pos >= 0: pos += 1
+        finally:
+            m.close()
+
+def _gunzip_blocks(path, blocksize):
+    # Concatenated gzip members (as written by pigz or bgzip) each
+    # get a fresh decompressor.
+    with open(path, 'rb') as infile:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = infile.read(blocksize)
+            if not data:
+                break
+            while data:
+                block = d.decompress(data)
+                if block: yield block
+                data = d.unused_data
+                if data:
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        block = d.flush()
+        if block: yield block
+
+def _block_headers(blocks):
+    # buf always starts just before a line start (a real or pretend
+    # '\n'), so '\n>' finds every header including the first.
+    buf = '\n'
+    for block in blocks:
+        buf += block
+        pos = 0
+        while True:
+            h = buf.find('\n>', pos)
+            if h < 0:
+                buf = buf[-1:]
+                break
+            end = buf.find('\n', h + 1)
+            if end < 0:
+                # Header continues in the next block
+                buf = buf[h:]
+                break
+            yield buf[h + 2:end].rstrip('\r')
+            pos = end
+    if buf.startswith('\n>'):
+        yield buf[2:].rstrip('\r\n')
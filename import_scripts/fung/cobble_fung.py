@@ -13,7 +13,10 @@
 # There is a different script fix-if.py dated 3 Oct 2015.  Not sure
 # how they relate.
 
-import csv, os
+import sys, os, argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import repair
 
 # inputs = ['feed/fung/if.4/', 'feed/fung/if.3/', 'feed/fung/if.2/', 'feed/fung/if.1/']
 # inputs = ['resource/fung-4/', 'resource/fung-3/', 'resource/fung-2/', 'resource/fung-1/']
@@ -28,218 +31,64 @@ for rank in ['kingdom', 'phylum', 'subphylum', 'class', 'subclass', 'order', 'fa
 
 all_ranks = {}
 
-def get_taxonomy(dirname, tag):
-    return Taxonomy(dirname)
-
-# ofung is not a smasher Taxonomy object.  see class Taxonomy below.
-
-def fixit(ofung, use_names):
-    count = 0
-    added = 0
-    for id in ofung.taxa:
-        otaxon = ofung.taxa[id]
-        taxon = fung.maybeTaxon(otaxon.id)
-        taxon_by_name = None
-        if otaxon.name in fung.taxa_by_name:
-            taxon_by_name = fung.taxa_by_name[otaxon.name]
-        danger = False
-
-        if taxon == None:
-            # Might be a new one, but don't create homonyms
-            if taxon_by_name == True:
-                # We have a homonym already, and no way to match.  Skip it.
-                continue
-
-            if taxon_by_name == None:
-                # Really a new one.  Create it
-                copy_taxon(otaxon, fung)
-                added += 1
-                continue
-
-            if not use_names:
-                continue
-
-            # Don't create a homonym, but do transfer information over from taxon 
-            # that has same name
-
-            if (int(taxon_by_name.id) - int(otaxon.id)) > 2:
-                danger = True
-            taxon = taxon_by_name
-
-        if taxon.flags == '':
-            taxon.flags = otaxon.flags
-
-        if taxon.parent_id == otaxon.parent_id:
-            continue   # No new information here
-
-        # Merge parent pointer from the supplementary record into the main record.
-        if (taxon.parent_id == None or
-            not taxon.parent_id in fung.taxa):
-            taxon.parent_id = otaxon.parent_id
-            if danger:
-                print "Targeting taxon %s with id %s (id in supplemental taxonomy is %s)"%(taxon.name, taxon.id, otaxon.id)
-            count += 1
-
-    print 'Added', added, '/ fixed', count
-
-def copy_taxon(otaxon, fung):
-    if otaxon.name in fung.taxa_by_name:
-        # Do not create homonyms
-        return
-    taxon = fung.new_taxon(otaxon.name, otaxon.rank, None)
-    taxon.id = otaxon.id
-    fung.enter(taxon)
-    fung.taxa[taxon.id] = taxon
-    taxon.parent_id = otaxon.parent_id
-    taxon.flags = otaxon.flags
-
-class Taxonomy:
-    def __init__(self, dirname):
-        print 'Loading', dirname
-        self.taxa = {}
-        self.taxa_by_name = {}
-        infile = open(dirname + "taxonomy.tsv")
-        for line in infile:
-            fields = (line.strip() + '\t\t|\tx').split('\t|\t')
-            id = fields[0]
-            parent_id = fields[1]
-            name = fields[2]
-            rank = fields[3].strip()
-            flags = fields[4].strip()
-            if id == 'uid': continue
-            if rank == '' or rank == 'no rank': rank = None
-            rec = Taxon(id, parent_id, name, rank, flags, self)
-            self.enter(rec)
-        infile.close()
-
-    def enter(self, rec):
-        self.taxa[rec.id] = rec
-        if rec.name in self.taxa_by_name:
-            self.taxa_by_name[rec.name] = True
-        else:
-            self.taxa_by_name[rec.name] = rec
-
-
-    def dump(self, dirname):
-
-        # Decide which records to keep
-        keep = {}
-        for rec in fung.taxa.values():
-            if rec.parent_id in fung.taxa:
-                keep[rec.id] = True
-                keep[rec.parent_id] = True
-        print 'Flushing', len(fung.taxa) - len(keep)
-
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        outfile = open(dirname + "taxonomy.tsv", 'w')
-        writer = csv.writer(outfile, delimiter='\t')
-        writer.writerow(('uid', 'parent_uid', 'name', 'rank', 'flags'))
-        missing = 0
-        badrank = 0
-        for rec in sorted(self.taxa.values(), key=lambda rec:int(rec.id)):
-            if rec.id in keep:
-                if not rec.parent_id in keep:
-                    if rec.name == 'Fungi':
-                        rec.parent_id = ''
-                    else:
-                        rec.parent_id = 'not found'
-                        missing += 1
-                parent = rec.getParent()
-                if (parent != None and
-                    parent.rank in rank_order and
-                    rec.rank in rank_order and
-                    rank_order[parent.rank] >= rank_order[rec.rank]):
-                    print ('Detaching %s %s %s from %s %s %s' %
-                           (rec.name, rec.id, rec.rank, parent.name, parent.id, parent.rank))
-                    badrank += 1
-                    rec.parent_id = None
-                rec.dump(writer)
-        outfile.close()
-        print 'Missing', missing, 'parents /', badrank, 'upranks'
-
-    def maybeTaxon(self, id_or_name):
-        if id_or_name in self.taxa:
-            return self.taxa[id_or_name]
-        if id_or_name in self.taxa_by_name:
-            rec = self.taxa_by_name[id_or_name]
-            if rec == True:
-                return None
-            else:
-                return rec
-
-    def new_taxon(self, name, rank, sources):
-        tax = Taxon(None, '', name, rank, '', self)
-        return tax
-
-
-class Taxon:
-    def __init__(self, id, parent_id, name, rank, flags, taxonomy):
-        if parent_id == '': parent_id = None
-        self.id = id
-        self.parent_id = parent_id
-        self.name = name
-        self.rank = rank
-        self.flags = flags
-        self.taxonomy = taxonomy
+def note_ranks(ranks):
+    for rank in ranks:
         if rank != None:
             all_ranks[rank] = True
 
-    def getParent(self):
-        if self.parent_id in self.taxonomy.taxa:
-            return self.taxonomy.taxa[self.parent_id]
-        else:
-            return None
-
-    def dump(self, writer):
-        parent_id = self.parent_id
-        if parent_id == None: parent_id = ''
-        if self.rank == None: self.rank = 'no rank'
-        writer.writerow((self.id, parent_id, self.name, self.rank, self.flags))
-
-
-fung  = get_taxonomy(inputs[0], 'if')
-
-fungi = fung.maybeTaxon('90156')
-if fungi == None:
-    fungi = fung.new_taxon('Fungi', 'kingdom', 'if:90156')
-    fungi.id = '90156'   #kludge
-    fung.enter(fungi)
-
-ascomycota = fung.maybeTaxon('90031')
-if ascomycota == None:
-    ascomycota = fung.new_taxon('Ascomycota', 'phylum', 'if:90031')
-    ascomycota.id = '90031'
-    fung.enter(ascomycota)
-ascomycota.parent_id = fungi.id
-
-tina = fung.maybeTaxon('501470')
-tina.parent_id = ascomycota.id
-
-#                Saccharomycetes class 90791
-#  is in         Saccharomycotina subphylum 501470
-#  which is in   Ascomycota phylum 90031
-sacc = fung.maybeTaxon('90791')
-if sacc == None:
-    sacc = fung.new_taxon('Saccharomycetes', 'class', 'if:90791')
-    sacc.id = '90791'
-    fung.enter(sacc)
-sacc.parent_id = tina.id
-
-print 'Testing:' , fung.maybeTaxon('Saccharomycetes')
-
-for input in inputs[1:-1]:
-    fixit(get_taxonomy(input, 'if'), True)
-
-fixit(get_taxonomy(inputs[-1], 'if'), False)
-
-sacc.flags = ''
-
-fung.dump(destdir)
-
-print all_ranks.keys()
-
-print "Don't forget to cp -p feed/fung/if.4/synonyms.tsv %ssynonyms.tsv" % destdir
+def get_taxonomy(dirname, tag):
+    taxonomy = repair.Table.load(dirname)
+    note_ranks(taxonomy.ranks)
+    return taxonomy
+
+def ensure_taxon(fung, id, name, rank):
+    k = fung.lookup(id)
+    if k == None:
+        k = fung.add(id, None, name, rank, '')
+        note_ranks([rank])
+    return k
+
+def cobble(inputs, destdir):
+    """Repairs the first version in inputs from the others, newest first,
+    and writes the result to destdir"""
+    fung = get_taxonomy(inputs[0], 'if')
+
+    fungi = ensure_taxon(fung, '90156', 'Fungi', 'kingdom')
+    ascomycota = ensure_taxon(fung, '90031', 'Ascomycota', 'phylum')
+    fung.set_parent(ascomycota, fung.ids[fungi], 'by hand')
+
+    tina = fung.lookup('501470')
+    fung.set_parent(tina, fung.ids[ascomycota], 'by hand')
+
+    #                Saccharomycetes class 90791
+    #  is in         Saccharomycotina subphylum 501470
+    #  which is in   Ascomycota phylum 90031
+    sacc = ensure_taxon(fung, '90791', 'Saccharomycetes', 'class')
+    fung.set_parent(sacc, fung.ids[tina], 'by hand')
+
+    print 'Testing:' , fung.lookup('Saccharomycetes') == sacc
+
+    # The oldest version is only joined on id
+    for input in inputs[1:-1]:
+        fung.repair_from(get_taxonomy(input, 'if'), True)
+    fung.repair_from(get_taxonomy(inputs[-1], 'if'), False)
+
+    fung.flags[sacc] = ''
+
+    fung.dump(destdir, ('Fungi',), rank_order)
+
+    print all_ranks.keys()
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Recover parent pointers missing from an IF conversion')
+    argparser.add_argument('versions', nargs='*', default=inputs,
+                           help='directories containing taxonomy.tsv, newest (the one to repair) first')
+    argparser.add_argument('--out', default=destdir,
+                           help='where to write the repaired taxonomy.tsv')
+    args = argparser.parse_args()
+    cobble(args.versions, args.out)
+
+    print "Don't forget to cp -p feed/fung/if.4/synonyms.tsv %ssynonyms.tsv" % args.out
 
 
 # --- End of file ---
@@ -14,8 +14,12 @@ DEFAULT_SYNONYMS_NAME = 'synonyms.tsv'
 # If this changes, change here and maybe the calls to utf8e can disappear as well
 INPUT_ENCODING = 'latin-1'
 
+# The exports are read and decoded this many bytes at a time
+BUFFER_SIZE = 1 << 20
+
 import sys
 import codecs
+import itertools
 import logging
 
 
@@ -88,137 +92,121 @@ def startup(args):
     logging.info("Processing taxonomy from %s", taxonomy_fname)
     logging.info("Processing names from %s\n", names_fname)
 
+    # Ranks, authors, years and higher taxon names repeat a lot; rows
+    # share one copy of each
+    strings = dict()
+
     try:
-        names_file = codecs.open(names_fname,"r",INPUT_ENCODING)
-        name_rows = get_dicts(names_file)
+        (fdc_dict, fdc_set) = read_fdc(taxonomy_fname,strings)
     except IOError as e:
-        msg = "opening %s as names file" % str(e)
-        print "Error: " +  msg
+        msg = "opening %s as taxonomy file" % str(e)
+        print "Error: " + msg
         logging.error(msg)
         sys.exit(1)
-        
+
     try:
-        taxonomy_file = codecs.open(taxonomy_fname,"r",INPUT_ENCODING)
-        taxonomy_rows = get_dicts(taxonomy_file)
+        (name_rows, if_id_dict) = read_names(names_fname,strings)
     except IOError as e:
-        msg = "opening %s as taxonomy file" % str(e)
-        print "Error: " + msg
+        msg = "opening %s as names file" % str(e)
+        print "Error: " +  msg
         logging.error(msg)
         sys.exit(1)
+    strings = None
 
+    fdc_index = index_fdc(fdc_dict)
 
-    fdc_dict = dict()
-    for row in taxonomy_rows:
-        #sanity checking - doesn't seem to happen
-        if not 'FDC-PK' in row:
-            logging.warning("found taxonomy row without FDC-PK: %s", str(row))
-        else:
-            if row['FDC-PK'] in fdc_dict:
-                logging.warning("duplicate FDC-PK found %s", str(row))
-            else:
-                fdc_dict[row['FDC-PK']] = row
-
-    fdc_set = init_fdc_set(fdc_dict)
+    try:
+        synonyms_file = codecs.open(synonyms_fname,"w","utf-8")
+        synonyms_file.write(SYNONYM_HEADER)
+    except IOError as e:
+        logging.error("error %s opening/writing %s as name synonym file",str(e),synonyms_fname)
+        synonyms_file = None
 
-    if_id_dict = fill_if_dict(name_rows)
     name2taxon = dict()
     name2synonym = dict()
-    taxon_table = []
-    synonyms = []
-    taxon_rows = []
     for row in name_rows:
-        name = row['Name']
+        name = row.name
         display_name = utf8e(name)
-        display_id = utf8e(row['IF-ID'])
+        display_id = utf8e(row.if_id)
         logging.info('Processing name: %s with id %s ***',display_name,display_id)
-        if row['IF-ID'] in KNOWNBAD:
-            row['status'] = 'invalid'
+        if row.if_id in KNOWNBAD:
+            row.status = 'invalid'
             logging.info("Rejecting knownbad id %s",display_id)
-        elif 'CurrentNameID' in row and (row['IF-ID'] != row['CurrentNameID']):
-            logging.info("Found synonym %s; IF-ID %s; CurrentNameID %s",display_name,display_id,utf8e(row['CurrentNameID']))
+        elif row.current != None and (row.if_id != row.current):
+            logging.info("Found synonym %s; IF-ID %s; CurrentNameID %s",display_name,display_id,utf8e(row.current))
             real_id = resolve_synonym(row,if_id_dict)
-            row['CurrentNameID'] = real_id
-            synonyms.append(row)
+            row.current = real_id
+            if synonyms_file != None:
+                write_synonym(synonyms_file,row)
             name2synonym[name] = row
-            row['status'] = 'synonym'
-        elif 'CurrentNameID' not in row:
+            row.status = 'synonym'
+        elif row.current == None:
             # last chance lookup for higher level taxa
             if fdc_find(name,fdc_set):
                 logging.info('found unsupported name in hard lineage search %s',display_name)
-                if row['IF-ID'] not in KNOWNBAD:
-                    validate_name(name2taxon,name,row,taxon_rows)
+                if row.if_id not in KNOWNBAD:
+                    validate_name(name2taxon,name,row)
                     logging.info('Adding %s to name to taxon with id %s',display_name,display_id)
                 else:
                     logging.info('Rejecting known bad Name: %s, id: %s',display_name,display_id)
             elif len(name.split(' ')) == 2:
                 logging.info('trying unsupported species %s',display_name)
-                if row['IF-ID'] not in KNOWNBAD:
-                    validate_name(name2taxon,name,row,taxon_rows)
+                if row.if_id not in KNOWNBAD:
+                    validate_name(name2taxon,name,row)
                     logging.info('Adding %s to name to taxon with id %s',display_name,display_id)
             else:
                 logging.info("rejecting name w/o Current ID: %s",display_name)
-                row['status'] = 'invalid' 
+                row.status = 'invalid'
         elif name in name2taxon:
             current_authority = format_authority(row)
             existing_row = name2taxon[name]
             existing_authority = format_authority(existing_row)
             logging.info("duplicate taxon name existing: %s; new: %s",existing_authority,current_authority)
-            existing_msg = "Existing id: %s " % existing_row['IF-ID'] 
-            if "FDC-FK" in existing_row:
-                existing_msg = existing_msg + ("; FDC-FK: %s" % existing_row['FDC-FK'])
-            if "CurrentNameID" in existing_row:
-                existing_msg = existing_msg + ("; CurrentNameID: %s" % existing_row['CurrentNameID'])
+            existing_msg = "Existing id: %s " % existing_row.if_id
+            if existing_row.fdc_fk != None:
+                existing_msg = existing_msg + ("; FDC-FK: %s" % existing_row.fdc_fk)
+            if existing_row.current != None:
+                existing_msg = existing_msg + ("; CurrentNameID: %s" % existing_row.current)
             logging.info(existing_msg)
-            new_msg = "new id: " + row['IF-ID'] 
-            if "FDC-FK" in row:
-                new_msg = new_msg + "; FDC-FK: " + row['FDC-FK']
-            if "CurrentNameID" in row:
-                new_msg = new_msg + ("; CurrentNameID: %s" % row['CurrentNameID'])
+            new_msg = "new id: " + row.if_id
+            if row.fdc_fk != None:
+                new_msg = new_msg + "; FDC-FK: " + row.fdc_fk
+            if row.current != None:
+                new_msg = new_msg + ("; CurrentNameID: %s" % row.current)
             logging.info(new_msg)
         else:
-            validate_name(name2taxon,name,row,taxon_rows)
+            validate_name(name2taxon,name,row)
             logging.info("Adding %s to name to taxon with id %s",display_name,display_id)
-    get_taxonomy(name_rows,fdc_dict,name2taxon,name2synonym) #second pass
-    write_taxonomy(results_fname,name_rows,name2taxon)
-    write_synonyms(synonyms_fname,synonyms)
+    if synonyms_file != None:
+        synonyms_file.close()
+    #second pass
+    write_taxonomy(results_fname,name_rows,fdc_dict,fdc_index,name2taxon,name2synonym)
 
 
 
-def validate_name(name2taxon,name,row,taxon_rows):
-    """marks name as valid and updates lists and mappings """
+def validate_name(name2taxon,name,row):
+    """marks name as valid and updates mappings """
     name2taxon[name] = row
-    row['status'] = 'available'
-    taxon_rows.append(row)
-
-
-def get_taxonomy(name_rows,fdc_dict,name2taxon,name2synonym):
-    """ """
-    for row in name_rows: 
-        if 'status' in row:
-            if row['status'] == 'available':
-                get_rank(row,fdc_dict)
-                if 'rank' not in row:
-                    row['rank'] = 'no rank'
-                get_parent(row,fdc_dict,name2taxon,name2synonym)
+    row.status = 'available'
 
 
 def is_synonym(row):
     """
     tests if the if id and the current name id differ, which indicates a synonym
     """
-    return 'CurrentNameID' in row and (row['IF-ID'] != row['CurrentNameID'])
+    return row.current != None and (row.if_id != row.current)
 
 def format_authority(row):
     """
     Generates an authority string for a name
     """
-    name_str = utf8e(row['Name'])
-    if 'Author' in row:
-        author_str = utf8e(row['Author'])
+    name_str = utf8e(row.name)
+    if row.author != None:
+        author_str = utf8e(row.author)
     else:
         author_str = ''
-    if 'Year' in row:
-        year_str = utf8e(row['Year'])
+    if row.year != None:
+        year_str = utf8e(row.year)
     else:
         year_str = ''
     return  "%s (%s, %s)" %(name_str,author_str,year_str)
@@ -226,80 +214,69 @@ def format_authority(row):
 TAXON_HEADER = "uid\t|\tparent_uid\t|\tname\t|\trank\t|\t\n"
 TAXON_TEMPLATE = "%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n"
 
-def write_taxonomy(taxonomy_fname,name_table,name2taxon):
+def write_taxonomy(taxonomy_fname,name_rows,fdc_dict,fdc_index,name2taxon,name2synonym):
     """
     Opens and writes lines in the taxonomy file corresponding to
-    each valid (available) name
+    each valid (available) name, working out its rank and parent
+    as it goes
     """
-    try:        
+    try:
         taxonomy_file = codecs.open(taxonomy_fname,"w","utf-8")
         taxonomy_file.write(TAXON_HEADER)
-        for row in name_table:
-            if 'id' in row:
-                uid = row['id']
-            elif 'CurrentNameID' in row:
-                uid = row['CurrentNameID']
-            else:
-                uid = row['IF-ID']
-            name = row['Name']
-            if 'parent' in row:
-                parent = row['parent']
-            else:
-                parent = ''
-            if 'rank' in row:
-                rank = row['rank']
-            else:
-                rank = 'no rank'
-            if 'status' in row and row['status'] == 'available':
-                outstr = TAXON_TEMPLATE % (uid,parent,name,rank)
+        for row in name_rows:
+            if row.status == 'available':
+                rank = get_rank(row,fdc_dict,fdc_index)
+                if rank == None:
+                    rank = 'no rank'
+                parent = get_parent(row,rank,fdc_dict,fdc_index,name2taxon,name2synonym)
+                if parent == None:
+                    parent = ''
+                if row.current != None:
+                    uid = row.current
+                else:
+                    uid = row.if_id
+                outstr = TAXON_TEMPLATE % (uid,parent,row.name,rank)
                 taxonomy_file.write(outstr)
         taxonomy_file.close()
     except IOError as e:
         logging.error("error %s opening/writing %s as taxonomy file file",str(e),taxonomy_fname)
-        
+
 
 SYNONYM_HEADER = "uid\t|\tname\t|\ttype\t|\tTBD\t|\n"
 SYNONYM_TEMPLATE = "%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n"
 
-def write_synonyms(synonyms_fname,synonyms):
+def write_synonym(synonyms_file,syn):
     """
-    Opens and writes lines in the synonyms file corresponding to
-    each name identified as a synonym (IF id != Current Name id)
+    Writes the line in the synonyms file for a name identified as a
+    synonym (IF id != Current Name id)
     If authority information is available, it will appear in the
-    third column, prefix by 'authority', rather than by 'synonym'     
+    third column, prefix by 'authority', rather than by 'synonym'
     """
-    try:
-        synonyms_file = codecs.open(synonyms_fname,"w","utf-8")
-        synonyms_file.write(SYNONYM_HEADER)
-        for syn in synonyms:
-            if 'CurrentNameID' in syn:  #if no id, then nothing worth writing
-                if 'Author' in syn and 'Year' in syn:
-                    namefield = "%s %s %s" % (syn['Name'],syn['Author'],syn['Year'])
-                    typefield = 'authority'
-                else:
-                    namefield = syn['Name']
-                    typefield = 'synonym'
-                outstr = SYNONYM_TEMPLATE % (syn['CurrentNameID'],namefield,typefield,'')
-                synonyms_file.write(outstr)
-        synonyms_file.close()
-    except IOError as e:
-        logging.error("error %s opening/writing %s as name synonym file",str(e),synonym_fname)
+    if syn.current != None:  #if no id, then nothing worth writing
+        if syn.author != None and syn.year != None:
+            namefield = "%s %s %s" % (syn.name,syn.author,syn.year)
+            typefield = 'authority'
+        else:
+            namefield = syn.name
+            typefield = 'synonym'
+        outstr = SYNONYM_TEMPLATE % (syn.current,namefield,typefield,'')
+        synonyms_file.write(outstr)
 
 BAD_SYNONYMS = []
 
 def resolve_synonym(row,if_id_dict):
     """
-    This chains back to find the taxonomically valid name for the synonym 
+    This chains back to find the taxonomically valid name for the synonym
     in the name field of row.  Synonyms are names of rows which have
     a CurrentNameID defined and has a different value from the IF-ID.  This
     returns the IF-ID of the first row encountered in the chaining that is
-    not a synonym.    
+    not a synonym.
     """
-    if_id = row['IF-ID']
+    if_id = row.if_id
     if if_id in BAD_SYNONYMS:
        logging.info("found bad synonym %s",if_id)
        return if_id
-    current_id = row['CurrentNameID']
+    current_id = row.current
     while if_id != current_id:
        logging.info("in resolve synonym; current_id = %s",current_id)
        if current_id in BAD_SYNONYMS:
@@ -307,38 +284,27 @@ def resolve_synonym(row,if_id_dict):
            return current_id
        if current_id in if_id_dict:
            new_row = if_id_dict[current_id]
-           if_id = new_row['IF-ID']
-           if 'CurrentNameID' in new_row:
-               current_id = new_row['CurrentNameID']
+           if_id = new_row.if_id
+           if new_row.current != None:
+               current_id = new_row.current
            else:
-               logging.info("chained synonym resolution mapped %s to unsupported id %s",row['IF-ID'],if_id)
+               logging.info("chained synonym resolution mapped %s to unsupported id %s",row.if_id,if_id)
                return if_id
        else:
            logging.info("chained id lookup failed: %s",current_id)
            return if_id
-    logging.info("chained synonym resolution mapped %s to %s",row['IF-ID'],current_id)
+    logging.info("chained synonym resolution mapped %s to %s",row.if_id,current_id)
     return current_id
 
-           
-def fill_if_dict(name_rows):
-    if_dict = dict()
-    for row in name_rows:
-        if 'IF-ID' not in row:
-            logging.info("found name row without IF-ID: %s",str(row))
-        elif row['IF-ID'] in if_dict:
-            logging.info("duplicate if_id found %s",str(row))
-        else:
-            if_dict[row['IF-ID']] = row
-    return if_dict
 
 def back_translate_name(name,name2taxon,name2synonym):
     """returns an if-id for a name"""
     if name in name2taxon:
         row = name2taxon[name]
-        return row['IF-ID']
+        return row.if_id
     elif name in name2synonym:
         row = name2synonym[name]
-        return row['CurrentNameID']
+        return row.current
     else:
         logging.info("Back translate failed for %s",name)
         return ''
@@ -359,153 +325,156 @@ rank_list = ["GenusName","FamilyName","OrderName","SubclassName","ClassName","Su
 raw_rank_list = ["genus","family","order","subclass","class","subphylum","phylum","kingdom"]
 rank_list_len = len(rank_list)
 
-def get_rank(row,fdc_dict):
-    name = row['Name']
+def get_rank(row,fdc_dict,fdc_index):
+    """returns the rank of an available name, or None"""
+    rank = None
+    name = row.name
     display_name = utf8e(name)
     logging.info("Looking for rank for %s",display_name)
-    if ('FDC-FK' in row and row['IF-ID'] != row['FDC-FK']):
+    if (row.fdc_fk != None and row.if_id != row.fdc_fk):
         # probably species
         if len(name.split(' ')) == 2:
             logging.info("found species %s",display_name)
-            row['rank'] = 'species'
+            rank = 'species'
         else:  # problem, check FDC-FK
             logging.info("probably not a species")
-            if row['FDC-FK'] in fdc_dict:
-                hier = fdc_dict[row['FDC-FK']]
+            if row.fdc_fk in fdc_dict:
+                hier = fdc_dict[row.fdc_fk]
                 for rank_field in rank_list:
-                    if name == hier[rank_field]:
-                        row['rank'] = rank_map[rank_field]
-                        logging.info("found %s %s",display_name,row['rank'])
-                else:               
-                    if 'CurrentNameID' in row:
+                    if name == getattr(hier,rank_field):
+                        rank = rank_map[rank_field]
+                        logging.info("found %s %s",display_name,rank)
+                else:
+                    if row.current != None:
                        logging.info('Bad species? %s',display_name)
             else:
-                fdc_list = fdc_search(name,fdc_dict)
+                fdc_list = fdc_search(name,fdc_index)
                 if len(fdc_list) > 0:
                     logging.info('found (and lost) in hard search %s',str(fdc_list))
                     if validate_lineages(name,fdc_list):
                         rank_guess = fdc_list[0][1]
                         logging.info("adding name %s with guessed rank %s",display_name,rank_guess)
-                        row['rank'] = rank_guess
-                else:               
-                    if 'CurrentNameID' in row:
+                        rank = rank_guess
+                else:
+                    if row.current != None:
                         logging.info('Bad species? %s',display_name)
-    elif ('FDC-FK' in row and row['IF-ID'] == row['FDC-FK']):
+    elif (row.fdc_fk != None and row.if_id == row.fdc_fk):
         rank_guess = 'genus'
-        row['rank'] = rank_guess
+        rank = rank_guess
         logging.info("probably a genus")
-        if len(row['Name'].split(' ')) > 1:
-            if 'CurrentNameID' in row:
+        if len(row.name.split(' ')) > 1:
+            if row.current != None:
                 logging.info('Bad genus? %s',display_name)
             else:
-                fdc_list = fdc_search(name,fdc_dict)
+                fdc_list = fdc_search(name,fdc_index)
                 if len(fdc_list) > 0:
                     logging.info('found in hard search %s',str(fdc_list))
                     if validate_lineages(name,fdc_list):
                         rank_guess = fdc_list[0][1]
                         logging.info("adding name %s with guessed rank %s",display_name,rank_guess)
-                        row['rank'] = rank_guess
-                else:               
-                    if 'CurrentNameID' in row:
-                        logging.warn('Bad taxon? %s',utf8e(row['Name']))
+                        rank = rank_guess
+                else:
+                    if row.current != None:
+                        logging.warn('Bad taxon? %s',utf8e(row.name))
                     else:
                         logging.warn("Name without currentNameID not found %s",display_name)
     else:
-        fdc_list = fdc_search(name,fdc_dict)
+        fdc_list = fdc_search(name,fdc_index)
         if len(fdc_list) > 0:
             logging.info('found in hard search %s',str(fdc_list))
             if validate_lineages(name,fdc_list):
                 rank_guess = fdc_list[0][1]
                 logging.info("adding name %s with guessed rank %s",display_name,rank_guess)
-                row['rank'] = rank_guess
-        else:               
-            if 'CurrentNameID' in row:
+                rank = rank_guess
+        else:
+            if row.current != None:
                 logging.warn('Bad taxon? %s',display_name)
             else:
                 logging.warn("Name without currentNameID not found %s",display_name)
+    return rank
 
 
-def get_parent(row,fdc_dict,name2taxon,name2synonym):
-    """
+def get_parent(row,rank,fdc_dict,fdc_index,name2taxon,name2synonym):
+    """returns the parent id of an available name, or None
     """
-    name = row['Name']
-    if ('FDC-FK' in row and row['IF-ID'] != row['FDC-FK']):         # probably species
+    parent_id = None
+    name = row.name
+    if (row.fdc_fk != None and row.if_id != row.fdc_fk):         # probably species
         if len(name.split(' ')) == 2:
-            if row['FDC-FK'] in fdc_dict:
-                parent_name = fdc_dict[row['FDC-FK']]['GenusName']
+            if row.fdc_fk in fdc_dict:
+                parent_name = fdc_dict[row.fdc_fk].GenusName
                 if parent_name in name2taxon:
                     t = name2taxon[parent_name]
-                    if 'IF-ID' in t:
-                        parent_id = t['IF-ID']
+                    if t.if_id != None:
+                        parent_id = t.if_id
                     else:
                         parent_id = 'not found'
                 elif parent_name in name2synonym:
                     s = name2synonym[parent_name]
-                    if 'CurrentNameID' in s:
-                        parent_id = s['CurrentNameID']
+                    if s.current != None:
+                        parent_id = s.current
                 else:
                     parent_id = 'not found'
             else:
-                logging.warn('fdc not found: %s',row['FDC-FK'])
+                logging.warn('fdc not found: %s',row.fdc_fk)
                 parent_id = 'not found'
                 parent_name = 'not found'
             logging.info("found parent for species %s: %s with id %s",utf8e(name),utf8e(parent_name),utf8e(parent_id))
-            row['parent'] = parent_id # 
         else:  # problem, check FDC-FK
-            fdc_parent_search(row,fdc_dict,name2taxon,name2synonym)
+            parent_id = fdc_parent_search(row,rank,fdc_dict,fdc_index,name2taxon,name2synonym)
     else:
-        fdc_parent_search(row,fdc_dict,name2taxon,name2synonym)
-
-          
-def fdc_parent_search(row,fdc_dict,name2taxon,name2synonym):
-    name = row['Name']
-    if 'FDC-FK' in row and row['FDC-FK'] in fdc_dict:
-        hier = fdc_dict[row['FDC-FK']]
-        if hier['KingdomName'] == 'Fungi':
+        parent_id = fdc_parent_search(row,rank,fdc_dict,fdc_index,name2taxon,name2synonym)
+    return parent_id
+
+
+def fdc_parent_search(row,rank,fdc_dict,fdc_index,name2taxon,name2synonym):
+    parent_id = None
+    name = row.name
+    if row.fdc_fk != None and row.fdc_fk in fdc_dict:
+        hier = fdc_dict[row.fdc_fk]
+        if hier.KingdomName == 'Fungi':
             parent_id = extract_parent(name,hier,name2taxon,name2synonym)
-            row['parent'] = parent_id
         else:
             parent_id = extract_parent(name,hier,name2taxon,name2synonym)
-            row['parent'] = parent_id
-            #row['status'] = 'non-fungi'
-            logging.info("Taxon %s is in kingdom %s, not fungi",utf8e(name),utf8e(hier['KingdomName']))
+            #row.status = 'non-fungi'
+            logging.info("Taxon %s is in kingdom %s, not fungi",utf8e(name),utf8e(hier.KingdomName))
     else:
-        fdc_list = fdc_search(name,fdc_dict)
+        fdc_list = fdc_search(name,fdc_index)
         if len(fdc_list) > 0:
             fdc = fdc_list[0][0]
             hier = fdc_dict[fdc]
             parent_id = extract_parent(name,hier,name2taxon,name2synonym)
-            row['parent'] = parent_id
-            if hier['KingdomName'] != 'Fungi':
-                logging.info("Taxon %s is in kingdom %s, not fungi",utf8e(name),utf8e(hier['KingdomName']))
-        else:               
-            if 'CurrentNameID' in row:
-                logging.info('Bad %s %s',utf8e(row['rank']),utf8e(name))    
+            if hier.KingdomName != 'Fungi':
+                logging.info("Taxon %s is in kingdom %s, not fungi",utf8e(name),utf8e(hier.KingdomName))
+        else:
+            if row.current != None:
+                logging.info('Bad %s %s',utf8e(rank),utf8e(name))
+    return parent_id
 
 
 def extract_parent(name,hier,name2taxon,name2synonym):
     disp_name = utf8e(name)
     logging.info("extracting parent for %s",disp_name)
-    parent_offset = find_immediate_parent(name,hier) 
+    parent_offset = find_immediate_parent(name,hier)
     foo = re_search_ranks(parent_offset,hier,name2taxon,name2synonym,disp_name)
     logging.info("tried re_search_ranks for %s, got %s",disp_name,utf8e(foo))
     return foo
 
 def find_immediate_parent(name,hier):
     for n,rank_field in enumerate(rank_list):
-        if name == hier[rank_field]:
+        if name == getattr(hier,rank_field):
             return n+1
 
 def re_search_ranks(parent_index,hier,name2taxon,name2synonym,disp_name):
     for sub_key in rank_list[parent_index:]:
         logging.info("sub_key is %s",sub_key)
-        next_parent = hier[sub_key]
+        next_parent = getattr(hier,sub_key)
         if next_parent != 'Incertae sedis':
             parent_name = next_parent
             parent_id = back_translate_name(parent_name,name2taxon,name2synonym)
-            if parent_id != '':  
+            if parent_id != '':
                 logging.info("found parent %s for non-species %s with id %s",utf8e(parent_name),disp_name,utf8e(parent_id))
-                return parent_id      
+                return parent_id
             if parent_name.startswith('Fossil '):
                 parent_name = parent_name[len('Fossil '):]
                 parent_id = back_translate_name(parent_name,name2taxon,name2synonym)
@@ -516,21 +485,22 @@ def re_search_ranks(parent_index,hier,name2taxon,name2synonym,disp_name):
         logging.warn('failed to find parent id for %s',disp_name)
         return ''
 
-def fdc_search(name,fdc_dict):
-    result =[]
+def index_fdc(fdc_dict):
+    """
+    Maps each name in the FDC hierarchies to the (FDC-PK, rank) pairs
+    it appears as, in the order a scan of fdc_dict would find them
+    """
+    fdc_index = dict()
     for fdc_id in fdc_dict:
         row = fdc_dict[fdc_id]
         for rank_field in rank_map:
-            if name == row[rank_field]:
-                result.append((fdc_id,rank_map[rank_field]))
-    return result
+            name = getattr(row,rank_field)
+            if name != None:
+                fdc_index.setdefault(name,[]).append((fdc_id,rank_map[rank_field]))
+    return fdc_index
 
-def init_fdc_set(fdc_dict):
-    fset = set()
-    for fdc_id in fdc_dict:
-        for name in fdc_dict[fdc_id].values():
-            fset.add(name)
-    return fset
+def fdc_search(name,fdc_index):
+    return fdc_index.get(name,[])
 
 def fdc_find(name,fset):
     return name in fset
@@ -548,20 +518,131 @@ def validate_lineages(name,fdc_list):
         return True
 
 
-def get_dicts(names_file):
-    result = []
-    line = names_file.readline()
-    keys = extract_keys(line)
-    line = names_file.readline()
-    while line:
-       values = extract_values(line)
-       d = {}
-       for pair in zip(keys,extract_values(line)):
-           if pair[1] != '':
-               d[pair[0]] = pair[1]
-       result.append(d)    
-       line = names_file.readline()
-    return result
+class Name(object):
+    """
+    A row of the IF export, holding just the columns used here;
+    empty values are None
+    """
+    __slots__ = ['if_id','name','author','year','fdc_fk','current','status']
+
+    def __init__(self):
+        for field in Name.__slots__:
+            setattr(self,field,None)
+
+NAME_COLUMNS = [('IF-ID','if_id'),('Name','name'),('Author','author'),
+                ('Year','year'),('FDC-FK','fdc_fk'),('CurrentNameID','current')]
+
+# Values that are the same in many rows
+SHARED_NAME_FIELDS = ['author','year']
+
+class Hierarchy(object):
+    """
+    The rank columns of a row of the FDC export; missing names are None
+    """
+    __slots__ = rank_list
+
+def read_names(names_fname,strings):
+    """
+    Reads the IF export into a list of Name rows, and a dict from
+    IF-ID to the first row with that id
+    """
+    (keys,rows) = read_values(names_fname)
+    columns = column_numbers(keys)
+    fields = [(columns[key],field) for (key,field) in NAME_COLUMNS if key in columns]
+    name_rows = []
+    if_dict = dict()
+    for values in rows:
+        if len(values) == 0:
+            # already logged as a bad data row
+            continue
+        row = Name()
+        for (k,field) in fields:
+            value = get_value(values,k)
+            if value != None and field in SHARED_NAME_FIELDS:
+                value = strings.setdefault(value,value)
+            setattr(row,field,value)
+        name_rows.append(row)
+        if row.if_id == None:
+            logging.info("found name row without IF-ID: %s",str(row_dict(keys,values)))
+        elif row.if_id in if_dict:
+            logging.info("duplicate if_id found %s",str(row_dict(keys,values)))
+        else:
+            if_dict[row.if_id] = row
+    return (name_rows,if_dict)
+
+def read_fdc(taxonomy_fname,strings):
+    """
+    Reads the FDC export into a dict from FDC-PK to Hierarchy, and the
+    set of all the values in it
+    """
+    (keys,rows) = read_values(taxonomy_fname)
+    columns = column_numbers(keys)
+    pk = columns.get('FDC-PK')
+    fields = [(columns.get(rank_field),rank_field) for rank_field in rank_list]
+    fdc_dict = dict()
+    fset = set()
+    for values in rows:
+        fdc_id = get_value(values,pk)
+        #sanity checking - doesn't seem to happen
+        if fdc_id == None:
+            logging.warning("found taxonomy row without FDC-PK: %s", str(row_dict(keys,values)))
+        elif fdc_id in fdc_dict:
+            logging.warning("duplicate FDC-PK found %s", str(row_dict(keys,values)))
+        else:
+            hier = Hierarchy()
+            for (k,rank_field) in fields:
+                value = get_value(values,k)
+                if value != None:
+                    value = strings.setdefault(value,value)
+                setattr(hier,rank_field,value)
+            fdc_dict[fdc_id] = hier
+            for (key,value) in zip(keys,values):
+                if value != '':
+                    fset.add(strings.get(value,value))
+    return (fdc_dict,fset)
+
+def column_numbers(keys):
+    """maps column names to positions; a repeated name means its last column"""
+    return dict((key,k) for (k,key) in enumerate(keys))
+
+def get_value(values,k):
+    if k != None and k < len(values) and values[k] != '':
+        return values[k]
+    return None
+
+def row_dict(keys,values):
+    """the row as a dict of its non-empty values, for log messages"""
+    return dict((key,value) for (key,value) in zip(keys,values) if value != '')
+
+def read_values(fname):
+    """returns the column names of the file and an iterator over the
+    value lists of its rows"""
+    lines = read_lines(fname)
+    keys = extract_keys(next(lines,u''))
+    return (keys,itertools.imap(extract_values,lines))
+
+def read_lines(fname):
+    """
+    Generates the lines of the file, decoded.  The file is read and
+    decoded a buffer at a time, and split into lines the way
+    codecs' readline would split it.
+    """
+    decoder = codecs.getincrementaldecoder(INPUT_ENCODING)()
+    with open(fname,'rb') as infile:
+        text = u''
+        while True:
+            block = infile.read(BUFFER_SIZE)
+            if not block:
+                break
+            lines = (text + decoder.decode(block)).splitlines(True)
+            # the last line may continue in the next buffer (even when
+            # it ends in '\r', the first half of '\r\n')
+            text = lines.pop()
+            for line in lines:
+                yield line
+        text = text + decoder.decode('',True)
+        if text:
+            yield text
 
 def extract_keys(line):
     strings = line.split(',')
@@ -607,12 +688,6 @@ def extract_values(line):
     return result
 
 
-def reverse_name_lookup(id,name_rows):
-    for row in name_rows:
-        if row['id'] == id:
-            return row['name']
-    return None
-
 # Not sure this is the best way to make the
 # formatting errors in log messages disappear,
 # but it seems to be effective.
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 # Command line arguments
-#   1: taxon.txt
+#   1: taxon.txt, either as it comes from GBIF (projected on the fly by
+#      project_2016.py) or already projected
 #   2: directory in which to put taxonomy.tsv and synonyms.tsv
+#   3: (optional) number of processes to parse taxon.txt with
 
 col = {"taxonID": 0,
        "parentNameUsageID": 1,
@@ -17,7 +19,12 @@ not_doubtful = {
 }
 
 import sys, os, json
+import itertools, multiprocessing
 from collections import Counter
+from project_2016 import projected_rows
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import subtrees
 
 """
 ignore.txt should include a list of ids to ignore, all of their children
@@ -26,7 +33,44 @@ should also be ignored but do not need to be listed
 
 incertae_sedis_kingdom = 0
 
-def process_gbif(inpath, outdir):
+def chunk_bounds(inpath, jobs):
+    """Split the file into about jobs byte ranges, each starting at the
+    beginning of a line"""
+    size = os.path.getsize(inpath)
+    bounds = [0]
+    with open(inpath, "r") as infile:
+        for k in range(1, jobs):
+            infile.seek(max(size * k // jobs, bounds[-1]))
+            if infile.tell() > 0:
+                infile.readline()
+            bounds.append(min(infile.tell(), size))
+    bounds.append(size)
+    raw = is_raw_dump(inpath)
+    return [(inpath, bounds[k], bounds[k+1], raw)
+            for k in range(jobs) if bounds[k] < bounds[k+1]]
+
+def is_raw_dump(inpath):
+    """True if the file has GBIF's own columns rather than those of the
+    2016 projection"""
+    with open(inpath, "r") as infile:
+        return len(infile.readline().split('\t')) >= 11
+
+def chunk_lines(inpath, start, end):
+    with open(inpath, "r") as infile:
+        infile.seek(start)
+        pos = start
+        while pos < end:
+            line = infile.readline()
+            if line == '':
+                break
+            pos += len(line)
+            yield line
+
+def read_chunk(chunk):
+    """Classify the rows in one byte range of the input.  Everything is
+    kept in row order, so chunks can be merged in file order to give
+    the same result as a single pass over the file."""
+    (inpath, start, end, raw) = chunk
 
     col_acceptedNameUsageID = col['acceptedNameUsageID']
     col_taxonID = col['taxonID']
@@ -36,31 +80,19 @@ def process_gbif(inpath, outdir):
     col_taxonRank = col['taxonRank']
     col_parentNameUsageID = col['parentNameUsageID']
 
-    to_ignore = []    # stack
-    to_ignore.append(incertae_sedis_kingdom)  #kingdom incertae sedis
-
-    infile = open(inpath,"r")
-    outfile = open(os.path.join(outdir, "taxonomy.tsv"), "w")
-    outfilesy = open(os.path.join(outdir, "synonyms.tsv"), "w")
-
-    infile_taxon_count = 0
-    infile_synonym_count = 0
-    count = 0
-    bad_id = 0
-    no_parent = 0
-    parent ={}      #key is taxon id, value is the parent
-    children ={}    #key is taxon id, value is list of children (ids)
-    nm_storage = {} #key is taxon id, value is the name
-    nrank = {}      #key is taxon id, value is rank
-    synnames = {}   #key is synonym id, value is name
-    syntargets = {} #key is synonym id, value is taxon id of target
-    syntypes = {}   #key is synonym id, value is synonym type
+    counts = Counter()
+    taxa = []       #(id, name, rank, parent id or None)
+    synonyms = []   #(synonym id, name, taxon id of target, synonym type)
+    to_ignore = []  #list of ids
     to_remove = []  #list of ids
     paleos = []     #ids that come from paleodb
-    flushed_because_source = 0
-    print "taxa synonyms no_parent"
-    for row in infile:
-        fields = row.split('\t')
+
+    lines = chunk_lines(inpath, start, end)
+    if raw:
+        rows = projected_rows(lines)
+    else:
+        rows = (line.split('\t') for line in lines)
+    for fields in rows:
         # For information on what information is in each column see
         # meta.xml in the gbif distribution.
    
@@ -71,20 +103,20 @@ def process_gbif(inpath, outdir):
         synonymp = syn_target_id_string.isdigit()
 
         if synonymp:
-            infile_synonym_count += 1
+            counts['infile_synonym_count'] += 1
         else:
-            infile_taxon_count += 1
+            counts['infile_taxon_count'] += 1
 
         id_string = fields[col_taxonID].strip()
         if len(id_string) == 0 or not id_string.isdigit():
             # Header line has "taxonID" here
-            bad_id += 1
+            counts['bad_id'] += 1
             continue
         id = int(id_string)
 
         name = fields[col_canonicalName].strip()
         if name == '':
-            bad_id += 1
+            counts['bad_id'] += 1
             continue
 
         source = fields[col_nameAccordingTo].strip()
@@ -96,15 +128,13 @@ def process_gbif(inpath, outdir):
             ("International Plant Names Index" in source) or
             # Blah.  See http://www.gbif.org/dataset/d9a4eedb-e985-4456-ad46-3df8472e00e8
             (source == "d9a4eedb-e985-4456-ad46-3df8472e00e8")):
-            flushed_because_source += 1
+            counts['flushed_because_source'] += 1
             if synonymp:
                 continue
             else:
                 to_remove.append(id)
         elif synonymp:
-            synnames[id] = name
-            syntargets[id] = int(syn_target_id_string)
-            syntypes[id] = tstatus    # heterotypic synonym, etc.
+            synonyms.append((id, name, int(syn_target_id_string), tstatus))  # heterotypic synonym, etc.
             continue
         elif ("Paleobiology Database" in source) or (source == "c33ce2f2-c3cc-43a5-a380-fe4526d63650"):
             paleos.append(id)
@@ -121,26 +151,74 @@ def process_gbif(inpath, outdir):
 
         parent_id_string = fields[col_parentNameUsageID].strip()
         if len(parent_id_string) == 0 and rank != 'kingdom':
-            no_parent += 1
+            counts['no_parent'] += 1
             continue
 
         # Past all the filters, time to store
-        nm_storage[id] = name
-        nrank[id] = rank
-
         if len(parent_id_string) > 0:
-            parent_id = int(parent_id_string)
-            parent[id] = parent_id
-            if parent_id not in children:
-                children[parent_id] = [id]
-            else:
-                children[parent_id].append(id)
+            taxa.append((id, name, rank, int(parent_id_string)))
+        else:
+            taxa.append((id, name, rank, None))
 
-        count += 1
-        if count % 100000 == 0:
-            print count, len(synnames), no_parent
+    return (counts, taxa, synonyms, to_ignore, to_remove, paleos)
 
-    infile.close()
+def process_gbif(inpath, outdir, jobs=1):
+
+    to_ignore = []    #list of ids
+    to_ignore.append(incertae_sedis_kingdom)  #kingdom incertae sedis
+
+    outfile = open(os.path.join(outdir, "taxonomy.tsv"), "w")
+    outfilesy = open(os.path.join(outdir, "synonyms.tsv"), "w")
+
+    counts = Counter()
+    count = 0
+    parent ={}      #key is taxon id, value is the parent
+    nm_storage = {} #key is taxon id, value is the name
+    nrank = {}      #key is taxon id, value is rank
+    synnames = {}   #key is synonym id, value is name
+    syntargets = {} #key is synonym id, value is taxon id of target
+    syntypes = {}   #key is synonym id, value is synonym type
+    to_remove = []  #list of ids
+    paleos = []     #ids that come from paleodb
+
+    # Parse the byte ranges in parallel, then fold the results in file
+    # order; the dicts are filled in the same order as by a single
+    # pass, so the output comes out in the same order too.
+    chunks = chunk_bounds(inpath, jobs)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(read_chunk, chunks)
+    else:
+        pool = None
+        results = itertools.imap(read_chunk, chunks)
+
+    print "taxa synonyms no_parent"
+    for (chunk_counts, taxa, synonyms, chunk_ignore, chunk_remove, chunk_paleos) in results:
+        counts.update(chunk_counts)
+        for (id, name, target, tstatus) in synonyms:
+            synnames[id] = name
+            syntargets[id] = target
+            syntypes[id] = tstatus
+        for (id, name, rank, parent_id) in taxa:
+            nm_storage[id] = name
+            nrank[id] = rank
+            if parent_id != None:
+                parent[id] = parent_id
+            count += 1
+            if count % 100000 == 0:
+                print count, len(synnames), counts['no_parent']
+        to_ignore.extend(chunk_ignore)
+        to_remove.extend(chunk_remove)
+        paleos.extend(chunk_paleos)
+    if pool != None:
+        pool.close()
+        pool.join()
+
+    infile_taxon_count = counts['infile_taxon_count']
+    infile_synonym_count = counts['infile_synonym_count']
+    bad_id = counts['bad_id']
+    no_parent = counts['no_parent']
+    flushed_because_source = counts['flushed_because_source']
 
     print ('%s taxa, %s synonyms\n' % (infile_taxon_count, infile_synonym_count))
 
@@ -149,10 +227,12 @@ def process_gbif(inpath, outdir):
 
     # Parent/child homonyms now get fixed by smasher
 
+    forest = subtrees.Forest((id, parent.get(id)) for id in nm_storage)
+
     # Flush terminal taxa from IRMNG and IPNI (OTT picks up IRMNG separately)
     count = 0
     for id in to_remove:
-        if (not id in children): # and id in nrank and nrank[id] != "species":
+        if not forest.has_children(id): # and id in nrank and nrank[id] != "species":
             if id in nm_storage:
                 del nm_storage[id]
                 # should remove from children[parent[id]] too
@@ -174,19 +254,12 @@ def process_gbif(inpath, outdir):
     # Now delete the taxa-to-be-ignored and all of their descendants.
     if len(to_ignore) > 0:
         print 'pruning %s taxa' % len(to_ignore)
-        seen = {}
-        stack = to_ignore
-        while len(stack) != 0:
-            curid = stack.pop()
-            if curid in seen:
-                continue
-            seen[curid] = True
-            if curid in children:
-                for id in children[curid]:
-                    stack.append(id)
-        for id in seen:
+        ignored = forest.flags(to_ignore)
+        forest.flag_descendants(ignored)
+        for id in forest.flagged_ids(ignored):
             if id in nm_storage:
                 del nm_storage[id]
+    del forest
 
     """
     output the id parentid name rank
@@ -227,11 +300,12 @@ def process_gbif(inpath, outdir):
     paleofile.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print "** Arg count"
-        print "python process_ottol_taxonomy.py taxa.txt ignore.txt outfile"
+        print "python process_gbif_taxonomy.py taxon.txt outdir [jobs]"
         sys.exit(0)
     inpath = sys.argv[1]
     outdir = sys.argv[2]
-    process_gbif(inpath, outdir)
+    jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    process_gbif(inpath, outdir, jobs)
 
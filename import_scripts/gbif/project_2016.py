@@ -6,28 +6,49 @@
 import sys, re
 
 def project_2016_gbif(inpath, outpath):
-    i = 0
     with open(inpath, 'r') as infile:
         with open(outpath, 'w') as outfile:
-            for line in infile:
-                row = line.split('\t')
-                if len(row) < 11:
-                    print 'bad row %s: %s' % (i, line)
-                    continue
-                scientific = row[6].decode('utf-8')
-                canonical = canonical_name(scientific)
-                canenc = canonical.encode('utf-8')
-                outfile.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' %
-                              (row[1], # taxonID
-                               row[3], # parentNameUsageID
-                               row[4], # acceptedNameUsageID
-                               canenc, # canonicalName
-                               row[7], # taxonRank
-                               row[10], # taxonomicStatus
-                               row[2], # nameAccordingTo / datasetID
-                               ))
-                if i % 500000 == 0: print i, scientific.encode('utf-8'), '=>', canenc
-                i += 1
+            for fields in projected_rows(infile, verbose=True):
+                outfile.write('\t'.join(fields) + '\n')
+
+# Yields the columns of the 2016 projection for each usable line, in
+# the order process_gbif_taxonomy.py expects.  Lets the importer read
+# the GBIF dump directly instead of a projected copy of it.
+
+def projected_rows(lines, verbose=False):
+    i = 0
+    for line in lines:
+        row = line.split('\t')
+        if len(row) < 11:
+            print 'bad row %s: %s' % (i, line)
+            continue
+        canenc = canonical_name_utf8(row[6])
+        yield (row[1], # taxonID
+               row[3], # parentNameUsageID
+               row[4], # acceptedNameUsageID
+               canenc, # canonicalName
+               row[7], # taxonRank
+               row[10], # taxonomicStatus
+               row[2], # nameAccordingTo / datasetID
+               )
+        if verbose and i % 500000 == 0: print i, row[6], '=>', canenc
+        i += 1
+
+# Scientific names repeat a lot (the same binomial under different
+# authorities, synonyms, etc.), so remember the canonical name of each
+# UTF-8 scientific name seen, up to a limit.
+
+canonical_cache = {}
+canonical_cache_limit = 1000000
+
+def canonical_name_utf8(scientific):
+    canenc = canonical_cache.get(scientific)
+    if canenc == None:
+        canenc = canonical_name(scientific.decode('utf-8')).encode('utf-8')
+        if len(canonical_cache) >= canonical_cache_limit:
+            canonical_cache.clear()
+        canonical_cache[scientific] = canenc
+    return canenc
 
 
 # Cases to deal with:
@@ -94,7 +115,8 @@ def canonical_name(name):
 
 # print canonical_name(u'Bütschliella longicollus Georgevitch, 1941')  - works
 
-project_2016_gbif(sys.argv[1], sys.argv[2])
+if __name__ == '__main__':
+    project_2016_gbif(sys.argv[1], sys.argv[2])
 
 # QC check: 
 #  grep " [0-9][0-9][0-9][0-9]	" feed/gbif/work/projection_2016.tsv  >tmp.tmp
@@ -2,16 +2,26 @@
 # This script access the .seq files directly, instead of using eutils.
 
 # Command line arguments:
-#   Input: SILVA unprocessed taxonomy path (from .fasta file)
-#   Output: pickle file path
+#   Input: SILVA .fasta or .fasta.gz file
+#   Output: accession index path (see accession_index.py); it is
+#     rewritten after each flat file, and a rerun resumes from it
+#   --jobs: number of flat files to fetch and scan at once
 
 # Original by Peter Midford, 27 January 2015
 # Former location in this repository was feed/genbank/
 
 import argparse
-import time
+import subprocess
 import sys, os
-import pickle
+import multiprocessing
+import itertools
+import math
+import hashlib
+import struct
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fasta
+import accession_index
 
 # These maximum values need to be updated manually from the directory listing 
 # at ftp://ftp.ncbi.nlm.nih.gov/genbank/
@@ -31,164 +41,311 @@ RANGES = {"gbbct": 350, # bacteria, was 159
 }
 
 FTP_SERVER = 'ftp://ftp.ncbi.nlm.nih.gov/genbank/'
-SILVA_FILE = sys.argv[1]  # 'feed/silva/work/silva_no_sequences.fasta'
-DEFAULT_PICKLE_FILE = sys.argv[2]  #'Genbank.pickle'
 
 # Process one genbank flat file, extracting taxon ids and strain names.
+# Only the accession, and the /db_xref="taxon:..." and /strain
+# qualifiers of the source feature, matter.  Nearly all records are of
+# no interest, so the file is read in big blocks and each record's
+# ACCESSION line is found and tested by string search; a record that
+# fails the test is skipped straight to its closing // without being
+# split into lines.  The rest go through scan_records.
+
+BLOCK_SIZE = 1 << 20
 
-def process_file(flatfilespec, accessions, conflicts, interesting_ids):
-    time.sleep(1)    # try to forestall throttling
-    with open(flatfilespec) as flatfile:
-        locus_id = None
-        accession_id = None
-        found_features = False
-        found_source = False
-        taxon_id = None
-        strain_id = None
-        i = 0
-
-        def finish_accession():
-            if (accession_id and taxon_id):
-                if strain_id:
-                    accession_pair = (taxon_id, strain_id)
-                else:
-                    accession_pair = (taxon_id, None)
-                if accession_id in accessions:
-                    accession_value = accessions[accession_id]
-                    if not accession_pair == accession_value:
-                        new_conflict = (accession_id, 
-                                        accession_value, 
-                                        accession_pair)
-                        if new_conflict not in conflicts:
-                            conflicts.add(new_conflict)
-                            print("conflict at %s: s% and %s" % new_conflict)
-                else:
-                    i += 1
-                    if i % 20000 == 0: print accession_id, taxon_id
-                    if accession_id in interesting_ids:
-                        accessions[accession_id] = accession_pair
-
-        for line in flatfile:
-            line = line.lstrip()
-            first = first_token(line)
-            if first != None:
-                if first == 'LOCUS':
-                    finish_accession()
+# Where we are in a record
+SKIP = 0        # nothing more of interest before the next LOCUS
+HEADER = 1      # before FEATURES
+FEATURES = 2    # in the feature table, before the source feature
+SOURCE = 3      # in the source feature's qualifiers
+
+def scan_records(lines, interesting_ids):
+    """Generates (accession_id, (taxon_id, strain_id)) for the records
+    with interesting accessions, in file order"""
+    accession_id = None
+    taxon_id = None
+    strain_id = None
+    state = SKIP
+    for line in lines:
+        if line.startswith('LOCUS'):
+            if accession_id and taxon_id:
+                yield (accession_id, (taxon_id, strain_id or None))
+            accession_id = None
+            taxon_id = None
+            strain_id = None
+            state = HEADER
+        elif state == SKIP:
+            continue
+        elif state == HEADER:
+            if line.startswith('ACCESSION'):
+                tokens = line.split()
+                if len(tokens) > 1:
+                    accession_id = tokens[1]
+                if not accession_id in interesting_ids:
                     accession_id = None
-                    taxon_id = None
-                    strain_id = None
-                    found_features = False
-                    found_source = False
-                    tokens = tokenize(line)
-                    locus_id = tokens[1]
-                elif first == 'ACCESSION':
-                    tokens = tokenize(line)
-                    if len(tokens) > 1:
-                        accession_id = tokens[1]
-                elif (first == 'FEATURES') and accession_id:
-                    # print('found features')
-                    found_features = True
-                elif (first == 'source') and found_features:
-                    # print('found source')
-                    found_features = False
-                    found_source = True
-                elif first in ['gene', 'CDS', 'exon', 'intron']:
-                    found_source = False
-                elif found_source and (first.startswith('/db_xref')):
-                    feature = extract_feature(line, '/db_xref=')
-                    taxon_id = feature[len('taxon:'):]   
-                elif found_source and (first.startswith('/strain')):
-                    feature = extract_feature(line, '/strain=')
-                    strain_id = feature
-        finish_accession()
-        return (accessions, conflicts)
-
-def tokenize(line):
-    result = []
-    for item in line[:-1].split(' '):
-        if item != '':
-            result.append(item)
-    return result
-
-def first_token(line):
-    s = line.split(' ', 1)
-    if len(s) >= 1 and s[0] != '':
-        return s[0]
-    else:
-        return None
+                    state = SKIP
+            elif line.startswith('FEATURES'):
+                state = FEATURES if accession_id else SKIP
+        elif state == FEATURES:
+            if line.startswith('     source '):
+                state = SOURCE
+            elif not line.startswith(' '):
+                state = SKIP
+        elif line[5:6] != ' ':
+            # Next feature, or the end of the feature table
+            state = SKIP
+        else:
+            stripped = line.lstrip()
+            if stripped.startswith('/db_xref='):
+                feature = extract_feature(stripped, '/db_xref=')
+                if feature.startswith('taxon:'):
+                    taxon_id = feature[len('taxon:'):]
+            elif stripped.startswith('/strain='):
+                strain_id = extract_feature(stripped, '/strain=')
+    if accession_id and taxon_id:
+        yield (accession_id, (taxon_id, strain_id or None))
+
+def scan_blocks(stream, interesting_ids):
+    """Generates the text of each record in the stream whose accession
+    is in interesting_ids, in file order"""
+    # Starting with a newline means every record, the first one
+    # included, begins '\nLOCUS'
+    buffer = '\n'
+    start = 0
+    searched = 0    # no '\n//' at or after start begins before this
+    while True:
+        end = buffer.find('\n//', searched)
+        if end < 0:
+            # Read blocks until one holds a separator (the last two
+            # characters before it are searched too, in case the
+            # separator is split between them), searching only the new
+            # text, and join them once, so that a very large record
+            # still takes linear time
+            pieces = [buffer[start:]]
+            edge = pieces[0][-2:]
+            block = stream.read(BLOCK_SIZE)
+            while block:
+                pieces.append(block)
+                if (edge + block[:2]).find('\n//') >= 0 or block.find('\n//') >= 0:
+                    break
+                edge = (edge + block[-2:])[-2:]
+                block = stream.read(BLOCK_SIZE)
+            if len(pieces) > 1:
+                buffer = ''.join(pieces)
+                start = 0
+                searched = max(len(buffer) - len(pieces[-1]) - 2, 0)
+                continue
+            # A last record with no // line
+            end = len(buffer)
+        locus = buffer.find('\nLOCUS', start, end)
+        if locus >= 0:
+            at = buffer.find('\nACCESSION', locus, end)
+            if at >= 0:
+                line_end = buffer.find('\n', at + 1, end + 1)
+                if line_end < 0:
+                    line_end = end
+                tokens = buffer[at + 1:line_end].split()
+                if len(tokens) > 1 and tokens[1] in interesting_ids:
+                    yield buffer[locus + 1:end + 1]
+        if end == len(buffer):
+            break
+        start = end + 3
+        searched = start
+
+def scan_file(stream, interesting_ids):
+    """Returns a dict from each interesting accession in the file to its
+    distinct (taxon_id, strain_id) pairs, in the order they occur"""
+    found = {}
+    for record in scan_blocks(stream, interesting_ids):
+        lines = record.splitlines(True)
+        for (accession_id, accession_pair) in scan_records(lines, interesting_ids):
+            pairs = found.get(accession_id)
+            if pairs == None:
+                found[accession_id] = [accession_pair]
+            elif not accession_pair in pairs:
+                pairs.append(accession_pair)
+    return found
+
+def merge_found(found, accessions, conflicts, ids):
+    """Adds one file's accessions in.  The first pair seen for an
+    accession wins; any other pair is a conflict.  The scan only had
+    a Bloom filter to go on, so accessions not really in ids are
+    dropped here."""
+    for accession_id in sorted(found.keys()):
+        if not accession_id in ids:
+            continue
+        for accession_pair in found[accession_id]:
+            accession_value = accessions.get(accession_id)
+            if accession_value == None:
+                accessions[accession_id] = accession_pair
+            elif accession_pair != accession_value:
+                new_conflict = (accession_id,
+                                accession_value,
+                                accession_pair)
+                if new_conflict not in conflicts:
+                    conflicts.add(new_conflict)
+                    print("conflict at %s: %s and %s" % new_conflict)
 
 def extract_feature(line, tag):
     stripped = line.strip()
     detagged = stripped[len(tag):]
     return detagged.strip('"')
 
-# Read the .fasta file (or sequence-stripped .fasta file) to find 
-# out which genbank ids we care about.
+# Read the header lines of the .fasta file to find out which genbank
+# ids we care about.
 # Has about .5 million rows.
 def read_silva(filename):
     print 'reading', filename
     ids = {}
-    with open(filename, 'r') as infile:
-        for line in infile:
-            stuff = line.lstrip('>').split('.', 1)
-            id = stuff[0]
+    for header in fasta.headers(filename):
+        if ';' in header:
+            id = header.split('.', 1)[0]
             ids[id] = True
     print '  %s accessions' % (len(ids))
     if not 'A45315' in ids:
         print '** Lost A45315 from SILVA'
     return ids
 
+# The workers test accessions against a Bloom filter rather than the
+# SILVA ids themselves: under a megabyte for SILVA's half million
+# accessions, where the dict of ids runs to tens of megabytes in every
+# worker.  Around one accession in a hundred that isn't wanted gets
+# through; merge_found throws those out.
+#
+# It uses three hashes, fewer than the usual optimum, so a lookup (one
+# per record) stays cheap; the bit array is about 30% bigger to
+# make up for it.  The hashes are slices of an MD5 digest, so they're
+# the same in every process.
+
+hash_pair = struct.Struct('<II').unpack_from
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.01, hashes=3):
+        capacity = max(capacity, 1)
+        self.hashes = hashes
+        self.size = int(math.ceil(-hashes * capacity /
+                                  math.log(1 - error_rate ** (1.0 / hashes))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        (h1, h2) = hash_pair(hashlib.md5(key).digest())
+        for i in xrange(self.hashes):
+            position = (h1 + i * h2) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        (h1, h2) = hash_pair(hashlib.md5(key).digest())
+        bits = self.bits
+        for i in xrange(self.hashes):
+            position = (h1 + i * h2) % self.size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+def make_filter(ids):
+    bloom = BloomFilter(len(ids))
+    for id in ids:
+        bloom.add(id)
+    return bloom
+
 def driver():
     for dataset in RANGES.keys():
         for count in xrange(RANGES[dataset]):
             yield dataset+str(count+1)
 
+# The Bloom filter of SILVA accessions, set in each worker process
+interesting_ids = None
+
+def init_worker(ids):
+    global interesting_ids
+    interesting_ids = ids
+
+def fetch_and_scan(segment, server=FTP_SERVER):
+    """Streams one flat file from the server through gunzip into the
+    scanner; nothing is written to disk.  Raises IOError if the file
+    couldn't be read to the end, rather than returning what was found
+    in part of it"""
+    remote_file = segment + '.seq.gz'
+    print 'fetching', server + remote_file
+    curl = subprocess.Popen(['curl', '-s', '-S', server + remote_file],
+                            stdout=subprocess.PIPE)
+    gunzip = subprocess.Popen(['gunzip', '-c'], stdin=curl.stdout,
+                              stdout=subprocess.PIPE, bufsize=1 << 20)
+    curl.stdout.close()
+    found = scan_file(gunzip.stdout, interesting_ids)
+    gunzip.stdout.close()
+    if curl.wait() != 0 or gunzip.wait() != 0:
+        raise IOError('failed to read %s' % (server + remote_file))
+    return (segment, found)
+
+class Fetcher(object):
+    """fetch_and_scan for a particular server, in a form the pool can
+    hand to its workers"""
+    def __init__(self, server):
+        self.server = server
+    def __call__(self, segment):
+        return fetch_and_scan(segment, self.server)
+
+# The accessions found so far, as an index from accession id to
+# (taxon id, strain); the last file read and the conflicts go in its
+# metadata.
+
+def save_checkpoint(path, accessions, lastfile, conflicts):
+    accession_index.write(path, accessions,
+                          {'last': lastfile, 'conflicts': sorted(conflicts)})
+
+def load_checkpoint(path):
+    index = accession_index.AccessionIndex(path)
+    accessions = dict(index.iteritems())
+    lastfile = index.metadata['last']
+    conflicts = set([(accession_id, tuple(old), tuple(new))
+                     for (accession_id, old, new) in index.metadata['conflicts']])
+    index.close()
+    return (accessions, lastfile, conflicts)
+
 
 def main(args):
-    if os.path.exists(SILVA_FILE):
-        interesting_ids = read_silva(SILVA_FILE)
-    if os.path.exists(DEFAULT_PICKLE_FILE):
-        with open(DEFAULT_PICKLE_FILE,'r') as picklefile:
-            to_load = pickle.load(picklefile)
-    else:
-        to_load = None
-    d = driver()
-    if to_load:
-        accessions, lastfile, conflicts = to_load
+    if os.path.exists(args.silva):
+        ids = read_silva(args.silva)
+    segments = list(driver())
+    if os.path.exists(args.index):
+        accessions, lastfile, conflicts = load_checkpoint(args.index)
         print("accessions: {0:8d}; last: {1}".format(len(accessions),lastfile))
-        segment = d.next()
-        while lastfile[:-4] != segment:
-            print("lastfile: {0}, segment: {1}".format(lastfile[:-4], segment))
-            segment = d.next()
-        segment = d.next() # advance to next sequence file
+        # advance to next sequence file
+        segments = segments[segments.index(lastfile[:-4]) + 1:]
     else:
         accessions = {}
         conflicts = set()
-        segment = d.next()
-    while segment:
-        remote_file = segment + '.seq.gz'
-        local_file = segment + '.seq'
-        command = ("curl -# '" + 
-                   FTP_SERVER + 
-                   remote_file + 
-                   "' | gunzip > " + 
-                   local_file)
-        print command
-        os.system(command)
-        accessions, conflicts = process_file(local_file, accessions, conflicts, interesting_ids)
-        print "accession count = {0:8d}".format(len(accessions))
-        to_save = (accessions, local_file, conflicts)
-        temp = DEFAULT_PICKLE_FILE + '.new'
-        with open(temp, 'w') as picklefile:
-            pickle.dump(to_save, picklefile, -1)
-        os.rename(temp, DEFAULT_PICKLE_FILE)
-        os.remove(local_file)
-        segment = d.next()
+
+    # Files are scanned concurrently, but merged (and checkpointed) in
+    # the order of segments, so the result doesn't depend on which
+    # worker finishes first.  A file that fails to download stops the
+    # run there, with the checkpoint at the file before it, so that
+    # rerunning picks it up again.
+    bloom = make_filter(ids)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, init_worker, (bloom,))
+        results = pool.imap(Fetcher(args.server), segments)
+    else:
+        init_worker(bloom)
+        results = itertools.imap(Fetcher(args.server), segments)
+    for (segment, found) in results:
+        merge_found(found, accessions, conflicts, ids)
+        print "%s: accession count = %8d" % (segment, len(accessions))
+        save_checkpoint(args.index, accessions, segment + '.seq', conflicts)
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Text genbank flatfile parsing')
+    parser.add_argument('silva', help='SILVA .fasta or .fasta.gz file')
+    parser.add_argument('index', help='where to keep the accessions found')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='number of flat files to fetch and scan at once')
+    parser.add_argument('--server', default=FTP_SERVER,
+                        help='where to get the flat files')
 
     main(parser.parse_args())
-
@@ -1,37 +1,35 @@
-# Phase 2 of accession info harvesting: read pickle file, write TSV
+
+# Phase 2 of accession info harvesting: read accession index, write TSV
 
 # Original by Peter Midford, 27 January 2015
 
 import argparse
-import time
 import sys, os
-import pickle
 
-DEFAULT_PICKLE_FILE = sys.argv[1]   # 'Genbank.pickle'
-DEFAULT_ACCESSION_MAP = sys.argv[2]  # 'accessionid_to_taxonid.tsv'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import accession_index
+
 parser = argparse.ArgumentParser(description='Text genbank flatfile testing')
+parser.add_argument('index', help='accession index written by accessionFromGenbank.py')
+parser.add_argument('out', help='where to write accession id, taxon id, strain rows')
 
 
 
 def main(args):
-    with open(DEFAULT_PICKLE_FILE,'rb') as picklefile:
-        to_load = pickle.load(picklefile)
-    if to_load:
-        accessions, lastfile, conflicts = to_load
-        print("conflicts: {0:8d}".format(len(conflicts)))
-        print("accessions: {0:8d}; last: {1}".format(len(accessions),lastfile))
-        with open(DEFAULT_ACCESSION_MAP,'wt') as mapfile: 
-            for acc in accessions.keys():
-                tax_strain = accessions[acc]
-                if tax_strain[1]:
-                    mapfile.write("{0}\t{1}\t{2}\n".format(acc, 
-                                                           tax_strain[0], 
-                                                           tax_strain[1]))
-                else:
-                    mapfile.write("{0}\t{1}\t\n".format(acc, tax_strain[0]))
+    index = accession_index.AccessionIndex(args.index)
+    print("conflicts: {0:8d}".format(len(index.metadata['conflicts'])))
+    print("accessions: {0:8d}; last: {1}".format(len(index),index.metadata['last']))
+    with open(args.out,'wt') as mapfile:
+        for (acc, tax_strain) in index.iteritems():
+            if tax_strain[1]:
+                mapfile.write("{0}\t{1}\t{2}\n".format(acc,
+                                                       tax_strain[0],
+                                                       tax_strain[1]))
+            else:
+                mapfile.write("{0}\t{1}\t\n".format(acc, tax_strain[0]))
+    index.close()
 
 
 
 if __name__ == '__main__':
     main(parser.parse_args())
-
@@ -5,7 +5,7 @@
 #  - path to OTT properties.json file
 #  - path to output directory (will hold ott*.csv and by_qid.csv)
 
-import sys, os, csv, json, argparse
+import sys, os, csv, json, argparse, sqlite3, itertools
 
 def extend_idlist(previous_path, ott_path, ott_name, props_path, out_path):
     if ott_path.endswith('/'): ott_path = ott_path[0:-1]
@@ -17,23 +17,28 @@ def extend_idlist(previous_path, ott_path, ott_name, props_path, out_path):
 
     info = get_sources_table(ott_name, props_path)
 
-    # previous_regs is a directory of .csv files, one per OTT version
-    registrations = read_registrations(previous_regs, names)
-    (registrations_by_id, ids_for_qid) = index_registrations(registrations)
-
-    new_regs = do_one_taxonomy(ott_name, ott_path, info,
-                               registrations_by_id, ids_for_qid)
     regs_path = os.path.join(out_path, 'regs')
     # Assume regs directory exists (other files are in it already)
+    index = RegistrationIndex(os.path.join(regs_path, INDEX_NAME))
+    # previous_regs is a directory of .csv files, one per OTT version
+    index.catch_up(previous_regs, names)
+
+    new_regs = do_one_taxonomy(ott_name, ott_path, info, index)
     write_registrations(new_regs, os.path.join(regs_path, ott_name + '.csv'))
-    write_indexes(registrations_by_id,
-                  ids_for_qid,
-                  out_path)
+    write_indexes(index, out_path)
+    index.add_version(ott_name + '.csv', new_regs)
+    index.close()
 
-def do_one_taxonomy(ott_name, ott_path, info, registrations_by_id, ids_for_qid):
+def do_one_taxonomy(ott_name, ott_path, info, index):
 
     ott = read_taxonomy(ott_path)
 
+    # The most recent id registered for each qid we'll be asking about
+    wanted = set()
+    for (id, qids) in ott:
+        wanted.update(qids or [('ott', str(id))])
+    last_ids = index.last_ids_for_qids(wanted)
+
     new_regs = []
     merges = changes = dups = 0
     info_losers = 0
@@ -50,16 +55,15 @@ def do_one_taxonomy(ott_name, ott_path, info, registrations_by_id, ids_for_qid):
         # Existing id(s) for this qid
         prev_id = None
         for q in qids:
-            old_ids = ids_for_qid.get(q)
-            if old_ids != None:
-                prev_id = old_ids[-1]
+            prev_id = last_ids.get(q)
+            if prev_id != None:
                 break
         if prev_id == id:
             # Re-used!
             continue
 
         # Does this id already map?
-        regs = registrations_by_id.get(id)
+        regs = index.registrations_for_id(id)
 
         if regs == None:
             # Are we creating a new id for a qid that already has one?
@@ -184,23 +188,103 @@ def sorted_taxa(ott):
     ott.sort(key=lambda (id, qids): id)
     return ott
 
-def index_registrations(registrations):
-    registrations_by_id = {}
-    ids_for_qid = {}
-    for reg in registrations:
-        (id, qid, version, reg_type, name) = reg
-        regs = registrations_by_id.get(id)
-        if regs == None:
-            registrations_by_id[id] = [reg]
-        else:
-            regs.append(reg)
-        if qid[1] != None:
-            ids = ids_for_qid.get(qid)
-            if ids == None:
-                ids_for_qid[qid] = [id]
-            else:
-                ids.append(id)
-    return (registrations_by_id, ids_for_qid)
+# The registrations from all the regs/*.csv files, in a SQLite database
+# kept in the regs directory alongside them, so that adding a version
+# costs a lookup or two per taxon rather than a reading of every
+# version there has been:
+#   versions(name) - the .csv files whose registrations are in, e.g.
+#     'ott3.0.csv'
+#   regs(seq, id, prefix, sid, source, ottver, note) - one row per
+#     registration, in the order of the .csv files; the qid is
+#     prefix:sid
+# The indexes carry seq and the other half of the id/qid pair so that
+# the by_qid and by_id listings come straight out of them, in order.
+# Versions are only ever added.  If the database doesn't hold just the
+# first few of the .csv files, it's built again from them.
+
+INDEX_NAME = 'registrations.sqlite'
+
+class RegistrationIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS regs (seq INTEGER PRIMARY KEY, id INTEGER,
+                prefix TEXT, sid TEXT, source TEXT, ottver TEXT, note TEXT);
+            CREATE INDEX IF NOT EXISTS regs_by_id ON regs (id, seq, prefix, sid);
+            CREATE INDEX IF NOT EXISTS regs_by_qid ON regs (prefix, sid, seq, id);
+        ''')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def catch_up(self, regs_path, names):
+        """Adds the registrations from any of the .csv files in names
+        (in version order) that aren't in yet"""
+        loaded = set([name for (name,) in self.db.execute('SELECT name FROM versions')])
+        if loaded != set(names[0:len(loaded)]):
+            print 'Rebuilding registration index'
+            with self.db:
+                self.db.execute('DELETE FROM regs')
+                self.db.execute('DELETE FROM versions')
+            loaded = set()
+        for name in names[len(loaded):]:
+            self.add_version(name, read_registrations(regs_path, [name]))
+
+    def add_version(self, name, regs):
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO regs (id, prefix, sid, source, ottver, note) VALUES (?, ?, ?, ?, ?, ?)',
+                ((id, prefix, sid, source, ottver, note)
+                 for (id, (prefix, sid), source, ottver, note) in regs))
+            self.db.execute('INSERT INTO versions VALUES (?)', (name,))
+
+    def last_ids_for_qids(self, qids):
+        """Returns a dict from each of the qids that has been registered
+        to the id most recently registered for it.  The qids go in a
+        temporary table so that they're all looked up in one query."""
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (prefix TEXT, sid TEXT)')
+        with self.db:
+            self.db.execute('DELETE FROM wanted')
+            self.db.executemany('INSERT INTO wanted VALUES (?, ?)', qids)
+        last_ids = {}
+        for (prefix, sid, id) in self.db.execute('''
+                SELECT prefix, sid,
+                       (SELECT id FROM regs
+                        WHERE regs.prefix = wanted.prefix AND regs.sid = wanted.sid
+                        ORDER BY seq DESC LIMIT 1)
+                FROM wanted'''):
+            if id != None:
+                last_ids[(prefix, sid)] = id
+        return last_ids
+
+    def registrations_for_id(self, id):
+        """The registrations of id, oldest first, or None"""
+        regs = [(id, (prefix, sid), source, ottver, note)
+                for (prefix, sid, source, ottver, note)
+                in self.db.execute(
+                    'SELECT prefix, sid, source, ottver, note FROM regs WHERE id = ? ORDER BY seq',
+                    (id,))]
+        if len(regs) == 0:
+            return None
+        return regs
+
+    def ids_by_qid(self):
+        """Generates (qid, ids registered for it, oldest first), sorted
+        by qid"""
+        rows = self.db.execute(
+            'SELECT prefix, sid, id FROM regs WHERE sid IS NOT NULL ORDER BY prefix, sid, seq')
+        for (qid, group) in itertools.groupby(rows, lambda row: row[0:2]):
+            yield (qid, [row[2] for row in group])
+
+    def qids_by_id(self):
+        """Generates (id, qids registered for it, oldest first), sorted
+        by id"""
+        rows = self.db.execute('SELECT id, prefix, sid FROM regs ORDER BY id, seq')
+        for (id, group) in itertools.groupby(rows, lambda row: row[0]):
+            yield (id, [row[1:3] for row in group])
 
 # Return [..., 'ott2.3.csv', ...]
 
@@ -251,28 +335,36 @@ def canonicalize(qid):
     else:
         return qid
 
-def write_indexes(registrations_by_id, ids_for_qid, out_path):
+# by_qid.csv and by_id.csv list the registrations from before this
+# version.
+
+def write_indexes(index, out_path):
 
     qid_path = os.path.join(out_path, 'by_qid.csv')
 
-    print >>sys.stderr, 'Writing %s qid records to %s' % (len(ids_for_qid), qid_path)
+    print >>sys.stderr, 'Writing qid records to %s' % qid_path
 
     with open(qid_path, 'w') as outfile:
         writer = csv.writer(outfile)
-        for qid in sorted(ids_for_qid.keys()):
+        count = 0
+        for (qid, ids) in index.ids_by_qid():
             # ott ids can get out of order, e.g. gbif:6197514,3190274;3185577
-            writer.writerow([unparse_qid(qid), ';'.join([str(i) for i in ids_for_qid[qid]])])
+            writer.writerow([unparse_qid(qid), ';'.join([str(i) for i in ids])])
+            count += 1
+    print >>sys.stderr, 'Wrote %s qid records' % count
 
     id_path = os.path.join(out_path, 'by_id.csv')
 
-    print >>sys.stderr, 'Writing %s id records to %s' % (len(registrations_by_id), id_path)
+    print >>sys.stderr, 'Writing id records to %s' % id_path
 
     with open(id_path, 'w') as outfile:
         writer = csv.writer(outfile)
-        for id in registrations_by_id:
-            regs = registrations_by_id[id]
-            qid_strings = [unparse_qid(reg[1]) for reg in regs]
+        count = 0
+        for (id, qids) in index.qids_by_id():
+            qid_strings = [unparse_qid(qid) for qid in qids]
             writer.writerow([id, ';'.join(qid_strings)])
+            count += 1
+    print >>sys.stderr, 'Wrote %s id records' % count
 
 
 
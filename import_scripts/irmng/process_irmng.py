@@ -4,7 +4,11 @@
 #      tax/irmng/taxonomy.tsv
 #      tax/irmng/synonyms.tsv
 
-import csv, string, sys
+import csv, string, sys, os, tempfile, itertools, heapq
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import subtrees
 
 nomenclatural_statuses_to_keep = {}
 for status in [
@@ -99,20 +103,103 @@ profile_file_name = sys.argv[2]
 taxonomy_file_name = sys.argv[3]
 synonyms_file_name = sys.argv[4]
 
-taxa = {}
-synonyms = {}
+# IRMNG ids are integers; 0 stands for no id (no parent).
+
+def irmng_id(text):
+    if text == '':
+        return 0
+    return int(text)
+
+# Sets of strings (ranks, statuses) are stored as integer codes into a
+# table of the distinct strings.  Statuses are free text, so there's no
+# telling how many distinct ones there will be; the code arrays are
+# four bytes wide.
+
+class Codes:
+    def __init__(self):
+        self.names = []
+        self.code = {}
+
+    def intern(self, name):
+        code = self.code.get(name)
+        if code == None:
+            code = len(self.names)
+            self.names.append(name)
+            self.code[name] = code
+        return code
+
+# The taxa and synonyms are stored column-wise, one row per record, in
+# file order, with a dict from id to row number.
+
+QUALIFIES = 1     # status is acceptable on its own
+KEEP = 2          # qualifies, or is an ancestor of a taxon that does
+EXTINCT = 4
+
+class Taxa:
+    def __init__(self):
+        self.row = {}
+        self.id = array('l')
+        self.parentid = array('l')
+        self.name = []
+        self.rank = array('I')
+        self.flags = bytearray()
+
+    def add(self, id, parentid, name, rank, flags):
+        i = self.row.get(id)
+        if i != None:
+            # Repeated id: the last row wins
+            (self.parentid[i], self.name[i], self.rank[i], self.flags[i]) = (parentid, name, rank, flags)
+            return
+        self.row[id] = len(self.id)
+        self.id.append(id)
+        self.parentid.append(parentid)
+        self.name.append(name)
+        self.rank.append(rank)
+        self.flags.append(flags)
+
+    def __len__(self):
+        return len(self.row)
+
+    def in_id_order(self):
+        """Iterator over the row numbers, by increasing id.  The dump is
+        normally already in id order, in which case that's just the
+        rows in file order."""
+        ids = self.id
+        if all(ids[i] < ids[i+1] for i in xrange(len(ids) - 1)):
+            return iter(xrange(len(ids)))
+        return iter(array('l', sorted(xrange(len(ids)), key=ids.__getitem__)))
+
+class Synonyms:
+    def __init__(self):
+        self.row = {}
+        self.id = array('l')
+        self.parentid = array('l')    # the accepted taxon
+        self.name = []
+        self.status = array('I')      # status to write
+        self.live = bytearray()
+
+    def add(self, id, parentid, name, status):
+        k = self.row.get(id)
+        if k != None:
+            (self.parentid[k], self.name[k], self.status[k]) = (parentid, name, status)
+            return
+        self.row[id] = len(self.id)
+        self.id.append(id)
+        self.parentid.append(parentid)
+        self.name.append(name)
+        self.status.append(status)
+        self.live.append(1)
+
+    def __len__(self):
+        return len(self.row)
+
+ranks = Codes()
+statuses = Codes()
+taxa = Taxa()
+synonyms = Synonyms()
 roots = []
 
-class Taxon:
-    def __init__(self, id, parentid, name, rank, tstatus, nstatus):
-        self.id = id
-        self.parentid = parentid
-        self.name = name
-        self.rank = rank
-        self.tstatus = tstatus
-        self.nstatus = nstatus
-        self.keep = False
-        self.extinctp = False
+taxon_statuses_to_keep = ['accepted', 'valid', '']
 
 def read_irmng():
 
@@ -171,12 +258,25 @@ def read_irmng():
                 name = longname[0:len(longname)-len(auth)-1]
             else:
                 name = longname
-            taxon = Taxon(taxonid, parent, name, rank, tstatus, nstatus)
             if synonymp:
-                taxon.parentid = syn_target_id
-                synonyms[taxonid] = taxon
+                # Only the status that gets written is kept
+                status = nstatus
+                if status == '':
+                    status = tstatus
+                    if status == '': status = 'synonym'
+                synonyms.add(irmng_id(taxonid), irmng_id(syn_target_id), name,
+                             statuses.intern(status.lower()))
             else:
-                taxa[taxonid] = taxon
+                # The status filters are applied here; rejected taxa
+                # are kept only as possible ancestors
+                flags = 0
+                if (taxonid in grandfathered or
+                    (tstatus in taxon_statuses_to_keep and
+                     # reduces number of kept taxa from 1685133 to 1351145
+                     nstatus in nomenclatural_statuses_to_keep)):
+                    flags = QUALIFIES
+                taxa.add(irmng_id(taxonid), irmng_id(parent), name,
+                         ranks.intern(rank), flags)
             rows += 1
             if rows % 250000 == 0:
                 print >>sys.stderr, rows, taxonid, name
@@ -194,120 +294,151 @@ def fix_irmng():
 
     # "10704","Decapoda Latreille, 1802","Latreille, 1802",,,,"order",,,,,,,"Malacostraca","1190","cf. Decapoda (Mollusca)","01-01-2012","ICZN"
 
-    loser_synonyms = {}
-    for syn in synonyms.itervalues():
-        if syn.parentid in synonyms:
-            loser_synonyms[syn.id] = True
+    loser_synonyms = [k for k in xrange(len(synonyms.id))
+                      if synonyms.parentid[k] in synonyms.row]
     print >>sys.stderr, "Indirect synonyms:", len(loser_synonyms)
-    for syn_id in loser_synonyms:
-        del synonyms[syn_id]
+    for k in loser_synonyms:
+        synonyms.live[k] = 0
+        del synonyms.row[synonyms.id[k]]
 
     # Short-circuit taxon parents that are synonyms
 
     loser_parent_count = 0
-    for taxon in taxa.itervalues():
-        if taxon.parentid in synonyms:
-            taxon.parentid = synonyms[taxon.parentid].parentid
+    for i in xrange(len(taxa.id)):
+        k = synonyms.row.get(taxa.parentid[i])
+        if k != None:
+            taxa.parentid[i] = synonyms.parentid[k]
             loser_parent_count += 1
     print >>sys.stderr, "Indirect parents:", loser_parent_count
 
-    # Decide which taxa to keep
+    # Decide which taxa to keep: those with an acceptable status, and
+    # all of their ancestors
+
+    forest = subtrees.Forest((taxa.id[i], taxa.parentid[i] or None)
+                             for i in xrange(len(taxa.id)))
+    keep = forest.flags(taxa.id[i] for i in xrange(len(taxa.id))
+                        if taxa.flags[i] & QUALIFIES)
+    forest.flag_ancestors(keep)
 
     keep_count = 0
     missing_parent_count = 0
-    taxon_statuses_to_keep = ['accepted', 'valid', '']
-    for taxon in taxa.itervalues():
-        if taxon.keep:
-            True    # already seen
-        elif (taxon.id in grandfathered or
-              (taxon.tstatus in taxon_statuses_to_keep and
-                # reduces number of kept taxa from 1685133 to 1351145
-               taxon.nstatus in nomenclatural_statuses_to_keep)):
-            scan = taxon
-            while not scan.keep:
-                if scan.id in grandfathered: print >>sys.stderr, 'Grandfathering', taxon.name
-                scan.keep = True
-                keep_count += 1
-                if scan.parentid == '':
-                    break
-                parent = taxa.get(scan.parentid)
-                if parent == None:
-                    missing_parent_count += 1
-                    break
-                scan = parent
+    for i in xrange(len(taxa.id)):
+        if keep[forest.node[taxa.id[i]]]:
+            if str(taxa.id[i]) in grandfathered: print >>sys.stderr, 'Grandfathering', taxa.name[i]
+            taxa.flags[i] |= KEEP
+            keep_count += 1
+            if taxa.parentid[i] != 0 and taxa.parentid[i] not in taxa.row:
+                missing_parent_count += 1
+    del forest
 
     print >>sys.stderr, "Keeping %s taxa" % keep_count
     print >>sys.stderr, "%s missing parents" % missing_parent_count
 
-    # Read the file that has the extinct annotations
-
+    # Merge the extinct annotations into the taxa
+
+    rows = taxa.in_id_order()
+    i = next(rows, None)
+    for (id, seq, extinctp) in profile_rows():
+        while i != None and taxa.id[i] < id:
+            i = next(rows, None)
+        if i == None: break
+        if taxa.id[i] != id: continue
+        taxonid = str(id)
+        if taxonid in not_extinct:
+            if not extinctp:
+                print >>sys.stderr, 'Already not extinct: %s(%s)' % (taxonid, taxa.name[i])
+            else:
+                print >>sys.stderr, 'Fixing extinctness of %s(%s)' % (taxonid, taxa.name[i])
+                extinctp = False
+        if extinctp:
+            taxa.flags[i] |= EXTINCT
+        else:
+            taxa.flags[i] &= ~EXTINCT
+
+# The profile file (extinct annotations) is read as a stream of
+# (id, row number, extinctp) in id order, and merged with the taxa.
+# It's sorted in runs of runsize rows; if there is more than one run,
+# the runs go to temporary files and are merged from there.  Rows with
+# the same id stay in file order, so the last one wins as before.
+
+def profile_rows(runsize=1000000):
+    runfiles = []
     with open(profile_file_name, 'rb') as csvfile:
         csvreader = csv.reader(csvfile)
         header = csvreader.next()
         if header[1] != 'ISEXTINCT':
             print >>sys.stderr, "** Expected to find ISEXTINCT in header row but didn't:", header[1]
-        for row in csvreader:
-            taxonid = row[0]
-            taxon = taxa.get(taxonid)
-            if taxon == None: continue
-            taxon.extinctp = (row[1] == 'TRUE')
-            if taxonid in not_extinct:
-                if not taxon.extinctp:
-                    print >>sys.stderr, 'Already not extinct: %s(%s)' % (taxonid, taxon.name)
-                else:
-                    print >>sys.stderr, 'Fixing extinctness of %s(%s)' % (taxonid, taxon.name)
-                    taxon.extinctp = False
+        seq = 0
+        run = None
+        while True:
+            if run != None:
+                runfile = tempfile.TemporaryFile()
+                for record in run:
+                    runfile.write('%s\t%s\t%s\n' % record)
+                runfile.seek(0)
+                runfiles.append(runfile)
+            run = []
+            for row in itertools.islice(csvreader, runsize):
+                run.append((irmng_id(row[0]), seq, int(row[1] == 'TRUE')))
+                seq += 1
+            run.sort()
+            if len(run) < runsize:
+                break
+    if len(runfiles) == 0:
+        return iter(run)
+    print >>sys.stderr, 'Merging %s runs of profile rows' % (len(runfiles) + 1)
+    return heapq.merge(iter(run), *[itertools.imap(read_profile_record, runfile)
+                                    for runfile in runfiles])
+
+def read_profile_record(line):
+    (id, seq, extinctp) = line.split('\t')
+    return (int(id), int(seq), int(extinctp))
 
 def extinctness_report():
     # Report on nonextinct descended from extinct
 
     count = 0
-    for taxon in taxa.itervalues():
-        if taxon.keep and not taxon.extinctp:
-            parentid = taxon.parentid
-            parent = taxa.get(parentid)
-            if parent != None and parent.extinctp:
+    for i in xrange(len(taxa.id)):
+        if taxa.flags[i] & KEEP and not taxa.flags[i] & EXTINCT:
+            parentid = taxa.parentid[i]
+            p = taxa.row.get(parentid)
+            if p != None and taxa.flags[p] & EXTINCT:
                 count += 1
-                if taxon.rank != 'species':
+                if ranks.names[taxa.rank[i]] != 'species':
                     print >>sys.stderr, ("Extant taxon %s(%s) with extinct parent %s(%s)"%
-                                         (taxon.id, taxon.name, parentid, parent.name))
+                                         (taxa.id[i], taxa.name[i], parentid, taxa.name[p]))
 
     print >>sys.stderr, 'Extant taxa with extinct parent:', count
 
 # Write it out
 
-# Returns True if one or more children also got written
-
 def write_irmng():
 
-    def write_taxon(taxon, taxfile):
-        parentid = taxon.parentid
-        if parentid == '':
-            parentid = '0'
+    def write_taxon(i, taxfile):
         flags = ''
-        if taxon.extinctp:
+        if taxa.flags[i] & EXTINCT:
             flags = 'extinct'
-        taxfile.write('%s\t|\t%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n'%(taxon.id, parentid, taxon.name, taxon.rank, flags))
+        # No parent (0) is written as parent 0, i.e. 'life'
+        taxfile.write('%s\t|\t%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n'%(taxa.id[i], taxa.parentid[i], taxa.name[i],
+                                                              ranks.names[taxa.rank[i]], flags))
 
     with open(taxonomy_file_name, 'w') as taxfile:
         print 'Writing %s'%taxonomy_file_name
         taxfile.write('%s\t|\t%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n'%('uid', 'parent_uid', 'name', 'rank', 'flags'))
         taxfile.write('%s\t|\t%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n'%('0', '', 'life', 'no rank', ''))
-        for taxon in taxa.itervalues():
-            if taxon.keep:
-                write_taxon(taxon, taxfile)
+        for i in xrange(len(taxa.id)):
+            if taxa.flags[i] & KEEP:
+                write_taxon(i, taxfile)
 
     with open(synonyms_file_name, 'w') as synfile:
         print 'Writing %s'%synonyms_file_name
         synfile.write('uid\t|\tname\t|\ttype\t|\t\n')
-        for syn in synonyms.itervalues():
-            taxon = taxa.get(syn.parentid)
-            if taxon != None and taxon.keep and not taxon.extinctp:
-                status = syn.nstatus
-                if status == '':
-                    status = syn.tstatus
-                    if status == '': status = 'synonym'
-                synfile.write('%s\t|\t%s\t|\t%s\t|\t\n'%(syn.parentid, syn.name, status.lower()))
+        for k in xrange(len(synonyms.id)):
+            if not synonyms.live[k]: continue
+            i = taxa.row.get(synonyms.parentid[k])
+            if i != None and taxa.flags[i] & KEEP and not taxa.flags[i] & EXTINCT:
+                synfile.write('%s\t|\t%s\t|\t%s\t|\t\n'%(synonyms.parentid[k], synonyms.name[k],
+                                                        statuses.names[synonyms.status[k]]))
 
 read_irmng()
 fix_irmng()
@@ -4,9 +4,14 @@
 
 # Arguments:
 #   download - T or F - whether or not to download the tar.gz file from NCBI
-#   downloaddir - where to find (or put) the tar.gz and its contents
+#   downloaddir - where to find (or put) the tar.gz and its contents;
+#     if this names a .tar.gz or .tgz file instead of a directory, the
+#     .dmp members are read straight out of the archive
 #   kill list file
 #   destination dir - where taxonomy.tsv etc. are to be put
+#   url - where the taxdump came from, for about.json
+#   previous dir (optional) - taxonomy.tsv from an earlier run; if given,
+#     the changes since then are listed in delta.tsv in the destination dir
 
 # JAR copied this file from data/ in the taxomachine repository
 # to smasher/ in the opentree repository on 2013-04-25.
@@ -17,6 +22,8 @@
 
 import sys,os,time
 import os.path
+import tarfile
+from array import array
 from collections import Counter
 
 """
@@ -44,103 +51,169 @@ connecting these to there parents
 -incertae sedis
 """
 
-if __name__ == "__main__":
-    if len(sys.argv) != 6:
-        print "Usage: python process_ncbi_taxonomy_taxdump.py {T|F} tmpdir skipids.file outdir url"
-        sys.exit(1)
-    download = sys.argv[1]
-    downloaddir = sys.argv[2]   # e.g. feed/ncbi/tmp
-    nodesfilename = downloaddir + "/nodes.dmp"
-    namesfilename = downloaddir + "/names.dmp"
-    skipfile = sys.argv[3]
-    taxdir = sys.argv[4]
-    url = sys.argv[5]
-
-    aboutfilename = taxdir+"/about.json"
-    with open(aboutfilename, "w") as aboutfile:
-        aboutfile.write('{ "prefix": "ncbi",\n')
-        aboutfile.write('  "prefixDefinition": "http://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=",\n')
-        aboutfile.write('  "description": "NCBI Taxonomy",\n')
-        # Get file date from nodes.dmp in downloaddir
-        # os.path.getmtime(file)   => number of seconds since epoch
-        ncbitime = os.path.getmtime(nodesfilename)
-        tuple_time = time.gmtime(ncbitime)
-        iso_time = time.strftime("%Y-%m-%dT%H:%M:%S", tuple_time)
-        aboutfile.write('  "source": {"URL": "%s", "date": "%s"},\n'%(url, iso_time))
-        aboutfile.write('}\n')
-
-    outfile = open(taxdir+"/taxonomy.tsv","w")
-    outfilesy = open(taxdir+"/synonyms.tsv","w")
-    if download.upper() == "T":
-        print("downloading taxonomy")
-        os.system("wget --output-document=" +
-                  downloaddir + "/taxdump.tar.gz " + url)
-        os.system("tar -C " +
-                  downloaddir +
-                  " -xzvf taxdump.tar.gz")
-
-    if os.path.isfile(nodesfilename) == False:
-        print nodesfilename + " is not present"
-        sys.exit(0)
-    if os.path.isfile(namesfilename) == False:
-        print namesfilename + " is not present"
-        sys.exit(0)
-
-    count = 0
-    parent_ids = {} #key is the child id and the value is the parent
-    cid = {} #key is the parent and value is the list of children
-    nrank = {} #key is the node id and the value is the rank
-    with open(nodesfilename,"r") as nodesf:
-        for line in nodesf:
+class TaxDump(object):
+    """The .dmp files of an NCBI taxdump, either extracted into a
+    directory or still inside the taxdump.tar.gz archive.  Archive
+    members are decompressed a block at a time as they are read, so
+    nothing is written to disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = None
+        if os.path.isfile(path) and tarfile.is_tarfile(path):
+            self.tar = tarfile.open(path, "r:gz")
+            self.members = dict((info.name, info) for info in self.tar.getmembers())
+
+    def exists(self, member):
+        if self.tar != None:
+            return member in self.members
+        return os.path.isfile(os.path.join(self.path, member))
+
+    def mtime(self, member):
+        if self.tar != None:
+            return self.members[member].mtime
+        return os.path.getmtime(os.path.join(self.path, member))
+
+    def lines(self, member, blocksize=1 << 20):
+        if self.tar == None:
+            with open(os.path.join(self.path, member), "r") as f:
+                for line in f:
+                    yield line
+            return
+        f = self.tar.extractfile(self.members[member])
+        pending = ""
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            rows = (pending + block).split("\n")
+            pending = rows.pop()
+            for row in rows:
+                yield row + "\n"
+        if pending:
+            yield pending
+        f.close()
+
+def iso_mtime(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+
+class NcbiTree(object):
+    """The nodes.dmp tree held in flat arrays.  Nodes are numbered
+    0..n-1 in nodes.dmp order; taxid[i] is the NCBI id of node i and
+    index[taxid] maps back (-1 where there is no such node).  parent[i]
+    is a node number (-1 if unknown), children are stored CSR style -
+    the children of i are child_list[child_start[i]:child_start[i+1]],
+    in nodes.dmp order - and ranks are small codes into rank_names."""
+
+    __slots__ = ["taxid", "index", "parent", "rank", "rank_names",
+                 "child_start", "child_list", "preorder"]
+
+    def __init__(self, dump):
+        self.taxid = array("i")
+        parent_taxid = array("i")
+        self.rank = array("H")
+        self.rank_names = []
+        rank_codes = {}
+        count = 0
+        for line in dump.lines("nodes.dmp"):
             spls = line.split("\t|\t")
-            node_id = spls[0].strip()
-            parentid = spls[1].strip()
             rank = spls[2].strip()
-            parent_ids[node_id] = parentid
-            nrank[node_id] = rank
-            if parentid not in cid: 
-                cid[parentid] = []
-            cid[parentid].append(node_id)
+            code = rank_codes.get(rank)
+            if code == None:
+                code = rank_codes[rank] = len(self.rank_names)
+                self.rank_names.append(intern(rank))
+            self.taxid.append(int(spls[0]))
+            parent_taxid.append(int(spls[1]))
+            self.rank.append(code)
             count += 1
             if count % 100000 == 0:
                 print count
-
-    # Removed "unclassified" 2013-04-25
-    skip = []
-    # skip = ["viral","other","viroids","viruses","artificial","x","environmental","unknown","unidentified","endophyte","endophytic","uncultured","scgc","libraries","virus","mycorrhizal samples"]
-    skipids = {}
-    #run through the skip ids file
-    if os.path.isfile(skipfile):
-        with open(skipfile,"r") as skipidf:
-            for line in skipidf:
-                skipids[line.strip()] = True
-    
-    count = 0
-    idstoexclude = []
-    nm_storage = {}
-    lines = {}
-    synonyms = {}
-    namesd = []
-    allnames = []
-    with open(namesfilename,"r") as namesf:
-        for line in namesf:
+        n = len(self.taxid)
+
+        self.index = array("i", [-1]) * (max(self.taxid) + 1 if n > 0 else 0)
+        for i in xrange(n):
+            self.index[self.taxid[i]] = i
+        self.parent = array("i", [-1]) * n
+        for i in xrange(n):
+            self.parent[i] = self.node(parent_taxid[i])
+        del parent_taxid
+
+        # Counting sort of the nodes by parent gives the child lists
+        self.child_start = array("i", [0]) * (n + 1)
+        for i in xrange(n):
+            p = self.parent[i]
+            if p >= 0 and p != i:
+                self.child_start[p + 1] += 1
+        for i in xrange(n):
+            self.child_start[i + 1] += self.child_start[i]
+        fill = array("i", self.child_start)
+        self.child_list = array("i", [0]) * self.child_start[n]
+        for i in xrange(n):
+            p = self.parent[i]
+            if p >= 0 and p != i:
+                self.child_list[fill[p]] = i
+                fill[p] += 1
+        del fill
+
+        # Parents come before children in preorder
+        self.preorder = array("i")
+        stack = [i for i in xrange(n - 1, -1, -1)
+                 if self.parent[i] < 0 or self.parent[i] == i]
+        while stack:
+            i = stack.pop()
+            self.preorder.append(i)
+            stack.extend(reversed(self.children(i)))
+
+    def __len__(self):
+        return len(self.taxid)
+
+    def node(self, taxid):
+        if 0 <= taxid < len(self.index):
+            return self.index[taxid]
+        return -1
+
+    def children(self, i):
+        return self.child_list[self.child_start[i]:self.child_start[i + 1]]
+
+class NcbiNames(object):
+    """What we keep of names.dmp: the scientific name of each node
+    (None if it has none), the synonyms as parallel columns, and the
+    nodes on the kill list."""
+
+    __slots__ = ["sciname", "syn_node", "syn_name", "syn_type",
+                 "toexclude"]
+
+    def __init__(self, dump, tree, skipids):
+        # Removed "unclassified" 2013-04-25
+        skip = set()
+        # skip = set(["viral","other","viroids","viruses","artificial","x","environmental","unknown","unidentified","endophyte","endophytic","uncultured","scgc","libraries","virus","mycorrhizal samples"])
+
+        self.sciname = [None] * len(tree)
+        self.syn_node = array("i")
+        self.syn_name = []
+        self.syn_type = []
+        self.toexclude = []
+        count = 0
+        for line in dump.lines("names.dmp"):
             line = line.strip()
             spls = line.split("\t|") #if you do \t|\t then you don't get the name class right because it is "\t|"
             node_id = spls[0].strip()
-            par = parent_ids[node_id]
+            i = tree.node(int(node_id))
+            if i < 0:
+                raise KeyError(node_id)
             # was name = spls[1].strip().replace("[","").replace("]","")
-            name = spls[1].strip()
+            name = intern(spls[1].strip())
             homonc = spls[2].strip() #can get if it is a series here
             nm_c = spls[3].strip()   # scientific name, synonym, etc.
             nm_keep = True
-            name_parts = name.split(" ")
-            for j in name_parts:
-                if j.lower() in skip:
-                    nm_keep = False
+            if skip:
+                for j in name.split(" "):
+                    if j.lower() in skip:
+                        nm_keep = False
             if node_id in skipids:
                 nm_keep = False
             if nm_keep == False:
-                idstoexclude.append(node_id)
+                self.toexclude.append(i)
                 continue
             if "<series>" in homonc:
                 name = name + " series"
@@ -159,177 +232,268 @@ if __name__ == "__main__":
                 # in-part (e.g. Bacteria in-part: Monera)
                 # includes (what polarity?)
                 if nm_c != "in-part":
-                    if node_id not in synonyms:
-                        synonyms[node_id] = []
-                    synonyms[node_id].append(line)
+                    # the synonyms table has always been written from
+                    # this split, which leaves "\t|" on the type
+                    sspls = line.split("\t|\t")
+                    self.syn_node.append(i)
+                    self.syn_name.append(intern(sspls[1].strip()))
+                    self.syn_type.append(intern(sspls[3].strip()))
             else:
-                lines[node_id] = line
-                nm_storage[node_id] = name
-                allnames.append(name)
+                self.sciname[i] = name
             count += 1
             if count % 100000 == 0:
                 print count
-    print "number of lines in names file: ",count
-
-    #get the nameids that are double
-    c = Counter(allnames)
-    namesd = []
-    for i in c:
-        if c[i] > 1:
-            namesd.append(i)
-    ndoubles = []
-    with open(namesfilename, "r") as namesf:
-        for line in namesf:
-            spls = line.strip().split("\t|") #IF YOU DO \T|\T THEN YOU DON'T GET THE NAME CLASS RIGHT BECAUSE IT IS "\T|"
-            node_id = spls[0].strip()
-            name = spls[1].strip()
-            if name in namesd:
-                ndoubles.append(node_id)
+        print "number of lines in names file: ",count
+
+def exclude_subtrees(tree, roots):
+    """Flag every node at or below one of the given nodes, in one sweep
+    down the preorder."""
+    excluded = bytearray(len(tree))
+    for i in roots:
+        excluded[i] = 1
+    for i in tree.preorder:
+        p = tree.parent[i]
+        if p >= 0 and excluded[p]:
+            excluded[i] = 1
+    return excluded
+
+def sink_same_names(tree, names, excluded, final_names):
+    """If parent and child have the same name higher than genus, the
+    child is sunk: its children and synonyms go to the parent.  Under
+    a genus, the child is called genusname rank childname instead.
+    Works top down so that a chain of same-named nodes all sink into
+    the topmost.  tree.parent is updated in place; returns the flags of
+    the sunk nodes."""
+    sciname = names.sciname
+    sunk = bytearray(len(tree))
+    for i in tree.preorder:
+        name = sciname[i]
+        if name == None or excluded[i] or name == "root":
+            continue
+        p = tree.parent[i]
+        if p < 0 or name != sciname[p]:
+            continue
+        if tree.rank_names[tree.rank[p]] == "genus":
+            final_names[i] = sciname[p]+" "+tree.rank_names[tree.rank[i]]+" "+name
+        else:
+            for j in tree.children(i):
+                tree.parent[j] = p
+            sunk[i] = 1
+    return sunk
+
+def find_lineage_homonyms(tree, names, alive, final_names):
+    """Names that are the same in lineage but not parent child.  One
+    walk down the tree keeps, for each name, the nearest ancestor
+    carrying it.  Returns a dict mapping each node that repeats the name
+    of an ancestor other than its parent to that ancestor.
+
+    The per-node search that this replaces returned as soon as it met
+    its starting node, so these names have never been rewritten; they
+    are counted but left alone, keeping the names that get aligned
+    against stable."""
+    sciname = names.sciname
+    nearest = {}
+    homonyms = {}
+    stack = [i for i in reversed(tree.preorder)
+             if tree.parent[i] < 0 or tree.parent[i] == i]
+    while stack:
+        i = stack.pop()
+        if isinstance(i, tuple):
+            # leaving a subtree: put back the outer carrier of the name
+            (name, outer) = i
+            if outer == None:
+                del nearest[name]
+            else:
+                nearest[name] = outer
+            continue
+        if alive[i] and i not in final_names:
+            name = sciname[i]
+            outer = nearest.get(name)
+            if outer != None and outer != tree.parent[i]:
+                homonyms[i] = outer
+            nearest[name] = i
+            stack.append((name, outer))
+        stack.extend(reversed(tree.children(i)))
+    return homonyms
+
+def taxonomy_row(tree, names, final_names, i):
+    """uid, parent uid, name and rank of node i as written to taxonomy.tsv"""
+    sciname = names.sciname
+    nametowrite = final_names.get(i, sciname[i])
+    p = tree.parent[i]
+    prid = str(tree.taxid[p]) if p >= 0 else ""
+    # if it is the root node then we need to make its parent id blank and rename it "life"
+    if nametowrite == "root":
+        nametowrite = "life"
+        prid = ""
+    elif nametowrite == 'environmental samples':
+        nametowrite = sciname[p] + ' ' + nametowrite
+    return (str(tree.taxid[i]), prid, nametowrite, tree.rank_names[tree.rank[i]])
+
+def write_taxonomy(tree, names, alive, final_names, filename):
+    with open(filename, "w") as outfile:
+        outfile.write("uid\t|\tparent_uid\t|\tname\t|\trank\t|\t\n")
+        for i in xrange(len(tree)):
+            if alive[i]:
+                outfile.write("%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n" %
+                              taxonomy_row(tree, names, final_names, i))
+
+def write_synonyms(tree, names, alive, sunk, filename):
+    """A sunk node's synonyms are listed with the node it was sunk
+    into, still under their own uid."""
+    def owner(k):
+        i = names.syn_node[k]
+        while sunk[i]:
+            i = tree.parent[i]
+        return i
+    owners = array("i", (owner(k) for k in xrange(len(names.syn_node))))
+    with open(filename, "w") as outfilesy:
+        outfilesy.write("uid\t|\tname\t|\ttype\t|\t\n")
+        for k in sorted(xrange(len(owners)), key=owners.__getitem__):
+            if alive[owners[k]]:
+                outfilesy.write("%s\t|\t%s\t|\t%s\t|\t\n" %
+                                (tree.taxid[names.syn_node[k]], names.syn_name[k], names.syn_type[k]))
+
+def write_forwards(dump, filename):
+    merge_count = 0
+    with open(filename, 'w') as forwardsfile:
+        for line in dump.lines("merged.dmp"):
+            row = line.split('|')
+            from_id = row[0].strip()
+            to_id = row[1].strip()
+            forwardsfile.write("%s\t%s\n" % (from_id, to_id))
+            merge_count += 1
+    print 'number of merges:', merge_count
+
+def write_delta(dump, tree, names, alive, final_names, prevdir, filename):
+    """Compare the new taxonomy against a previous taxonomy.tsv and list
+    the differences, one per line: uid, kind of change, old value, new
+    value.  The kinds are added, moved (parent changed), renamed,
+    rerank, and for uids that are gone, merged (new value is the id
+    merged into, from merged.dmp), deleted (listed in delnodes.dmp) or
+    removed (dropped by this script).  The previous file is streamed,
+    not loaded."""
+    merged = {}
+    if dump.exists("merged.dmp"):
+        for line in dump.lines("merged.dmp"):
+            row = line.split('|')
+            merged[row[0].strip()] = row[1].strip()
+    deleted = set()
+    if dump.exists("delnodes.dmp"):
+        for line in dump.lines("delnodes.dmp"):
+            deleted.add(line.split('|')[0].strip())
+
+    counts = Counter()
+    seen = bytearray(len(tree))
+    with open(filename, "w") as deltafile:
+        def change(uid, kind, old, new):
+            deltafile.write("%s\t%s\t%s\t%s\n" % (uid, kind, old, new))
+            counts[kind] += 1
+        deltafile.write("uid\tchange\told\tnew\n")
+        with open(os.path.join(prevdir, "taxonomy.tsv"), "r") as prevfile:
+            prevfile.readline()
+            for line in prevfile:
+                (uid, prid, name, rank) = line.split("\t|\t")[:4]
+                i = tree.node(int(uid))
+                if i < 0 or not alive[i]:
+                    if uid in merged:
+                        change(uid, "merged", "", merged[uid])
+                    elif uid in deleted:
+                        change(uid, "deleted", "", "")
+                    else:
+                        change(uid, "removed", "", "")
+                    continue
+                seen[i] = 1
+                (_, new_prid, new_name, new_rank) = taxonomy_row(tree, names, final_names, i)
+                if prid != new_prid:
+                    change(uid, "moved", prid, new_prid)
+                if name != new_name:
+                    change(uid, "renamed", name, new_name)
+                if rank != new_rank:
+                    change(uid, "rerank", rank, new_rank)
+        for i in xrange(len(tree)):
+            if alive[i] and not seen[i]:
+                (uid, prid, name, rank) = taxonomy_row(tree, names, final_names, i)
+                change(uid, "added", "", name)
+    for kind in sorted(counts):
+        print 'number %s:' % kind, counts[kind]
 
-    #now making sure that the taxonomy is functional before printing to the file
+if __name__ == "__main__":
+    if len(sys.argv) not in (6, 7):
+        print "Usage: python process_ncbi_taxonomy_taxdump.py {T|F} {tmpdir|taxdump.tar.gz} skipids.file outdir url [prevdir]"
+        sys.exit(1)
+    download = sys.argv[1]
+    downloaddir = sys.argv[2]   # e.g. feed/ncbi/tmp, or feed/ncbi/tmp/taxdump.tar.gz
+    skipfile = sys.argv[3]
+    taxdir = sys.argv[4]
+    url = sys.argv[5]
+    prevdir = sys.argv[6] if len(sys.argv) > 6 else None
+    archived = downloaddir.endswith(".tar.gz") or downloaddir.endswith(".tgz")
+
+    if download.upper() == "T":
+        print("downloading taxonomy")
+        if archived:
+            os.system("wget --output-document=" + downloaddir + " " + url)
+        else:
+            os.system("wget --output-document=" +
+                      downloaddir + "/taxdump.tar.gz " + url)
+            os.system("tar -C " +
+                      downloaddir +
+                      " -xzvf " + downloaddir + "/taxdump.tar.gz")
+
+    if archived and not os.path.isfile(downloaddir):
+        print downloaddir + " is not present"
+        sys.exit(0)
+    dump = TaxDump(downloaddir)
+    for member in ["nodes.dmp", "names.dmp"]:
+        if not dump.exists(member):
+            print os.path.join(downloaddir, member) + " is not present"
+            sys.exit(0)
+
+    aboutfilename = taxdir+"/about.json"
+    with open(aboutfilename, "w") as aboutfile:
+        aboutfile.write('{ "prefix": "ncbi",\n')
+        aboutfile.write('  "prefixDefinition": "http://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=",\n')
+        aboutfile.write('  "description": "NCBI Taxonomy",\n')
+        # Get file date from nodes.dmp in downloaddir (or in the archive)
+        iso_time = iso_mtime(dump.mtime("nodes.dmp"))
+        members = ", ".join('"%s": "%s"' % (member, iso_mtime(dump.mtime(member)))
+                            for member in ["nodes.dmp", "names.dmp", "merged.dmp"]
+                            if dump.exists(member))
+        aboutfile.write('  "source": {"URL": "%s", "date": "%s",\n' % (url, iso_time))
+        aboutfile.write('             "members": {%s}},\n' % members)
+        aboutfile.write('}\n')
 
     skipids = {}
-    stack = idstoexclude
+    #run through the skip ids file
+    if os.path.isfile(skipfile):
+        with open(skipfile,"r") as skipidf:
+            for line in skipidf:
+                skipids[line.strip()] = True
 
+    tree = NcbiTree(dump)
+    names = NcbiNames(dump, tree, skipids)
 
+    #now making sure that the taxonomy is functional before printing to the file
     print "checking functionality of taxonomy"
-    print "count lefttocompare"
+    excluded = exclude_subtrees(tree, names.toexclude)
 
-    count = 0
-    while len(stack) != 0:
-        curid = stack.pop()
-        if curid in skipids:
-            continue
-        skipids[curid] = True
-        if curid in cid:
-            ids = cid[curid]
-            for i in ids:
-                stack.append(i)
-        count += 1
-        if count % 10000 == 0:
-            print count,len(stack)
-
-    for i in skipids:
-        if i in lines:
-            del lines[i]
-        if i in synonyms:
-            del synonyms[i]
-        if i in nm_storage:
-            del nm_storage[i]
-    
-    print "number of scientific names: ",len(lines)
-    print "number of synonyms: ",len(synonyms)
-
-    """
-    in this section we change the names of the parent child identical names for
-    1) if parent and child have the same name higher than genus, they are sunk
-    2) if the parent and child have the same name at genus and subspecies (etc), the subname
-    is called genusname rank subgenus name
-    """
-
-    final_nm_storage = {}
-
-    for i in nm_storage:
-        if nm_storage[i] != "root":
-            if i in parent_ids:
-                if nm_storage[i] == nm_storage[parent_ids[i]]:
-                #do something for the genus 
-                    if nrank[parent_ids[i]] == "genus":
-                        final_nm_storage[i] = nm_storage[parent_ids[i]]+" "+nrank[i]+" "+nm_storage[i]
-                    else:
-                        idstoch = cid[i]
-                        for j in idstoch:
-                            parent_ids[j] = parent_ids[i]
-                        if i in synonyms:
-                            for j in synonyms[i]:
-                                if parent_ids[i] in synonyms:
-                                    synonyms[parent_ids[i]].append(j)
-                                else:
-                                    synonyms[parent_ids[i]] = [j]
-                            del synonyms[i]
-                        del lines[i]
-                #do something for everything else
+    final_names = {}
+    sunk = sink_same_names(tree, names, excluded, final_names)
+
+    alive = bytearray(len(tree))
+    for i in xrange(len(tree)):
+        if names.sciname[i] != None and not excluded[i] and not sunk[i]:
+            alive[i] = 1
+    print "number of scientific names: ",sum(alive)
 
     #checking for names that are the same in lineage but not parent child
-    for i in ndoubles:
-        if i not in nm_storage:
-            continue
-        stack = []
-        if i in final_nm_storage:
-            continue
-        stack.append(i)
-        while len(stack) > 0:
-            cur = stack.pop()
-            if cur in nm_storage:
-                if cur in final_nm_storage:
-                    continue
-                if nm_storage[cur] == nm_storage[i]:
-                    tname = ""
-                    tcur = cur
-                    if tcur == i:
-                        continue
-                    while tcur != i:
-                        tname += nm_storage[tcur] +" "+nrank[tcur]+" "
-                        if tcur in parent_ids:
-                            tcur = parent_ids[tcur]
-                        else:
-                            break
-                    final_nm_storage[cur] = nm_storage[i]+" "+nrank[i]+" "+tname
-            if cur in cid:
-                for j in cid[cur]:
-                    stack.append(j)
-    outfile.write("uid\t|\tparent_uid\t|\tname\t|\trank\t|\t\n")
-
-    #need to print id, parent id, and name   
-    for i in lines:
-        spls = lines[i].split("\t|\t")
-        node_id = spls[0].strip()
-        prid = parent_ids[spls[0]].strip()
-        sname = spls[1].strip()
-
-        #changed from sname to nm_storage to fix the dup name issue
-        if i in final_nm_storage:
-            nametowrite = final_nm_storage[i]
-        else:
-            nametowrite = nm_storage[i]
-
-        # if it is the root node then we need to make its parent id blank and rename it "life"
-        if nametowrite == "root":
-            nametowrite = "life"
-            prid = ""
-        elif nametowrite == 'environmental samples':
-            nametowrite = nm_storage[parent_ids[i]] + ' ' + nametowrite
-            if False:
-                if nametowrite not in synonyms:
-                    synonyms[i] = []
-                # kludge, would be better to change synonyms table representation
-                synonyms[i].append('%s\t|\t%s\t|\t%s\t|\t%s\t|\t\n' % (i, 'environmental samples', '', 'synonym'))
-        rankwrite = nrank[node_id]
-        outfile.write(node_id+"\t|\t"+prid+"\t|\t"+nametowrite+"\t|\t"+rankwrite+"\t|\t\n")
-
-    outfile.close()
-
-    outfilesy.write("uid\t|\tname\t|\ttype\t|\t\n")
-
-    for i in synonyms:
-        if i in lines:
-            for j in synonyms[i]:
-                spls = j.split("\t|\t")
-                node_id = spls[0].strip()
-                sname = spls[1].strip()
-                nametp = spls[3].strip()
-                outfilesy.write(node_id+"\t|\t"+sname+"\t|\t"+nametp+"\t|\t\n")
-    outfilesy.close()
-
-    mergedfilename = downloaddir + "/merged.dmp"
-    if os.path.isfile(mergedfilename):
-        merge_count = 0
-        with open(mergedfilename, 'r') as mergedfile:
-            with open(taxdir + '/forwards.tsv', 'w') as forwardsfile:
-                for line in mergedfile:
-                    row = line.split('|')
-                    from_id = row[0].strip()
-                    to_id = row[1].strip()
-                    forwardsfile.write("%s\t%s\n" % (from_id, to_id))
-                    merge_count += 1
-        print 'number of merges:', merge_count
+    homonyms = find_lineage_homonyms(tree, names, alive, final_names)
+    print "number of lineage homonyms: ",len(homonyms)
+
+    write_taxonomy(tree, names, alive, final_names, taxdir + "/taxonomy.tsv")
+    write_synonyms(tree, names, alive, sunk, taxdir + "/synonyms.tsv")
+    if dump.exists("merged.dmp"):
+        write_forwards(dump, taxdir + "/forwards.tsv")
+    if prevdir != None:
+        write_delta(dump, tree, names, alive, final_names, prevdir, taxdir + "/delta.tsv")
@@ -0,0 +1,180 @@
+# Repairing a source taxonomy from earlier versions of itself.
+#
+# A new conversion of a source sometimes loses parent pointers that an
+# older conversion had.  Each version's taxonomy.tsv is loaded as a
+# Table: one list per column (id, parent id, name, rank, flags), plus
+# hash indexes from id and from name to row number.  An older version
+# is joined against the current one on id, or failing that on
+# unambiguous name, and a parent pointer the current version lacks is
+# taken from the older one; taxa the current version lacks altogether
+# are copied over.  Every row remembers which version its parent
+# pointer came from, so the repaired taxonomy can report how many
+# parents each version contributed.
+
+import os, csv
+
+# by_name value for a name shared by more than one row
+HOMONYM = -1
+
+class Table(object):
+
+    def __init__(self, label):
+        self.label = label
+        self.ids = []
+        self.parent_ids = []     # None for no parent
+        self.names = []
+        self.ranks = []          # None for no rank
+        self.flags = []
+        self.origin = []         # which of origins the parent came from
+        self.origins = [label]
+        self.row = {}            # id -> row
+        self.by_name = {}        # name -> row, or HOMONYM
+
+    @staticmethod
+    def load(dirname):
+        print 'Loading', dirname
+        table = Table(dirname)
+        with open(os.path.join(dirname, 'taxonomy.tsv')) as infile:
+            for line in infile:
+                fields = (line.strip() + '\t\t|\tx').split('\t|\t')
+                id = fields[0]
+                if id == 'uid': continue
+                rank = fields[3].strip()
+                if rank == '' or rank == 'no rank': rank = None
+                table.add(id, fields[1], fields[2], rank, fields[4].strip())
+        return table
+
+    def add(self, id, parent_id, name, rank, flags, origin=0):
+        """Adds a row and enters it in the indexes; returns its number"""
+        if parent_id == '': parent_id = None
+        if rank != None: rank = intern(rank)
+        k = len(self.ids)
+        self.ids.append(id)
+        self.parent_ids.append(parent_id)
+        self.names.append(name)
+        self.ranks.append(rank)
+        self.flags.append(intern(flags))
+        self.origin.append(origin)
+        self.row[id] = k
+        if name in self.by_name:
+            self.by_name[name] = HOMONYM
+        else:
+            self.by_name[name] = k
+        return k
+
+    def lookup(self, id_or_name):
+        """Row number for an id, or else for an unambiguous name"""
+        k = self.row.get(id_or_name)
+        if k == None:
+            k = self.by_name.get(id_or_name)
+            if k == HOMONYM: k = None
+        return k
+
+    def origin_code(self, label):
+        if label not in self.origins:
+            self.origins.append(label)
+        return self.origins.index(label)
+
+    def set_parent(self, k, parent_id, label):
+        self.parent_ids[k] = parent_id
+        self.origin[k] = self.origin_code(label)
+
+    def repair_from(self, older, use_names):
+        """Takes parent pointers and missing taxa from an older version.
+        Rows of older that match no row by id match by name, if
+        use_names is set and the name isn't a homonym."""
+        code = self.origin_code(older.label)
+        added = 0
+        fixed = 0
+        # Rows are visited in the order of older's id index, which
+        # decides which of two same-named new taxa gets copied
+        for (oid, j) in older.row.iteritems():
+            k = self.lookup(oid)
+            danger = False
+            if k == None:
+                # Might be a new one, but don't create homonyms
+                k = self.by_name.get(older.names[j])
+                if k == HOMONYM:
+                    # We have a homonym already, and no way to match.  Skip it.
+                    continue
+                if k == None:
+                    # Really a new one.  Copy it
+                    self.add(oid, older.parent_ids[j], older.names[j],
+                             older.ranks[j], older.flags[j], code)
+                    added += 1
+                    continue
+                if not use_names:
+                    continue
+                # Don't create a homonym, but do transfer information
+                # over from the taxon that has the same name
+                if int(self.ids[k]) - int(oid) > 2:
+                    danger = True
+
+            if self.flags[k] == '':
+                self.flags[k] = older.flags[j]
+            parent_id = self.parent_ids[k]
+            if parent_id == older.parent_ids[j]:
+                continue   # No new information here
+            if parent_id == None or not parent_id in self.row:
+                self.parent_ids[k] = older.parent_ids[j]
+                self.origin[k] = code
+                if danger:
+                    print "Targeting taxon %s with id %s (id in supplemental taxonomy is %s)"%(self.names[k], self.ids[k], oid)
+                fixed += 1
+        print 'Added', added, '/ fixed', fixed
+        return (added, fixed)
+
+    def dump(self, dirname, roots, rank_order):
+        """Writes the taxa that have a parent or a child.  A parent
+        pointer that doesn't lead to one of those becomes 'not found'
+        (or none, for the named roots), and one that leads to a taxon
+        of the same or lower rank is dropped."""
+        row = self.row
+        parent_ids = self.parent_ids
+        keep = set()
+        for k in row.itervalues():
+            parent_id = parent_ids[k]
+            if parent_id in row:
+                keep.add(self.ids[k])
+                keep.add(parent_id)
+        print 'Flushing', len(row) - len(keep)
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        outfile = open(os.path.join(dirname, "taxonomy.tsv"), 'w')
+        writer = csv.writer(outfile, delimiter='\t')
+        writer.writerow(('uid', 'parent_uid', 'name', 'rank', 'flags'))
+        missing = 0
+        badrank = 0
+        contributed = [0] * len(self.origins)
+        for k in sorted(row.itervalues(), key=lambda k:int(self.ids[k])):
+            if self.ids[k] not in keep:
+                continue
+            parent_id = parent_ids[k]
+            if not parent_id in keep:
+                if self.names[k] in roots:
+                    parent_id = ''
+                else:
+                    parent_id = 'not found'
+                    missing += 1
+            else:
+                p = row[parent_id]
+                if (self.ranks[p] in rank_order and
+                    self.ranks[k] in rank_order and
+                    rank_order[self.ranks[p]] >= rank_order[self.ranks[k]]):
+                    print ('Detaching %s %s %s from %s %s %s' %
+                           (self.names[k], self.ids[k], self.ranks[k],
+                            self.names[p], self.ids[p], self.ranks[p]))
+                    badrank += 1
+                    parent_id = ''
+                else:
+                    contributed[self.origin[k]] += 1
+            parent_ids[k] = parent_id
+            rank = self.ranks[k]
+            if rank == None: rank = 'no rank'
+            writer.writerow((self.ids[k], parent_id, self.names[k], rank, self.flags[k]))
+        outfile.close()
+        print 'Missing', missing, 'parents /', badrank, 'upranks'
+        for (label, count) in zip(self.origins, contributed):
+            print 'Parents from %s: %s' % (label, count)
+        return contributed
@@ -1,8 +1,20 @@
 # Adds a fourth 'name' column to the accessionid_to_taxonid.tsv table.
+# The result is an accession index (see accession_index.py) from
+# accession id to (ncbi id, strain, name), for process_silva.py to
+# search directly.
 
-import argparse, csv
+import argparse, csv, sys, os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import accession_index
 
 def get_accession_to_taxon(accessionfilename):
+    if accession_index.is_index(accessionfilename):
+        index = accession_index.AccessionIndex(accessionfilename)
+        accession_to_taxon = dict(index.iteritems())
+        index.close()
+        print len(accession_to_taxon), 'accessions'
+        return accession_to_taxon
     accession_to_taxon = {}
     with open(accessionfilename, 'r') as afile:
         i = 0
@@ -43,8 +55,8 @@ def get_ncbi_to_name(taxonomyfilename):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='NCBI ids and names')
     parser.add_argument('ncbi', help='taxonomy.tsv for NCBI taxonomy in open tree format')
-    parser.add_argument('mappings', help='genbank accession id to NCBI taxon mapping')
-    parser.add_argument('out', help='where to write the output file')
+    parser.add_argument('mappings', help='genbank accession id to NCBI taxon mapping (.tsv or index)')
+    parser.add_argument('out', help='where to write the accession index')
     args = parser.parse_args()
 
     print 'reading', args.mappings
@@ -54,13 +66,13 @@ if __name__ == '__main__':
     ncbi_to_name = get_ncbi_to_name(args.ncbi)
 
     print 'writing', args.out
-    with open(args.out, 'w') as outfile:
+    def rows():
         i = 0
-        writer = csv.writer(outfile, delimiter='\t')
         for gid in accession_to_taxon:
             (ncbi_id, strain) = accession_to_taxon[gid]
             name = ncbi_to_name.get(ncbi_id)
-            row = writer.writerow((gid, ncbi_id, strain, name))
+            yield (gid, (ncbi_id, strain, name))
             i += 1
             if i % 500000 == 0:
                 print gid, ncbi_id, strain, name
+    accession_index.write(args.out, rows())
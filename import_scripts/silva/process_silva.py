@@ -52,6 +52,12 @@ import string
 import os, time, json, os.path
 import csv
 import argparse
+import tempfile, shutil, heapq, itertools, multiprocessing
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fasta
+import accession_index
 
 class Taxon:
     def __init__(self):
@@ -63,35 +69,37 @@ class Taxon:
         self.exemplar_id = None
         self.clusters = 0
 
-pathdict = {} #given the cluster identifier, return the taxonomy path
 #seqdict = {} #given the taxon name, return (<species id assigned here>,<unique sequence id from SSU ref file>) 
 Seen = {} # to tell whether the taxon name has been seen before - to know if homonym check needs to be done
 
-# Input: name of the SILVA fasta file (with sequences removed, or not)
-# Return value: a dict mapping sequence specifier (e.g. 'A45315.1.1521')
-# to lineage
+# Input: name of the SILVA fasta file, as downloaded (.fasta.gz) or
+# uncompressed, with or without sequences
+# Generates (cluster id, lineage) for each header line, where the
+# cluster id is the sequence specifier (e.g. 'A45315.1.1521') and the
+# lineage is the list of names from the header.  Header lines without
+# a lineage (no ';') are skipped.
 
-def makePathDict(infilename):
-    infile = open(infilename,'rU')
+def read_lineages(infilename):
     inclusive = 0
     exclusive = 0
-    for line in infile:
-        if line[0] == '>':
-            inclusive += 1
-            exclusive += 1
-            taxlist = []        
-            cluster_id = line.split()[0].strip() # was going to use the species but there are multiple 'unidentified', for example
-            taxlist_1  = line.strip(cluster_id).strip().split(';')
-            cluster_id = cluster_id.lstrip('>')
-            for taxname in taxlist_1:
-                # JAR commented out the following... smasher takes care of these
-                # if not re.search('Incertae Sedis',tax) and tax not in taxlist:            
-                taxlist.append(taxname)
-            #if 'uncultured' in taxlist:
-            #   taxlist.remove('uncultured') #not sure...
-            pathdict[cluster_id] = taxlist
+    for header in fasta.headers(infilename):
+        if ';' not in header:
+            continue
+        inclusive += 1
+        exclusive += 1
+        # was going to use the species but there are multiple 'unidentified', for example
+        fields = header.split(None, 1)
+        cluster_id = fields[0]
+        if len(fields) > 1:
+            taxlist = fields[1].strip().split(';')
+        else:
+            taxlist = ['']
+        # JAR commented out the following... smasher takes care of these
+        # if not re.search('Incertae Sedis',tax) and tax not in taxlist:
+        #if 'uncultured' in taxlist:
+        #   taxlist.remove('uncultured') #not sure...
+        yield (cluster_id, taxlist)
     print "Clusters: %s  Exclusive of kill list: %s"%(inclusive, exclusive)
-    return pathdict 
 
 # Not used for now...
 def checkHomonym(cluster_id,taxon,pathdict,olduid,homfilename):
@@ -127,8 +135,13 @@ def readRanks(indir):
     rankfile.close()
 
 # Each row is (accession id, ncbi id, strain, taxon name)
+# The mapping is either an accession index, made by get_taxon_names.py,
+# which is searched in place, or (from older builds) a .tsv file
 
 def read_accession_to_ncbi_info(ncbifilename):
+    if accession_index.is_index(ncbifilename):
+        print 'Opening', ncbifilename
+        return NcbiInfo(ncbifilename)
     accession_to_ncbi_info = {}
     with open(ncbifilename, 'r') as ncbifile:
         print 'Reading', ncbifilename
@@ -140,69 +153,222 @@ def read_accession_to_ncbi_info(ncbifilename):
                     strain = fields[2]
                 else:
                     strain = None
-                    if len(fields) >= 3 and fields[3] != '':
-                        name = fields[3]
-                    else:
-                        name = None
+                if len(fields) >= 4 and fields[3] != '':
+                    name = fields[3]
+                else:
+                    name = None
                 accession_to_ncbi_info[genbank_id] = (ncbi_id, name, strain)
     return accession_to_ncbi_info
 
+class NcbiInfo(object):
+    """accession id -> (ncbi id, name, strain), like the dict that
+    read_accession_to_ncbi_info makes from a .tsv file"""
+
+    def __init__(self, path):
+        self.index = accession_index.AccessionIndex(path)
+
+    def get(self, accession_id, default=None):
+        fields = self.index.get(accession_id)
+        if fields == None or fields[0] == '*':
+            return default
+        (ncbi_id, strain, name) = fields
+        return (ncbi_id, name, strain)
+
 synonyms = {}
 
-def process_silva(pathdict, outdir):
+def process_silva(fasta_path, outdir, jobs=1):
     taxa = {}
     synonyms = {}
-    cluster_parent = get_higher_taxa(pathdict, taxa, synonyms)
-    ncbi_to_taxon = get_tips(taxa, cluster_parent)
+    spooldir = tempfile.mkdtemp(prefix='clusters-', dir=outdir)
+    try:
+        spool = ClusterSpool(spooldir)
+        (renumber, heights) = get_higher_taxa(read_lineages(fasta_path), taxa, synonyms, spool)
+        ncbi_to_taxon = get_tips(taxa, spool.close(), renumber, heights, jobs)
+    finally:
+        shutil.rmtree(spooldir)
     return (taxa, synonyms, ncbi_to_taxon)
 
-# Returns map from cluster id to higher taxon (actual OTT taxon will
-# be somewhere in between)
-
-def get_higher_taxa(pathdict, taxa, synonyms):
+# Clusters are spooled to disk as they are read, one file per domain
+# (the first name of the lineage), as lines
+#   len(cluster_id) <tab> cluster_id <tab> provisional parent number
+# where the provisional number is the parent's position in creation
+# order; the final integer ids aren't known until all lineages have
+# been read.  A cluster's tip taxon always lies in the same domain as
+# its parent, so the domains can be processed independently.
+
+class ClusterSpool:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.files = {}    # domain name -> open file
+        self.paths = []
+        self.count = 0
+
+    def add(self, domain, cluster_id, parent_number):
+        spoolfile = self.files.get(domain)
+        if spoolfile == None:
+            path = os.path.join(self.dirname, 'domain%s' % len(self.paths))
+            spoolfile = open(path, 'w')
+            self.files[domain] = spoolfile
+            self.paths.append(path)
+        spoolfile.write('%s\t%s\t%s\n' % (len(cluster_id), cluster_id, parent_number))
+        self.count += 1
+
+    def close(self):
+        for spoolfile in self.files.itervalues():
+            spoolfile.close()
+        return self.paths
+
+# External sort of a spool file into canonical cluster order, i.e. by
+# (len(cluster_id), cluster_id).  Sorted runs of at most runsize
+# clusters are written next to the spool file and then merged into
+# <path>.sorted, whose path is returned.
+
+def sort_spool(path, runsize=1000000):
+    runpaths = []
+    with open(path, 'r') as infile:
+        while True:
+            run = [read_cluster(line) for line in itertools.islice(infile, runsize)]
+            if len(run) == 0:
+                break
+            run.sort()
+            runpath = '%s.run%s' % (path, len(runpaths))
+            write_clusters(run, runpath)
+            runpaths.append(runpath)
+            del run
+    sorted_path = path + '.sorted'
+    runfiles = [open(runpath, 'r') for runpath in runpaths]
+    write_clusters(heapq.merge(*[itertools.imap(read_cluster, runfile) for runfile in runfiles]),
+                   sorted_path)
+    for runfile in runfiles:
+        runfile.close()
+        os.remove(runfile.name)
+    os.remove(path)
+    return sorted_path
+
+def read_cluster(line):
+    (length, cluster_id, parent_number) = line.split('\t')
+    return (int(length), cluster_id, int(parent_number))
+
+def read_clusters(path):
+    with open(path, 'r') as infile:
+        for line in infile:
+            yield read_cluster(line)
+
+def write_clusters(records, path):
+    with open(path, 'w') as outfile:
+        for record in records:
+            outfile.write('%s\t%s\t%s\n' % record)
+
+# Position of each cluster in the walk over clusters that assigns tip
+# taxon ids; see get_tips.  Set before the worker processes are forked.
+walk = {}
+
+# Groups one domain's clusters by (parent taxon, ncbi id, strain).
+# Returns a list with one entry per group, in walk order of the
+# group's first cluster:
+#   [walk position of first cluster, its cluster id, its accession id,
+#    parent taxon id, height, ncbi id, name, number of clusters]
+
+def group_clusters(task):
+    (path, renumber, heights) = task
+    groups = {}
+    for (length, cluster_id, parent_number) in read_clusters(path):
+        parent_id = renumber[parent_number]
+        accession_id = string.split(cluster_id,".",1)[0]
+        ncbi_info = accession_to_ncbi_info.get(accession_id)
+        if ncbi_info != None:
+            (ncbi_id, name, strain) = ncbi_info
+
+            if name != None and strain != None and not name.endswith(strain):
+                name = "%s %s" % (name, strain)
+                print 'strain:', name
+
+            position = walk[cluster_id]
+            taxon_key = (parent_id, ncbi_id, strain)
+            group = groups.get(taxon_key)
+            if group == None:
+                groups[taxon_key] = [position, cluster_id, accession_id, parent_id,
+                                     heights[parent_id] + 1, ncbi_id, name, 1]
+            else:
+                if position < group[0]:
+                    # Taxon is named after its first cluster
+                    group[0:3] = [position, cluster_id, accession_id]
+                    group[6] = name
+                group[7] += 1
+    return sorted(groups.itervalues())
+
+def pool_map(function, tasks, jobs):
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(function, tasks)
+        pool.close()
+        pool.join()
+        return results
+    else:
+        return map(function, tasks)
+
+# Spools each cluster, with the taxon for the next-to-last name of its
+# lineage as parent (actual OTT taxon will be somewhere in between).
+# Returns arrays mapping provisional parent number to taxon id, and
+# taxon id to height.
+
+# The lineages are merged into a prefix trie as they are read: one taxon
+# per (parent, name), with each cluster hanging off the taxon for the
+# next-to-last name of its lineage.  The final name (the species) isn't
+# used.
+#
+# Ids have to come out as if the clusters had been visited in
+# canonical order - sorted by (len(cluster_id), cluster_id), so that
+# there's a chance they'll match up from one run to the next - with
+# each taxon getting the next integer id when first reached, and its
+# exemplar from the first cluster that reached it.  So each taxon
+# remembers the canonically least cluster below it, and the integer
+# ids are handed out at the end in order of (that cluster, height).
+
+def get_higher_taxa(lineages, taxa, synonyms, spool):
     i = 0
-    taxon_id_counter = 1
-    taxa_by_key = {}  # maps (parentid, name) to taxon
-    cluster_parent = {}
+    taxa_by_key = {}  # maps (parent, name) to taxon
+    first_key = {}    # maps taxon to canonical key of its first cluster
+    synonym_key = {}
 
     # This gets updated as we look down the path
     root = Taxon()
     root.id = 0
     root.name = "life"
     root.height = 0
-    taxa[root.id] = root
+    nodes = [root]
     # cluster_id is a unique cluster reference sequence id e.g. A58083.1.1474
 
-    # Cluster ids - sort canonically so that there's a chance they'll match up from one run to the next
-    cluster_ids = [cluster_id for (z, cluster_id) in sorted([(len(cluster_id), cluster_id) for cluster_id in pathdict])]
+    for (cluster_id, path) in lineages:
 
-    for cluster_id in cluster_ids:
-
-        accession_id = string.split(cluster_id,".",1)[0]
+        key = (len(cluster_id), cluster_id)
 
         i = i + 1
-        if i % 100000 == 0: print i, taxon_id_counter
-        path = pathdict[cluster_id]
+        if i % 100000 == 0: print i, len(nodes)
         parent = root
+        if root not in first_key or key < first_key[root]:
+            first_key[root] = key
 
         # For a single cluster, look at all names on path from root to cluster
         for depth in range(0, len(path)-1):
             name = path[depth]
-            taxon_key = (parent.id, name)
+            taxon_key = (parent, name)
             taxon = taxa_by_key.get(taxon_key)
             if taxon == None:
-                # Subpath not seen before; create new taxon
+                # Subpath not seen before; create new taxon.  Its id is
+                # provisional, until the canonical order is known.
                 taxon = Taxon()
-                taxon.id = taxon_id_counter
-                taxon_id_counter += 1
-                taxon.parent_id = parent.id
+                taxon.id = len(nodes)
+                taxon.parent_id = parent
                 taxon.name = name
                 if depth == 0:  #taxname in ['Bacteria','Eukaryota','Archaea']: 
                     taxon.rank = 'domain'
                 taxon.height = parent.height + 1
                 taxa_by_key[taxon_key] = taxon
-                taxa[taxon.id] = taxon
-                cluster_parent[cluster_id] = taxon
+                first_key[taxon] = key
+                nodes.append(taxon)
+            elif key < first_key[taxon]:
+                first_key[taxon] = key
 
             # Removing plants, animals, fungi, chloroplast and mitochondrial 
             # clusters - also specifying Oryza because it is problematic in 
@@ -217,28 +383,46 @@ def get_higher_taxa(pathdict, taxa, synonyms):
                         ]:
                 if name == 'Chloroplastida':
                     # What NCBI calls it
-                    synonyms['Viridiplantae'] = taxon
+                    synonym = 'Viridiplantae'
                 elif name == 'Metazoa':
                     # What GBIF calls it
-                    synonyms['Animalia'] = taxon
+                    synonym = 'Animalia'
+                else:
+                    synonym = None
+                # The canonically last cluster through a taxon of this name
+                # wins, and within its lineage the deepest such taxon
+                if synonym != None and (synonym not in synonym_key or key >= synonym_key[synonym][0]):
+                    synonym_key[synonym] = (key, taxon)
 
             # Update for next iteration down lineage
             parent = taxon
 
         # Done traversing path
-        cluster_parent[cluster_id] = taxa[parent.id]
-
-        # Set examplar for lineage, if not set already
-        accession_id = string.split(cluster_id,".",1)[0]
-        anc = parent
-        while anc.exemplar_id == None:
-            anc.exemplar_id = accession_id
-            if anc.parent_id == None: break
-            anc = taxa[anc.parent_id]
-
-    print 'Selected clusters:', len(cluster_parent)
+        if len(path) > 1:
+            spool.add(path[0], cluster_id, parent.id)
+        else:
+            spool.add('', cluster_id, parent.id)
+    del taxa_by_key
+
+    # Exemplar for lineage: accession id of the first cluster below
+    nodes.sort(key=lambda taxon: (first_key[taxon], taxon.height))
+    renumber = array('i', [0]) * len(nodes)
+    heights = array('i', [0]) * len(nodes)
+    for (taxon_id, taxon) in enumerate(nodes):
+        renumber[taxon.id] = taxon_id
+        taxon.id = taxon_id
+        taxon.exemplar_id = string.split(first_key[taxon][1],".",1)[0]
+        if taxon.parent_id != None:
+            taxon.parent_id = taxon.parent_id.id
+        heights[taxon_id] = taxon.height
+        taxa[taxon.id] = taxon
+    for synonym in synonym_key:
+        synonyms[synonym] = synonym_key[synonym][1]
+
+
+    print 'Selected clusters:', spool.count
     print 'Higher taxa:', len(taxa)
-    return cluster_parent
+    return (renumber, heights)
 
 # Populate the taxa table with taxa covering clusters.
 # Some of these will be single clusters, others groups of cluster.
@@ -246,52 +430,55 @@ def get_higher_taxa(pathdict, taxa, synonyms):
 # Returns map from ncbi id to taxon; if there are multiple taxa, value in the 
 # map is True.
 
-def get_tips(taxa, cluster_parent):
-
-    # Cluster ids - sort canonically so that there's a chance they'll match up from one run to the next
-    cluster_ids = [cluster_id for (z, cluster_id) in sorted([(len(cluster_id), cluster_id) for cluster_id in cluster_parent.keys()])]
-
-    # Map from (parent_taxon_id, ncbi) to list of clusters... and an id for the list...
-    taxa_by_key = {}
+# Tip taxa are created, and get their ids, in the order of a walk over
+# the clusters: the iteration order of a dict whose keys were inserted
+# in canonical order.  (That is the order the serial version of this
+# loop used, and the ids have to stay the same from one run to the
+# next.)  The domain spools are sorted in parallel, the walk is
+# recovered from their merge, and then the domains are grouped in
+# parallel and their groups merged in walk order.
+
+def get_tips(taxa, spool_paths, renumber, heights, jobs=1):
+    global walk
+
+    sorted_paths = pool_map(sort_spool, spool_paths, jobs)
+    sorted_files = [open(path, 'r') for path in sorted_paths]
+    walk = dict.fromkeys(cluster_id for (length, cluster_id, parent_number)
+                         in heapq.merge(*[itertools.imap(read_cluster, sorted_file)
+                                          for sorted_file in sorted_files]))
+    for sorted_file in sorted_files:
+        sorted_file.close()
+    for (position, cluster_id) in enumerate(walk):
+        walk[cluster_id] = position
+
+    groups = pool_map(group_clusters,
+                      [(path, renumber, heights) for path in sorted_paths],
+                      jobs)
+    walk = {}
 
     # Map from integer id to external id G01123/#4
     ncbi_to_taxon = {}
 
     tip_taxa = []
 
-    for cluster_id in cluster_parent:
-        parent_taxon = cluster_parent.get(cluster_id)
-        if parent_taxon != None:
-            accession_id = string.split(cluster_id,".",1)[0]
-            ncbi_info = accession_to_ncbi_info.get(accession_id)
-            if ncbi_info != None:
-                (ncbi_id, name, strain) = ncbi_info
-
-                if name != None and strain != None and not name.endswith(strain):
-                    name = "%s %s" % (newname, strain)
-                    print 'strain:', name
-
-                taxon_key = (parent_taxon.id, ncbi_id, strain)
-                taxon = taxa_by_key.get(taxon_key)
-                if taxon == None:
-                    taxon = Taxon()
-
-                    # Choose a unique id for this taxon
-                    if accession_id in taxa:
-                        id = cluster_id
-                    else:
-                        id = accession_id
-                    taxon.id = id
-                    taxon.parent_id = parent_taxon.id
-                    taxon.name = name
-                    taxon.height = parent_taxon.height + 1
-                    taxa[id] = taxon
-                    taxa_by_key[taxon_key] = taxon
-
-                    # Save it for next pass (name and rank)
-                    tip_taxa.append((taxon, ncbi_id))
-
-                taxon.clusters += 1
+    for (position, cluster_id, accession_id, parent_id, height, ncbi_id, name, count) in heapq.merge(*groups):
+        taxon = Taxon()
+
+        # Choose a unique id for this taxon
+        if accession_id in taxa:
+            id = cluster_id
+        else:
+            id = accession_id
+        taxon.id = id
+        taxon.parent_id = parent_id
+        taxon.name = name
+        taxon.height = height
+        taxon.clusters = count
+        taxa[id] = taxon
+
+        # Save it for next pass (name and rank)
+        tip_taxa.append((taxon, ncbi_id))
+    del groups
 
     paraphyletic_count = 0
 
@@ -424,10 +611,11 @@ ncbi_info = {}
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process SILVA distribution to make opentree-format taxonomy')
-    parser.add_argument('silva', help='silva.fast file (with or without sequences)')
-    parser.add_argument('mapping', help='genbank id to NCBI taxon id mapping')
+    parser.add_argument('silva', help='silva .fasta or .fasta.gz file (with or without sequences)')
+    parser.add_argument('mapping', help='genbank id to NCBI taxon id mapping (accession index, or .tsv)')
     parser.add_argument('origin_info', help='JSON file with origin info')
     parser.add_argument('outdir', help='taxonomy output directory')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes for the tip taxa')
     args = parser.parse_args()
 
     fasta_path = args.silva
@@ -437,8 +625,7 @@ if __name__ == '__main__':
         blob = json.load(injson)
     outdir = args.outdir
     accession_to_ncbi_info = read_accession_to_ncbi_info(accessionid_to_taxonid_path)
-    pathdict = makePathDict(fasta_path)
-    (taxa, synonyms, ncbi_to_taxon) = process_silva(pathdict, outdir)
+    (taxa, synonyms, ncbi_to_taxon) = process_silva(fasta_path, outdir, args.jobs)
     write_taxonomy(taxa, synonyms, ncbi_to_taxon, blob, args.silva, outdir)
 
 
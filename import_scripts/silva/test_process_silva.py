@@ -0,0 +1,62 @@
+# Tests for the lineage trie in process_silva.py.
+#
+#   python import_scripts/silva/test_process_silva.py
+
+import unittest
+import os, sys, shutil, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import process_silva
+
+def higher_taxa(lineages):
+    taxa = {}
+    synonyms = {}
+    spooldir = tempfile.mkdtemp()
+    try:
+        spool = process_silva.ClusterSpool(spooldir)
+        process_silva.get_higher_taxa(lineages, taxa, synonyms, spool)
+        spool.close()
+    finally:
+        shutil.rmtree(spooldir)
+    return (taxa, synonyms, spool)
+
+def path_names(taxa, taxon):
+    names = []
+    while taxon.parent_id != None:
+        names.append(taxon.name)
+        taxon = taxa[taxon.parent_id]
+    names.reverse()
+    return names
+
+class testHigherTaxa(unittest.TestCase):
+
+    def testIdsInCanonicalOrder(self):
+        (taxa, synonyms, spool) = higher_taxa([
+            ('X17300.1.100', ['Eukaryota', 'Opisthokonta', 'Holozoa', 'x']),
+            ('A45315.1.100', ['Eukaryota', 'SAR', 'y']),
+        ])
+        self.assertEqual([taxa[id].name for id in sorted(taxa)],
+                         ['life', 'Eukaryota', 'SAR', 'Opisthokonta', 'Holozoa'])
+        self.assertEqual(taxa[1].exemplar_id, 'A45315')
+        self.assertEqual(taxa[3].exemplar_id, 'X17300')
+        self.assertEqual(spool.count, 2)
+
+    def testSynonymGoesToCanonicallyLastCluster(self):
+        (taxa, synonyms, spool) = higher_taxa([
+            ('CP02993.1.100', ['Eukaryota', 'Opisthokonta', 'Metazoa', 'x']),
+            ('X173.1.100', ['Eukaryota', 'Holozoa', 'Metazoa', 'y']),
+        ])
+        self.assertEqual(path_names(taxa, synonyms['Animalia']),
+                         ['Eukaryota', 'Opisthokonta', 'Metazoa'])
+
+    def testSynonymGoesToDeepestTaxonOfLineage(self):
+        # Metazoa twice in one lineage: the deeper one gets the synonym
+        (taxa, synonyms, spool) = higher_taxa([
+            ('X173.1.100', ['Eukaryota', 'Metazoa', 'Holozoa', 'Metazoa', 'x']),
+        ])
+        self.assertEqual(path_names(taxa, synonyms['Animalia']),
+                         ['Eukaryota', 'Metazoa', 'Holozoa', 'Metazoa'])
+        self.assertEqual(synonyms['Animalia'].height, 4)
+
+if __name__ == "__main__":
+    unittest.main()
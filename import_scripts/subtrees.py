@@ -0,0 +1,134 @@
+# Subtree and ancestor closures shared by the source importers.
+#
+# An importer describes its tree once, as (id, parent id) pairs, and
+# gets back a Forest whose nodes are numbered 0..n-1.  Questions like
+# "remove these taxa and everything below them" or "keep these taxa and
+# everything above them" are then answered with a flag array (one byte
+# per node) and a single sweep over the nodes in topological order,
+# instead of a stack of ids and repeated dict lookups per taxon.
+
+from array import array
+
+class Forest(object):
+
+    def __init__(self, pairs):
+        """pairs is an iterable of (id, parent id), with None as the
+        parent id of a root.  A parent id that is not itself the id of
+        one of the pairs becomes an extra root node."""
+        self.ids = []      # node number -> id
+        self.node = {}     # id -> node number
+        parent_ids = []
+        for (id, parent_id) in pairs:
+            self.node[id] = len(self.ids)
+            self.ids.append(id)
+            parent_ids.append(parent_id)
+        for k in xrange(len(parent_ids)):
+            parent_id = parent_ids[k]
+            if parent_id != None and parent_id not in self.node:
+                self.node[parent_id] = len(self.ids)
+                self.ids.append(parent_id)
+        n = len(self.ids)
+
+        self.parent = array('i', [-1]) * n
+        for k in xrange(len(parent_ids)):
+            if parent_ids[k] != None:
+                self.parent[k] = self.node[parent_ids[k]]
+        del parent_ids
+
+        # Children, CSR style: those of v are
+        # child_list[child_start[v]:child_start[v+1]]
+        self.child_start = array('i', [0]) * (n + 1)
+        for v in xrange(n):
+            p = self.parent[v]
+            if p >= 0 and p != v:
+                self.child_start[p + 1] += 1
+        for v in xrange(n):
+            self.child_start[v + 1] += self.child_start[v]
+        fill = array('i', self.child_start)
+        self.child_list = array('i', [0]) * self.child_start[n]
+        for v in xrange(n):
+            p = self.parent[v]
+            if p >= 0 and p != v:
+                self.child_list[fill[p]] = v
+                fill[p] += 1
+        del fill
+
+        # Topological order (parents before children).  Nodes on a
+        # parent cycle aren't reachable from any root; they go at the
+        # end, and the sweeps repeat over that tail until nothing
+        # changes.
+        self.order = array('i')
+        seen = bytearray(n)
+        roots = [v for v in xrange(n) if self.parent[v] < 0]
+        self.acyclic_count = self._visit(roots, seen)
+        self._visit(xrange(n), seen)
+
+    def _visit(self, starts, seen):
+        for start in starts:
+            if seen[start]:
+                continue
+            seen[start] = 1
+            stack = [start]
+            while stack:
+                v = stack.pop()
+                self.order.append(v)
+                for c in self.children(v):
+                    if not seen[c]:
+                        seen[c] = 1
+                        stack.append(c)
+        return len(self.order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def children(self, v):
+        return self.child_list[self.child_start[v]:self.child_start[v + 1]]
+
+    def has_children(self, id):
+        v = self.node.get(id)
+        return v != None and self.child_start[v] < self.child_start[v + 1]
+
+    def flags(self, ids=()):
+        """A fresh flag array with the nodes for the given ids set.  Ids
+        that aren't in the forest are ignored."""
+        flags = bytearray(len(self.ids))
+        for id in ids:
+            v = self.node.get(id)
+            if v != None:
+                flags[v] = 1
+        return flags
+
+    def flag_descendants(self, flags):
+        """Set the flag of every node below a flagged node"""
+        self._sweep(flags, self.order)
+
+    def flag_ancestors(self, flags):
+        """Set the flag of every node above a flagged node"""
+        self._sweep(flags, reversed(self.order), up=True)
+
+    def _sweep(self, flags, order, up=False):
+        parent = self.parent
+        for v in order:
+            p = parent[v]
+            if p >= 0:
+                if up:
+                    if flags[v]: flags[p] = 1
+                elif flags[p]:
+                    flags[v] = 1
+        tail = self.order[self.acyclic_count:]
+        if up: tail.reverse()
+        changed = len(tail) > 0
+        while changed:
+            changed = False
+            for v in tail:
+                p = parent[v]
+                if up:
+                    if flags[v] and not flags[p]:
+                        flags[p] = 1
+                        changed = True
+                elif flags[p] and not flags[v]:
+                    flags[v] = 1
+                    changed = True
+
+    def flagged_ids(self, flags):
+        return [self.ids[v] for v in xrange(len(self.ids)) if flags[v]]
@@ -9,59 +9,224 @@
 #        harvest 8, then wait one second?
 
 # Starts with:
-#   queue.txt - list of aphia ids for subtress that remain to be harvested.
+#   store (SQLite) - the queue: aphia ids for subtrees that remain to be
+#     harvested; the ids seen so far; and the chunks written so far.
 #   records/*.csv - file of digested worms records already harvested.
+# (A queue.txt from an older harvest can be loaded into a new store
+# with --queue.)
 
 # Every member of the queue is an aphia id for a record that has been 
 # processed, but whose children and synonyms have not.
 
+# The store is updated in one transaction after each chunk's files are
+# written, so after a crash the harvest resumes with the chunk that
+# was in progress, and nothing is fetched twice once committed.
+
+# Requests can be made from several threads at once (--jobs); the
+# politeness budget of REQUESTS_PER_SLEEP requests per SECONDS_PER_SLEEP
+# seconds is shared between them (see TokenBucket).
+
 REQUESTS_PER_SLEEP = 3
 SECONDS_PER_SLEEP = 1
 DEFAULT_CHUNK_SIZE = 100   # eventually maybe 800
 
 DEFAULT_PROXY = 'http://www.marinespecies.org/aphia.php?p=soap&wsdl=1'
+DEFAULT_REST_URL = 'http://www.marinespecies.org/rest'
 DEFAULT_ROOT_ID = 1  # Biota
 stop_at_species = True
 
-# Need:
+# Need (for SOAP only):
 #  https://sourceforge.net/projects/pywebsvcs/files/SOAP.py/
 
 import os, sys, re, csv
 import codecs  # maybe not
 import argparse
-from collections import deque
-from time import sleep
-from SOAPpy import WSDL
-
-WORMSPROXY = WSDL.Proxy(DEFAULT_PROXY)
+import json, threading, time, urllib, urllib2, sqlite3
+import socket, httplib
+from multiprocessing.pool import ThreadPool
 
 seen = {}
 
-# For phase I
-def fetch_worms(root, queuepath, outdir, chunk_size, chunk_count):
-    queue = load_queue(queuepath, root)
-    j = 0
-    while len(queue) > 0 and j < chunk_count:
-        chunk = get_chunk(chunk_size, queue)
-        save_chunk(chunk, outdir)
-        save_queue(queue, queuepath)
-        j += 1
+# For phase I.  A chunk is only committed to the store once all of its
+# fetches have succeeded; if one raises, the harvest stops there, and
+# the next run starts again from the last chunk committed.
+def fetch_worms(root, store, queuepath, outdir, chunk_size, chunk_count, worms, jobs=1):
+    global seen
+    seen = store.seen
+    queue = load_queue(store, queuepath, root)
+    pool = make_pool(jobs)
+    try:
+        j = 0
+        while len(queue) > 0 and j < chunk_count:
+            chunk = get_chunk(chunk_size, queue, worms, pool, jobs)
+            id = save_chunk(chunk, outdir)
+            store.commit_chunk(id, queue)
+            print 'queued:', len(queue)
+            j += 1
+    finally:
+        close_pool(pool)
 
 # For phase II
 
-def fetch_worms_synonyms(outdir, chunk_count):
-    done = 0
-    for name in sorted(os.listdir(outdir)):
-        if done >= chunk_count: break
-        if name.startswith('a'):
-            inpath = os.path.join(outdir, name)
-            synpath = os.path.join(outdir, 's%s.csv' % name[1:-4])
-            if not os.path.exists(synpath):
+def fetch_worms_synonyms(store, outdir, chunk_count, worms, jobs=1):
+    global seen
+    seen = store.synonym_seen
+    if store.chunk_count() == 0:
+        # Harvested before there was a store
+        store.add_chunks_from(outdir)
+    pool = make_pool(jobs)
+    try:
+        for id in store.synonymless_chunks(chunk_count):
+            inpath = os.path.join(outdir, 'a%07d.csv' % id)
+            synpath = os.path.join(outdir, 's%07d.csv' % id)
+            if os.path.exists(inpath):
                 print '%s -> %s' % (inpath, synpath)
                 taxon_aphias = load_aphias(inpath)
-                syn_aphias = get_synonym_aphias(taxon_aphias)
+                syn_aphias = get_synonym_aphias(taxon_aphias, worms, pool)
                 save_aphias(syn_aphias, synpath)
-                done += 1
+            store.commit_synonyms(id)
+    finally:
+        close_pool(pool)
+
+# The harvest's durable state, in a SQLite database:
+#   queue(pos, id) - the queue (a stack), by position
+#   seen(id, parent) - phase I: parent id (or 'queued') of each id seen
+#   synonym_seen(id, taxon) - the same for phase II
+#   chunks(id, synonyms) - chunks written, by first id; synonyms is 1
+#     once phase II has been done for the chunk
+
+class HarvestStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS queue (pos INTEGER PRIMARY KEY, id INTEGER);
+            CREATE TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY, parent);
+            CREATE TABLE IF NOT EXISTS synonym_seen (id INTEGER PRIMARY KEY, taxon);
+            CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, synonyms INTEGER DEFAULT 0);
+        ''')
+        self.db.commit()
+        self.seen = SeenMap(self.db, 'seen')
+        self.synonym_seen = SeenMap(self.db, 'synonym_seen')
+
+    def close(self):
+        self.db.close()
+
+    def load_queue(self):
+        return Frontier([id for (id,) in self.db.execute('SELECT id FROM queue ORDER BY pos')])
+
+    def chunk_count(self):
+        return self.db.execute('SELECT count(*) FROM chunks').fetchone()[0]
+
+    def commit_chunk(self, id, queue):
+        with self.db:
+            self.seen.flush()
+            queue.flush(self.db)
+            if id != None:
+                self.db.execute('INSERT OR REPLACE INTO chunks (id) VALUES (?)', (id,))
+
+    def synonymless_chunks(self, limit):
+        return [id for (id,) in self.db.execute(
+            'SELECT id FROM chunks WHERE synonyms = 0 ORDER BY id LIMIT ?',
+            (limit if limit != None else -1,))]
+
+    def commit_synonyms(self, id):
+        with self.db:
+            self.synonym_seen.flush()
+            self.db.execute('UPDATE chunks SET synonyms = 1 WHERE id = ?', (id,))
+
+    def add_chunks_from(self, outdir):
+        with self.db:
+            for name in sorted(os.listdir(outdir)):
+                if name.startswith('a'):
+                    id = int(name[1:-4])
+                    done = os.path.exists(os.path.join(outdir, 's%07d.csv' % id))
+                    self.db.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?)', (id, int(done)))
+
+# Ids seen, with the store's table behind an in-memory map of the ids
+# seen since the last commit.
+
+class SeenMap:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.pending = {}
+
+    def __contains__(self, id):
+        return self.get(id) != None
+
+    def __getitem__(self, id):
+        value = self.get(id)
+        if value == None:
+            raise KeyError(id)
+        return value
+
+    def get(self, id):
+        value = self.pending.get(id)
+        if value == None:
+            row = self.db.execute('SELECT * FROM %s WHERE id = ?' % self.table, (id,)).fetchone()
+            if row != None:
+                value = row[1]
+        return value
+
+    def __setitem__(self, id, value):
+        self.pending[id] = value
+
+    def flush(self):
+        self.db.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % self.table,
+                            self.pending.iteritems())
+        self.pending = {}
+
+# The queue is worked from the end.  Entries below the lowest point
+# the queue has shrunk to since the last flush are still in the store
+# as they were; only those above it are rewritten.
+
+class Frontier:
+    def __init__(self, ids):
+        self.ids = ids
+        self.synced = len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def pop(self):
+        id = self.ids.pop()
+        self.synced = min(self.synced, len(self.ids))
+        return id
+
+    def append(self, id):
+        self.ids.append(id)
+
+    def extend(self, ids):
+        self.ids.extend(ids)
+
+    def flush(self, db):
+        db.execute('DELETE FROM queue WHERE pos >= ?', (self.synced,))
+        db.executemany('INSERT INTO queue VALUES (?, ?)',
+                       ((pos, self.ids[pos]) for pos in xrange(self.synced, len(self.ids))))
+        self.synced = len(self.ids)
+
+# Requests for several ids are made concurrently by a pool of threads;
+# the results come back in the order of the ids.
+
+def make_pool(jobs):
+    if jobs > 1:
+        return ThreadPool(jobs)
+    else:
+        return None
+
+def close_pool(pool):
+    if pool != None:
+        pool.close()
+        pool.join()
+
+def fetch_all(function, ids, pool):
+    if pool == None:
+        return map(function, ids)
+    else:
+        return pool.map(function, ids)
 
 def save_chunk(chunk, outdir):
     (aphias, links) = chunk
@@ -80,6 +245,8 @@ def save_chunk(chunk, outdir):
                 writer.writerow(row)
         path = os.path.join(outdir, 'a%07d.csv' % id)
         save_aphias(aphias, path)
+        return id
+    return None
 
 def save_aphias(aphias, path):
     if len(aphias) > 0:
@@ -110,36 +277,34 @@ def fieldify(x):
     else:
         return x
 
-def load_queue(queuepath, root):
-    q = deque()
-    if os.path.exists(queuepath):
-        with open(queuepath, 'r') as infile:
-            for line in infile:
-                id = int(line.strip())
-                q.append(id)
-                seen[id] = 'queued'
-    else:
-        q.append(root)
-        seen[root] = 'queued'
+# A new store starts with the ids in queuepath (an old queue.txt), if
+# given, or else with the root.
+
+def load_queue(store, queuepath, root):
+    q = store.load_queue()
+    if len(q) == 0 and store.chunk_count() == 0:
+        if queuepath != None and os.path.exists(queuepath):
+            with open(queuepath, 'r') as infile:
+                for line in infile:
+                    id = int(line.strip())
+                    q.append(id)
+                    seen[id] = 'queued'
+        else:
+            q.append(root)
+            seen[root] = 'queued'
+        store.commit_chunk(None, q)
     print '%s ids queued' % len(q)
     return q
 
-def save_queue(queue, queuepath):
-    print 'queued:', len(queue)
-    with open(queuepath, 'w') as outfile:
-        writer = csv.writer(outfile)
-        for id in queue:
-            writer.writerow([id])
+# Up to width subtrees are taken off the queue at a time and their
+# children fetched concurrently; the children are then processed in
+# the order the subtrees were taken, as if they had been fetched one
+# at a time.
 
-def get_chunk(chunk_size, queue):
+def get_chunk(chunk_size, queue, worms, pool=None, width=1):
     record_count = [0]
-    request_count = [0]
     aphias = []
     links = []
-    def throttle():
-        request_count[0] += 1
-        if request_count[0] % REQUESTS_PER_SLEEP == 0:
-            sleep(SECONDS_PER_SLEEP)
     def see(child, parent_id, rel):
         if child.AphiaID in seen:
             if child.status != 'unaccepted':
@@ -158,12 +323,9 @@ def get_chunk(chunk_size, queue):
             s = True
         links.append((child.AphiaID, parent_id, rel))
         return s
-    while len(queue) > 0 and record_count[0] < chunk_size:
-        parent_id = queue.pop()
+    def take_children(parent_id, children):
         siblings = {}
-
-        # print 'requesting children of', parent_id
-        children = sort_aphia(get_one_taxon_children(parent_id))
+        children = sort_aphia(children)
         to_q = []
         for child in children:
 
@@ -186,8 +348,11 @@ def get_chunk(chunk_size, queue):
                     to_q.append(child.AphiaID)
         # try to do lowest numbered subtrees first
         queue.extend(to_q)
-
-        throttle()
+    while len(queue) > 0 and record_count[0] < chunk_size:
+        parent_ids = [queue.pop() for k in xrange(min(width, len(queue)))]
+        # print 'requesting children of', parent_ids
+        for (parent_id, children) in zip(parent_ids, fetch_all(worms.children, parent_ids, pool)):
+            take_children(parent_id, children)
     return (aphias, links)
 
 def synonymp(aphia):
@@ -197,30 +362,26 @@ def synonymp(aphia):
             
 # Phase II
 
-def get_synonym_aphias(aphias):
+def get_synonym_aphias(aphias, worms, pool=None):
     status_column = digest_header.index('status')
-    request_count = 0
     for taxon in aphias:
         taxon_id = int(taxon[0])
         seen[taxon_id] = True
+    taxon_ids = [int(taxon[0]) for taxon in aphias
+                 if taxon[status_column] == 'accepted']
+    # print 'requesting synonyms of', taxon_ids
     syn_aphias = []
-    for taxon in aphias:
-        if taxon[status_column] == 'accepted':
-            taxon_id = int(taxon[0])
-            cosynonyms = {}
-            # print 'requesting synonyms of', taxon_id
-            # Get all aphia records for synonyms of aphia
-            for syn in sort_aphia(get_one_taxon_synonyms(taxon_id)):
-                if not syn.AphiaID in cosynonyms:
-                    cosynonyms[syn.AphiaID] = True
-                    if not syn.AphiaID in seen:
-                        # First time encountering this id
-                        seen[syn.AphiaID] = taxon_id
-                        if synonymp(syn):
-                            syn_aphias.append(digest(syn))
-            request_count += 1
-            if request_count % REQUESTS_PER_SLEEP == 0:
-                sleep(SECONDS_PER_SLEEP)
+    for (taxon_id, syns) in zip(taxon_ids, fetch_all(worms.synonyms, taxon_ids, pool)):
+        cosynonyms = {}
+        # Get all aphia records for synonyms of aphia
+        for syn in sort_aphia(syns):
+            if not syn.AphiaID in cosynonyms:
+                cosynonyms[syn.AphiaID] = True
+                if not syn.AphiaID in seen:
+                    # First time encountering this id
+                    seen[syn.AphiaID] = taxon_id
+                    if synonymp(syn):
+                        syn_aphias.append(digest(syn))
     return syn_aphias
 
 def sort_aphia(aphia_list):
@@ -265,55 +426,197 @@ Keep these aphia fields:
 # http://marinespecies.org/aphia.php?p=soap# says max 50
 MAXLENGTH = 50
 
-
-def get_one_taxon_children(taxon_id):
-    result = []
-    offset = 0
-    try:
-        wsdlChildren = WORMSPROXY.getAphiaChildrenByID(taxon_id,
-                                                       offset=offset,
-                                                       marine_only=False)
+# A token bucket holding up to capacity tokens, refilled at rate tokens
+# per second.  Each request takes one token, waiting (outside the lock)
+# for its turn if the bucket is empty, so any number of threads
+# together stay within the budget.
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+def polite_bucket():
+    return TokenBucket(float(REQUESTS_PER_SLEEP) / SECONDS_PER_SLEEP,
+                       REQUESTS_PER_SLEEP)
+
+# A request that fails with a transient error (connection trouble, 429
+# or 5xx) is retried after an exponentially growing pause, and the
+# error is raised once the retries are used up.  A failed request must
+# never come back as an empty list, or the taxon would be harvested as
+# having no children.
+
+class Retry:
+    def __init__(self, retries=5, backoff=1.0, sleep=time.sleep):
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def __call__(self, request, transient):
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                return request()
+            except Exception as e:
+                if attempt == self.retries or not transient(e):
+                    raise
+                print '** request failed (%s), attempt %s' % (e, attempt + 1)
+
+def transient_http_error(e):
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (urllib2.URLError, httplib.HTTPException, socket.error))
+
+# The WoRMS web services.  children(id) and synonyms(id) return lists
+# of aphia records (objects with AphiaID, scientificname, ... fields).
+
+# SOAP service; each thread gets its own proxy.
+
+class SoapWorms:
+    def __init__(self, url=DEFAULT_PROXY, bucket=None, retry=None):
+        self.url = url
+        self.bucket = bucket or polite_bucket()
+        self.retry = retry or Retry()
+        self.local = threading.local()
+
+    def proxy(self):
+        if not hasattr(self.local, 'proxy'):
+            from SOAPpy import WSDL
+            self.local.proxy = WSDL.Proxy(self.url)
+        return self.local.proxy
+
+    def call(self, method, *args, **kwargs):
+        def request():
+            self.bucket.take()
+            return getattr(self.proxy(), method)(*args, **kwargs)
+        return self.retry(request, self.transient)
+
+    def transient(self, e):
+        from SOAPpy.Errors import HTTPError
+        if isinstance(e, HTTPError):
+            return e.code == 429 or e.code >= 500
+        return isinstance(e, (socket.error, httplib.HTTPException))
+
+    def children(self, taxon_id):
+        result = []
+        offset = 0
+        wsdlChildren = self.call('getAphiaChildrenByID', taxon_id,
+                                 offset=offset,
+                                 marine_only=False)
         if wsdlChildren:
             result.extend(wsdlChildren)
             while len(wsdlChildren) == MAXLENGTH:
                 offset += MAXLENGTH
                 # if you put marine_only=False here then it stops working!!
-                wsdlChildren = WORMSPROXY.getAphiaChildrenByID(taxon_id,
-                                                               offset=offset)
+                wsdlChildren = self.call('getAphiaChildrenByID', taxon_id,
+                                         offset=offset)
                 if wsdlChildren:
                     result.extend(wsdlChildren)
                 else:
                     break
-    except socket.error as e:
-        print e
-        raise RuntimeException("dummy")
-    finally:
         return result
 
+    def synonyms(self, taxon_id):
+        result = []
+        wsdlSyns = self.call('getAphiaSynonymsByID', taxon_id)
+        if wsdlSyns:
+            result.extend(wsdlSyns)    # return wsdlSyns ?
+        return result
 
-def get_one_taxon_synonyms(taxon_id):
-    result = []
-    offset = 0
-    wsdlSyns = WORMSPROXY.getAphiaSynonymsByID(taxon_id)
-    if wsdlSyns:
-        result.extend(wsdlSyns)    # return wsdlSyns ?
-    return result
+# REST service, or a stand-in for it serving the same JSON.  Pages
+# are numbered from offset 1; a 204 (no content) response means no
+# records.
+
+class Aphia:
+    def __init__(self, record):
+        for (key, value) in record.iteritems():
+            setattr(self, str(key), value)
+
+class RestWorms:
+    def __init__(self, url=DEFAULT_REST_URL, bucket=None, timeout=60, retry=None):
+        self.url = url.rstrip('/')
+        self.bucket = bucket or polite_bucket()
+        self.timeout = timeout
+        self.retry = retry or Retry()
+
+    def get(self, method, taxon_id, params):
+        url = '%s/%s/%s?%s' % (self.url, method, taxon_id, urllib.urlencode(params))
+        def request():
+            self.bucket.take()
+            response = urllib2.urlopen(url, timeout=self.timeout)
+            try:
+                if response.getcode() == 204:
+                    return ''
+                return response.read()
+            finally:
+                response.close()
+        body = self.retry(request, transient_http_error)
+        if body.strip() == '':
+            return []
+        return [Aphia(record) for record in json.loads(body)]
+
+    def get_pages(self, method, taxon_id, params=[]):
+        result = []
+        offset = 1
+        while True:
+            page = self.get(method, taxon_id, params + [('offset', offset)])
+            result.extend(page)
+            if len(page) < MAXLENGTH:
+                return result
+            offset += MAXLENGTH
+
+    def children(self, taxon_id):
+        return self.get_pages('AphiaChildrenByAphiaID', taxon_id,
+                              [('marine_only', 'false')])
+
+    def synonyms(self, taxon_id):
+        return self.get_pages('AphiaSynonymsByAphiaID', taxon_id)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--synonyms', dest='synonymsp', action='store_true')
-    parser.add_argument('--queue', dest='queuefile')
+    parser.add_argument('--store', dest='storefile', required=True,
+                        help='SQLite file for the queue and progress')
+    parser.add_argument('--queue', dest='queuefile',
+                        help='old-style queue file to start a new store from')
     parser.add_argument('--out', dest='outdir')
     parser.add_argument('--chunks', dest='chunk_count', type=int)
     parser.add_argument('--root', dest='root', type=int, default=DEFAULT_ROOT_ID)
     parser.add_argument('--chunksize', dest='chunksize', type=int,
                         default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='number of requests in flight at once')
+    parser.add_argument('--rest', dest='rest_url', nargs='?', const=DEFAULT_REST_URL,
+                        help='use the REST service at this URL instead of SOAP')
     args = parser.parse_args()
+    if args.rest_url:
+        worms = RestWorms(args.rest_url)
+    else:
+        worms = SoapWorms()
+    store = HarvestStore(args.storefile)
     if not args.synonymsp:
         print 'phase 1'
-        fetch_worms(args.root, args.queuefile, args.outdir,
-                    args.chunksize, args.chunk_count)
+        fetch_worms(args.root, store, args.queuefile, args.outdir,
+                    args.chunksize, args.chunk_count, worms, args.jobs)
     else:
         print 'phase 2'
-        fetch_worms_synonyms(args.outdir, args.chunk_count)
+        fetch_worms_synonyms(store, args.outdir, args.chunk_count, worms, args.jobs)
+    store.close()
@@ -13,8 +13,8 @@
 import os, csv, argparse, re
 
 parents = {}
-taxa = {}
-synonyms = {}
+taxa = {}            # int(id) -> record
+synonyms = {}        # int(id) -> record
 has_children = {}
 taxa_by_name = {}    # name -> records
 
@@ -27,6 +27,7 @@ def process_worms(digest_path, out_path):
     for name in names:
         if name.startswith('a'):
             process_records(os.path.join(digest_path, name))
+    grandparents = index_grandparents()
     if not os.path.isdir(out_path):
         os.makedirs(out_path)
     taxpath = os.path.join(out_path, 'taxonomy.tsv')
@@ -34,8 +35,9 @@ def process_worms(digest_path, out_path):
     with open(taxpath + '.new', 'w') as taxfile:
         form = '%s\t%s\t%s\t%s\t%s\n'
         taxfile.write(form % ('uid', 'parent_uid', 'name', 'rank', 'flags'))
-        for taxon in sorted(taxa.values(), key=lambda taxon: int(taxon[0])):
-            if not suppress(taxon):
+        for id in sorted(taxa):
+            taxon = taxa[id]
+            if not suppress(taxon, grandparents):
                 taxfile.write(form % taxon)
     os.rename(taxpath + '.new', taxpath)
     synpath = os.path.join(out_path, 'synonyms.tsv')
@@ -43,23 +45,33 @@ def process_worms(digest_path, out_path):
     with open(synpath + '.new', 'w') as synfile:
         form = '%s\t%s\t%s\t%s\n'
         synfile.write(form % ('uid', 'name', 'type', 'sid'))
-        for synonym in sorted(synonyms.values(), key=lambda synonym: int(synonym[0])):
-            synfile.write(form % synonym)
+        # By accepted id, then synonym id
+        for (valid_id, id) in sorted((int(synonym[0]), id) for (id, synonym) in synonyms.iteritems()):
+            synfile.write(form % synonyms[id])
     os.rename(synpath + '.new', synpath)
 	# The reasons are very interesting, but not to the average OTT builder
     # print 'unaccept_reasons', sorted(unaccept_reasons.values())
 
-def suppress(taxon):
+# For each name that has more than one record, the set of the
+# records' grandparent ids
+
+def index_grandparents():
+    grandparents = {}
+    for (name, records) in taxa_by_name.iteritems():
+        if len(records) > 1:
+            grandparents[name] = set(map(grandparent_id, records))
+    return grandparents
+
+def suppress(taxon, grandparents):
     # (id, parent_id, name, rank, flags) = taxon
     if taxon[0] in has_children:
         return False
     name = taxon[2]
     parent_id = taxon[1]
     flags = taxon[4]
-    taxa = taxa_by_name[name]
-    if len(taxa) == 1:
+    if len(taxa_by_name[name]) == 1:
         return False
-    elif parent_id in map(grandparent_id, taxa):
+    elif parent_id in grandparents[name]:
         # print 'suppress', taxon   -- 145 of these
         return True
     elif 'hidden' in flags:
@@ -70,7 +82,8 @@ def suppress(taxon):
 
 def grandparent_id(taxon):
     parent_id = taxon[1]    # OTT form
-    parent = taxa.get(parent_id)
+    if parent_id == '': return None
+    parent = taxa.get(int(parent_id))
     if parent == None: return None
     gp_id = parent[1]
     return gp_id
@@ -104,7 +117,7 @@ def process_records(inpath):
             if id == valid_id or valid_id == '':
                 taxon = record_to_taxon(row, rank, name)
                 if taxon != None:
-                    taxa[id] = taxon
+                    taxa[int(id)] = taxon
             elif valid_id != '':
                 # synonym, original combination, original rank as subgenus
                 unaccept_reason = row[5].strip()
@@ -130,7 +143,7 @@ def process_records(inpath):
                 else:
                     typ = unaccept_reason
                     unaccept_reasons[lower] = unaccept_reason
-                synonyms[id] = (valid_id, name, typ, id)
+                synonyms[int(id)] = (valid_id, name, typ, id)
 
 unaccept_reasons = {}
 
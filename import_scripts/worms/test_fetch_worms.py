@@ -0,0 +1,217 @@
+# Tests for fetch_worms.py, run against a stand-in for the WoRMS REST
+# service that serves recorded responses from a local port.
+#
+#   python import_scripts/worms/test_fetch_worms.py
+
+import unittest
+import os, sys, csv, json, shutil, tempfile, threading, urlparse
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fetch_worms
+
+def aphia(id, name, rank, valid=None, status='accepted'):
+    return {'AphiaID': id, 'scientificname': name, 'authority': 'Smith, 1900',
+            'rank': rank, 'status': status, 'unacceptreason': None,
+            'valid_AphiaID': valid or id, 'isExtinct': None}
+
+conus = [aphia(1000 + k, 'Conus sp%s' % k, 'Species') for k in range(60)]
+
+# Recorded responses: (method, AphiaID) -> all records, before paging
+RECORDED = {
+    ('AphiaChildrenByAphiaID', 1): [
+        aphia(3, 'Plantae', 'Kingdom'),
+        aphia(2, 'Animalia', 'Kingdom'),
+        aphia(90, 'Animals', 'Kingdom', valid=2, status='unaccepted'),
+    ],
+    ('AphiaChildrenByAphiaID', 2): [
+        aphia(10, 'Mollusca', 'Phylum'),
+        aphia(11, 'Chordata', 'Phylum'),
+        aphia(11, 'Chordata', 'Phylum'),
+    ],
+    ('AphiaChildrenByAphiaID', 10): [aphia(100, 'Conus', 'Genus')],
+    ('AphiaChildrenByAphiaID', 100): conus,
+    ('AphiaChildrenByAphiaID', 11): [aphia(110, 'Pisces', 'Genus')],
+    ('AphiaChildrenByAphiaID', 110): [
+        aphia(1100, 'Pisces piscis', 'Species'),
+        aphia(1101, 'Pisces vulgaris', 'Species', valid=1100, status='unaccepted'),
+    ],
+    ('AphiaSynonymsByAphiaID', 1000): [
+        aphia(2000, 'Conus olim', 'Species', valid=1000, status='unaccepted'),
+    ],
+    ('AphiaSynonymsByAphiaID', 1100): [
+        aphia(1101, 'Pisces vulgaris', 'Species', valid=1100, status='unaccepted'),
+        aphia(2100, 'Pisces antiquus', 'Species', valid=1100, status='unaccepted'),
+    ],
+}
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        (method, id) = url.path.split('/')[-2:]
+        params = urlparse.parse_qs(url.query)
+        offset = int(params.get('offset', ['1'])[0])
+        self.server.requests.append((method, int(id), offset))
+        # The server's 'failures' dict gives the number of requests for
+        # an id to answer with a 500, instead of data
+        if self.server.failures.get(int(id), 0) > 0:
+            self.server.failures[int(id)] -= 1
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        page = RECORDED.get((method, int(id)), [])[offset - 1:offset - 1 + 50]
+        if len(page) == 0:
+            self.send_response(204)
+            self.end_headers()
+            return
+        body = json.dumps(page)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class testFetchWorms(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests = []
+        self.server.failures = {}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%s/rest' % self.server.server_port
+        self.tempdir = tempfile.mkdtemp()
+        self.sleeps = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def worms(self):
+        return fetch_worms.RestWorms(self.url, fetch_worms.TokenBucket(1000, 1000),
+                                     retry=fetch_worms.Retry(2, sleep=self.sleeps.append))
+
+    def store(self, name):
+        return fetch_worms.HarvestStore(os.path.join(self.tempdir, name + '.db'))
+
+    def harvest(self, name, jobs, chunk_size=1000, chunk_count=100):
+        outdir = os.path.join(self.tempdir, name)
+        store = self.store(name)
+        fetch_worms.fetch_worms(1, store, None, outdir,
+                                chunk_size, chunk_count, self.worms(), jobs)
+        store.close()
+        return outdir
+
+    def read_rows(self, outdir, prefix):
+        rows = []
+        for name in sorted(os.listdir(outdir)):
+            if name.startswith(prefix):
+                with open(os.path.join(outdir, name)) as infile:
+                    reader = csv.reader(infile)
+                    rows.append(reader.next())
+                    rows.extend(reader)
+        return rows
+
+    def testHarvestConcurrently(self):
+        outdir = self.harvest('digest', 4)
+        aphias = self.read_rows(outdir, 'a')
+        self.assertEqual(aphias[0], fetch_worms.digest_header)
+        ids = set(int(row[0]) for row in aphias if row[0] != 'id')
+        # All 60 Conus species, from two pages
+        self.assertTrue(set(range(1000, 1060)) <= ids)
+        self.assertTrue(set([2, 3, 10, 11, 90, 100, 110, 1100, 1101]) <= ids)
+        links = self.read_rows(outdir, 'l')
+        self.assertEqual(links[0], fetch_worms.links_header)
+        self.assertTrue(['90', '2', 's'] in links)
+        self.assertTrue(['1101', '1100', 's'] in links)
+        self.assertTrue(['1059', '100', 'c'] in links)
+        # Species aren't expanded; each page is fetched once
+        self.assertFalse(('AphiaChildrenByAphiaID', 1000, 1) in self.server.requests)
+        self.assertEqual(len(self.server.requests), len(set(self.server.requests)))
+
+    def testSameRecordsAsSerial(self):
+        serial = self.read_rows(self.harvest('serial', 1), 'a')
+        concurrent = self.read_rows(self.harvest('concurrent', 3), 'a')
+        self.assertEqual(sorted(serial), sorted(concurrent))
+
+    def testChunks(self):
+        outdir = self.harvest('chunked', 2, chunk_size=5)
+        self.assertTrue(len([name for name in os.listdir(outdir) if name.startswith('a')]) > 1)
+        store = self.store('chunked')
+        self.assertEqual(len(store.load_queue()), 0)
+        self.assertTrue(store.chunk_count() > 1)
+        store.close()
+
+    def testResume(self):
+        whole = self.read_rows(self.harvest('whole', 1, chunk_size=5), 'a')
+        del self.server.requests[:]
+        # One chunk per run, until the queue is empty
+        for run in range(20):
+            outdir = self.harvest('resumed', 2, chunk_size=5, chunk_count=1)
+        resumed = self.read_rows(outdir, 'a')
+        self.assertEqual(sorted(whole), sorted(resumed))
+        # Nothing fetched twice across runs
+        self.assertEqual(len(self.server.requests), len(set(self.server.requests)))
+
+    def testSynonyms(self):
+        outdir = self.harvest('digest', 2, chunk_size=5)
+        store = self.store('digest')
+        # Resumes from the store's chunk list
+        fetch_worms.fetch_worms_synonyms(store, outdir, 1, self.worms(), 3)
+        self.assertEqual(len(store.synonymless_chunks(100)), store.chunk_count() - 1)
+        fetch_worms.fetch_worms_synonyms(store, outdir, 100, self.worms(), 3)
+        self.assertEqual(store.synonymless_chunks(100), [])
+        store.close()
+        syns = self.read_rows(outdir, 's')
+        ids = set(row[0] for row in syns if row[0] != 'id')
+        self.assertEqual(ids, set(['2000', '2100']))
+
+    def testRetriesFailedRequest(self):
+        whole = self.read_rows(self.harvest('whole', 1), 'a')
+        self.server.failures = {10: 2}
+        retried = self.read_rows(self.harvest('retried', 3), 'a')
+        self.assertEqual(sorted(whole), sorted(retried))
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+
+    def testGivesUp(self):
+        self.server.failures = {10: 3}
+        worms = self.worms()
+        self.assertRaises(IOError, worms.children, 10)
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+
+    def testFailedParentNotCommitted(self):
+        whole = self.read_rows(self.harvest('whole', 1, chunk_size=5), 'a')
+        # Mollusca's children can't be had, however often they're asked for
+        self.server.failures = {10: 1000}
+        self.assertRaises(IOError, self.harvest, 'failed', 2, chunk_size=5)
+        store = self.store('failed')
+        # The chunk before is kept; Mollusca is still to be done
+        self.assertEqual(store.chunk_count(), 1)
+        self.assertTrue(10 in store.load_queue())
+        self.assertFalse(100 in store.seen)
+        store.close()
+        # Once the server recovers, a resumed harvest fills in the subtree
+        self.server.failures = {}
+        resumed = self.read_rows(self.harvest('failed', 2, chunk_size=5), 'a')
+        self.assertEqual(sorted(whole), sorted(resumed))
+
+    def testTokenBucket(self):
+        clock = [0.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+        bucket = fetch_worms.TokenBucket(3, 3, clock=lambda: clock[0], sleep=sleep)
+        for i in range(9):
+            bucket.take()
+        # 3 at once, then one every third of a second
+        self.assertEqual(len(sleeps), 6)
+        self.assertAlmostEqual(clock[0], 2.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -326,6 +326,16 @@ public abstract class Taxonomy {
         }
     }
 
+    // Look up many ids from one idspace in a single call (saves a
+    // Jython to Java crossing per id).  Element i of the result is
+    // lookupQid(prefix:ids[i]).
+    public Node[] lookupQids(String prefix, String[] ids) {
+        Node[] nodes = new Node[ids.length];
+        for (int i = 0; i < ids.length; ++i)
+            nodes[i] = this.lookupQid(new QualifiedId(prefix, ids[i]));
+        return nodes;
+    }
+
     // index a single node by one qid.
     // Don't index synonyms.
     public void indexByQid(Node node, QualifiedId qid) {
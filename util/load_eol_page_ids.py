@@ -11,67 +11,92 @@
 # 46582742,worms,250737
 
 import csv, sys, argparse
+from jarray import array
 from org.opentreeoflife.taxa import Taxonomy, QualifiedId
-from java.lang import System, Runtime
+from java.lang import System, Runtime, String
 
 def load_eol_page_ids(inpath, tax):
     (page_to_nodes, node_to_pages) = load_eol_ids(inpath, tax)
     add_page_ids_to_nodes(tax, node_to_pages, page_to_nodes)
     return (page_to_nodes, node_to_pages)
 
+# Rows are looked up a batch at a time, one call into Java for each
+# batch of source ids from a given idspace.
+
+LOOKUP_BATCH = 100000
+
 def load_eol_ids(inpath, tax):
     System.gc()
     rt = Runtime.getRuntime()
     print '# Memory', rt.freeMemory()/(1024*1024), rt.totalMemory()/(1024*1024)
 
-    page_to_nodes = {}
-    node_to_pages = {}
+    # idspace -> ([row number], [page id], [source id]), not yet looked up
+    pending = {}
+    page_to_nodes = {}    # page id -> {node: (row number, qid)}
+    node_to_pages = {}    # node -> set of page ids
     with open(inpath, 'r') as infile:
         print '| Processing EOL page ids file %s' % (inpath)
         reader = csv.reader(infile)
         row_count = 0
-        hits = 0
         for row in reader:
             row_count += 1
             [page_id, idspace, source_id] = row
             if row_count % 250000 == 0:
                 print row_count, row
-            qid = QualifiedId(idspace, source_id)
-            node = tax.lookupQid(qid)
-            if node != None:   # and node.isPotentialOtu():
-
-                nodes = page_to_nodes.get(page_id)
-                if nodes == None:
-                    nodes = [(node, qid)]
-                    page_to_nodes[page_id] = nodes
-                elif not in_alist(node, nodes):
-                    nodes.append((node, qid))
-
-                pages = node_to_pages.get(node)
-                if pages == None:
-                    pages = [page_id]
-                    node_to_pages[node] = pages
-                elif not page_id in pages:
-                    pages.append(page_id)
-
-        print '| OTT nodes having at least one EOL page: %s' % len(node_to_pages)
-        print '| EOL page ids having at least one OTT node: %s' % len(page_to_nodes)
+            batch = pending.get(idspace)
+            if batch == None:
+                batch = ([], [], [])
+                pending[idspace] = batch
+            batch[0].append(row_count)
+            batch[1].append(page_id)
+            batch[2].append(source_id)
+            if len(batch[0]) >= LOOKUP_BATCH:
+                lookup_batch(tax, idspace, batch, page_to_nodes, node_to_pages)
+                del pending[idspace]
+        for idspace in sorted(pending.keys()):
+            lookup_batch(tax, idspace, pending[idspace], page_to_nodes, node_to_pages)
+
+    print '| OTT nodes having at least one EOL page: %s' % len(node_to_pages)
+    print '| EOL page ids having at least one OTT node: %s' % len(page_to_nodes)
 
     # Sort page ids for each OTT node (will use smallest one)
     for node in node_to_pages:
-        pages = node_to_pages[node]
-        if len(pages) > 1:
-            pages.sort(key=int)
+        node_to_pages[node] = sorted(node_to_pages[node], key=int)
+
+    # Sort nodes for each page id, for sake of deterministic output (?)
+    # and unique choice
+    for page_id in page_to_nodes:
+        page_to_nodes[page_id] = sorted([(node, qid) for (node, (row_number, qid))
+                                         in page_to_nodes[page_id].iteritems()],
+                                        key=lambda (node, qid): node.id)
 
     return (page_to_nodes, node_to_pages)
 
-def add_page_ids_to_nodes(tax, node_to_pages, page_to_nodes):
+# Batches finish out of file order, so for each (page, node) pair the
+# row number of the qid kept is remembered, and an earlier row's qid
+# replaces it; the first qid in the file is the one kept.
+
+def lookup_batch(tax, idspace, batch, page_to_nodes, node_to_pages):
+    (row_numbers, page_ids, source_ids) = batch
+    found = tax.lookupQids(idspace, array(source_ids, String))
+    for (i, node) in enumerate(found):
+        if node != None:   # and node.isPotentialOtu():
+            page_id = page_ids[i]
+            nodes = page_to_nodes.get(page_id)
+            if nodes == None:
+                nodes = {}
+                page_to_nodes[page_id] = nodes
+            kept = nodes.get(node)
+            if kept == None or row_numbers[i] < kept[0]:
+                nodes[node] = (row_numbers[i], QualifiedId(idspace, source_ids[i]))
+
+            pages = node_to_pages.get(node)
+            if pages == None:
+                node_to_pages[node] = set([page_id])
+            else:
+                pages.add(page_id)
 
-    # Sort for sake of deterministic output (?) and unique choice
-    for page_id in page_to_nodes:
-        nodes = page_to_nodes[page_id]
-        if len(nodes) > 1:
-            nodes.sort(key=lambda(node, qid): node.id)
+def add_page_ids_to_nodes(tax, node_to_pages, page_to_nodes):
 
     # Assign an EOL page id to as many nodes as possible
     for node in node_to_pages:
@@ -151,12 +176,6 @@ def report(page_to_nodes, reportpath):
                                      qid2, node2.name, div2,
                                      node1.rank.name, node1.mrca(node2).count(), similarity])
 
-def in_alist(node, nodes):
-    for (xnode, qid) in nodes:
-        if node is xnode:
-            return True
-    return False
-
 def get_eol_qid(node):
     for qid in node.sourceIds:
         if qid.prefix == 'eol':